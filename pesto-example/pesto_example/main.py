@@ -2,9 +2,10 @@ import logging
 import sys
 import traceback
 
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request
 
 from pesto_common.log.logger_factory import LoggerFactory
+from pesto_orm.dialect.mysql.domain import mysqlExecutor
 
 from router.example import app_example
 
@@ -18,12 +19,36 @@ app = Flask(__name__)
 app.register_blueprint(app_example)
 
 
+# 只读请求不固定连接, 会话内的查询都走主库, 只读请求仍然按语句分发到从库
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+@app.before_request
+def open_db_session():
+    # 写请求内的所有语句使用同一个主库连接, 请求结束时归还连接池
+    if request.method not in READ_ONLY_METHODS:
+        mysqlExecutor.open_session()
+        g.db_session = True
+
+
+@app.teardown_request
+def close_db_session(exception=None):
+    if g.pop('db_session', False):
+        mysqlExecutor.close_session()
+
+
 @app.route('/')
 def index():
     data = {'name': 'pesto-example'}
     return jsonify(data)
 
 
+@app.route('/metrics')
+def metrics():
+    # 连接池和sql执行的监控指标, Prometheus text format
+    return Response(mysqlExecutor.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     port = 8080
     try:
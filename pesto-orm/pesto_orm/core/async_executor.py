@@ -0,0 +1,243 @@
+'''
+asyncio 执行器, 接口与 Executor 一致, 所有执行方法都是协程
+事务状态保存在 contextvars 中, 使用 async with executor.transaction(): 开启事务
+事务连接只能在开启事务的任务中使用: 事务内 asyncio.gather/create_task 创建的任务会复制 contextvars, 使用事务连接时抛出 OPERATE_NOT_SUPPORT_ERROR
+'''
+import asyncio
+import contextvars
+import sys
+import time
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_orm.core.base import ExecuteMode, CursorMode
+from pesto_orm.core.error import DBErrorType, DBError, reraise
+from pesto_orm.core.executor import convert_row, convert_rows
+from pesto_orm.core.hooks import HookContext, HookRegistry, global_hooks, CHECKOUT, STATEMENT, TRANSACTION
+from pesto_orm.core.metrics import Metrics
+from pesto_orm.core.statement import check_statement
+
+logger = LoggerFactory.get_logger('core.async_executor')
+
+
+class AsyncTransaction(object):
+    '''
+    异步事务上下文, 嵌套使用时加入外层事务
+    '''
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._conn = None
+        self._token = None
+
+    async def __aenter__(self):
+        self._conn, self._token = await self._executor._begin_transaction()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._executor._end_transaction(self._conn, self._token, exc_type is None)
+        return False
+
+
+class AsyncExecutor(object):
+
+    def __init__(self, pool, show_sql=False, query_stats=None):
+        '''
+        :param query_stats: 按 sql 指纹统计执行耗时和行数并记录慢查询的 QueryStats, 为空时不统计
+        '''
+        self.__pool = pool
+        self.__show_sql = show_sql
+        self.query_stats = query_stats
+        # 只对该执行器生效的 hook, 全局 hook 见 pesto_orm.core.hooks.register_hook
+        self.hooks = HookRegistry()
+        self.__transaction_conn = contextvars.ContextVar('pesto_transaction_conn_%s' % id(self), default=None)
+        self.metrics = Metrics()
+
+    def show_sql(self, sql, params=None):
+        if isinstance(params, list) and len(params) > 0 and isinstance(params[0], tuple):
+            log_params = params[:5]
+            logger.info('Execute sql: {}, params(top5): \n{}'.format(sql, ', \n'.join([str(param_tuple) for param_tuple in log_params])))
+        else:
+            logger.info('Execute sql: {}, params: {}'.format(sql, params))
+
+    def get_metrics(self):
+        return {'executor': self.metrics.snapshot(), 'pool': self.__pool.get_metrics()}
+
+    def to_prometheus(self, labels=None):
+        return self.__pool.metrics.to_prometheus(labels=labels) + self.metrics.to_prometheus(labels=labels)
+
+    def in_transaction(self):
+        return self.__transaction_conn.get() is not None
+
+    def transaction(self):
+        return AsyncTransaction(self)
+
+    def __before_hooks(self, kind, statement_type, sql=None, params=None):
+        if not global_hooks.hooks and not self.hooks.hooks:
+            return None
+        return HookContext(global_hooks.hooks + self.hooks.hooks, self, kind, statement_type, sql=sql, params=params).before()
+
+    async def __hooked(self, kind, statement_type, action, conn=None):
+        '''
+        调用 action() 协程, 前后调用 checkout/transaction hook
+        '''
+        context = self.__before_hooks(kind, statement_type)
+        if context is None:
+            return await action()
+        if conn is not None:
+            context.set_connection(conn)
+        try:
+            result = await action()
+        except Exception as e:
+            context.finish(error=e)
+            raise
+        context.finish()
+        return result
+
+    def __transaction(self):
+        '''
+        当前任务的事务连接, 其他任务(复制了 contextvars)使用时抛出异常, 同一个连接不能并发执行语句
+        '''
+        transaction = self.__transaction_conn.get()
+        if transaction is None:
+            return None
+        conn, task = transaction
+        if task is not asyncio.current_task():
+            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR,
+                          message='Transaction connection can not be shared by concurrent tasks, await statements in the task that began the transaction.')
+        return conn
+
+    async def _begin_transaction(self):
+        if self.__transaction() is not None:
+            return None, None
+
+        conn = await self.__hooked(CHECKOUT, 'checkout', self.__pool.get_connection)
+        try:
+            await self.__hooked(TRANSACTION, 'begin', conn.begin, conn)
+        except Exception:
+            await self.__pool.discard_connection(conn)
+            raise
+        return conn, self.__transaction_conn.set((conn, asyncio.current_task()))
+
+    async def _end_transaction(self, conn, token, success):
+        if conn is None:
+            return
+
+        self.__transaction_conn.reset(token)
+        try:
+            if success:
+                await self.__hooked(TRANSACTION, 'commit', conn.commit, conn)
+            else:
+                await self.__hooked(TRANSACTION, 'rollback', conn.rollback, conn)
+        finally:
+            await self.__pool.return_connection(conn)
+
+    async def __acquire(self):
+        '''
+        事务内使用事务连接, 否则从连接池借出, 返回 (conn, 是否需要归还)
+        '''
+        conn = self.__transaction()
+        if conn is not None:
+            return conn, False
+        return await self.__hooked(CHECKOUT, 'checkout', self.__pool.get_connection), True
+
+    async def __execute(self, conn, sql, params=None, execute_mode=ExecuteMode.ONE_MODE):
+        if self.__show_sql:
+            self.show_sql(sql=sql, params=params)
+
+        cursor = await conn.cursor()
+        if execute_mode == ExecuteMode.ONE_MODE:
+            await cursor.execute(sql, params)
+        else:
+            await cursor.executemany(sql, params)
+        return cursor
+
+    async def __run(self, statement_type, sql, params, execute_mode, handle):
+        start = time.time()
+        conn = None
+        owned = False
+        cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, statement_type, sql, params)
+        try:
+            conn, owned = await self.__acquire()
+            if context is not None:
+                context.set_connection(conn)
+            cursor = await self.__execute(conn, sql, params=params, execute_mode=execute_mode)
+            result = await handle(cursor)
+            if owned and statement_type != 'select':
+                await conn.commit()
+            rows = len(result) if isinstance(result, list) else cursor.rowcount
+            return result
+        except DBError as e:
+            self.metrics.inc('executor_errors', labels={'key': e.code})
+            raise e
+        except Exception as e:
+            error = DBError(e, sql=sql, params=params)
+            self.metrics.inc('executor_errors', labels={'key': error.code})
+            reraise(error, sys.exc_info()[2])
+        finally:
+            if cursor:
+                await cursor.close()
+            if owned:
+                await self.__pool.return_connection(conn)
+            seconds = time.time() - start
+            self.metrics.observe('executor_statement_seconds', seconds, labels={'type': statement_type})
+            if self.query_stats is not None:
+                self.query_stats.record(sql, seconds, rows=rows, params=params, error=rows is None)
+            if context is not None:
+                context.finish(rowcount=rows, error=sys.exc_info()[1] if rows is None else None)
+
+    async def execute(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE):
+        check_statement(sql, ('INSERT', 'SELECT', 'UPDATE', 'DELETE'))
+
+        async def handle(cursor):
+            return True
+
+        return await self.__run('execute', sql, params, execute_mode, handle)
+
+    async def insert(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE):
+        check_statement(sql, ('DROP', 'CREATE', 'SELECT', 'UPDATE', 'DELETE'))
+
+        async def handle(cursor):
+            if execute_mode == ExecuteMode.ONE_MODE:
+                return cursor.lastrowid
+            return cursor.rowcount
+
+        return await self.__run('insert', sql, params, execute_mode, handle)
+
+    async def select_first(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE'))
+
+        async def handle(cursor):
+            row = await cursor.fetchone()
+            return convert_row(cursor_mode, tuple(column[0] for column in cursor.description), row)
+
+        return await self.__run('select', sql, params, ExecuteMode.ONE_MODE, handle)
+
+    async def select(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE'))
+
+        async def handle(cursor):
+            rows = await cursor.fetchall()
+            return convert_rows(cursor_mode, tuple(column[0] for column in cursor.description), rows)
+
+        return await self.__run('select', sql, params, ExecuteMode.ONE_MODE, handle)
+
+    async def update(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'SELECT', 'DELETE'))
+
+        async def handle(cursor):
+            return cursor.rowcount
+
+        return await self.__run('update', sql, params, ExecuteMode.ONE_MODE, handle)
+
+    async def delete(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'SELECT', 'UPDATE'))
+
+        async def handle(cursor):
+            return cursor.rowcount
+
+        return await self.__run('delete', sql, params, ExecuteMode.ONE_MODE, handle)
+
+    async def close(self):
+        await self.__pool.close()
@@ -0,0 +1,41 @@
+'''
+asyncio 领域模型, sql 构建与 BaseModel 相同, get_executor 需返回 AsyncExecutor
+'''
+from pesto_orm.core.model import BaseModel
+
+
+class AsyncBaseModel(BaseModel):
+
+    async def save(self):
+        sql, params = self.build_save_sql()
+        primary_value = await self.get_executor().insert(sql=sql, params=params)
+        self.set_attr(self.primary_key, primary_value)
+        return primary_value
+
+    '''
+    根据主键更新单个对象
+    '''
+
+    async def update(self):
+        sql, params = self.build_update_sql()
+        return await self.get_executor().update(sql=sql, params=params)
+
+    '''
+    根据主键删除单个对象
+    '''
+
+    async def delete(self):
+        sql, params = self.build_delete_sql()
+        return await self.get_executor().delete(sql, params)
+
+    '''
+    根据主键查询单个对象
+    '''
+
+    async def query(self):
+        sql, params = self.build_query_sql()
+        result = await self.get_executor().select_first(sql=sql, params=params)
+
+        self.clear_attrs()
+        self.set_attrs(result.copy())
+        return self
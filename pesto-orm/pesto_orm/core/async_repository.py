@@ -0,0 +1,141 @@
+'''
+asyncio 仓库, sql 构建与 BaseRepository 相同, get_executor 需返回 AsyncExecutor
+AsyncExecutor 没有的功能(列式查询、批量导入)抛出 OPERATE_NOT_SUPPORT_ERROR
+'''
+import asyncio
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_orm.core.base import ExecuteMode, CursorMode
+from pesto_orm.core.batch import chunk_values
+from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.repository import BaseRepository
+from pesto_orm.core.shard import ShardMerge
+
+logger = LoggerFactory.get_logger('core.async_repository')
+
+
+class AsyncBaseRepository(BaseRepository):
+
+    def __check_table(self, sql):
+        if self.table_name is not None and self.table_name not in sql:
+            logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
+
+    async def __fan_out(self, func):
+        # 事务连接不能被并发的任务共用, 任一分片有事务时串行执行
+        if any(executor.in_transaction() for executor in self.shard_router.executors):
+            return [await func(executor) for executor in self.shard_router.executors]
+        return await asyncio.gather(*[func(executor) for executor in self.shard_router.executors])
+
+    async def query_by(self, columns=['*'], where='', params=None, yield_able=False, shard_value=None, row_format=None):
+        sql, params = self.build_query_sql(columns=columns, where=where, params=params)
+        return await self.query(sql=sql, params=params, yield_able=yield_able, shard_value=shard_value, row_format=row_format)
+
+    async def query(self, sql='', params=None, yield_able=False, shard_value=None, row_format=None):
+        self.__check_table(sql)
+
+        cursor_mode = row_format or CursorMode.CURSOR_MODE
+        if self.shard_router is not None and shard_value is None:
+            merge = ShardMerge(sql)
+            shard_results = await self.__fan_out(lambda executor: executor.select(sql=merge.sql, params=params, cursor_mode=cursor_mode))
+            query_result = merge.merge(shard_results)
+        else:
+            query_result = await self._get_executor(shard_value).select(sql=sql, params=params, cursor_mode=cursor_mode)
+
+        if row_format is not None:
+            return query_result
+        if yield_able:
+            return self._yield_result(query_result)
+        else:
+            return self._return_result(query_result)
+
+    async def query_first_by(self, columns=['*'], where='', params=None, shard_value=None, row_format=None):
+        sql, params = self.build_query_first_sql(columns=columns, where=where, params=params)
+        return await self.query_first(sql=sql, params=params, shard_value=shard_value, row_format=row_format)
+
+    async def query_first(self, sql='', params=None, shard_value=None, row_format=None):
+        self.__check_table(sql)
+
+        cursor_mode = row_format or CursorMode.CURSOR_MODE
+        if self.shard_router is not None and shard_value is None:
+            merge = ShardMerge(sql)
+            if merge.offset:
+                shard_results = await self.__fan_out(lambda executor: executor.select(sql=merge.sql, params=params, cursor_mode=cursor_mode))
+            else:
+                shard_results = await self.__fan_out(lambda executor: executor.select_first(sql=merge.sql, params=params, cursor_mode=cursor_mode))
+                shard_results = [[shard_result] for shard_result in shard_results if shard_result]
+            query_result = next(iter(merge.merge(shard_results)), None)
+        else:
+            query_result = await self._get_executor(shard_value).select_first(sql=sql, params=params, cursor_mode=cursor_mode)
+
+        if row_format is not None:
+            return query_result
+
+        result = None
+        if query_result is not None and len(query_result) > 0:
+            result = self._create_instance()
+            if isinstance(result, dict):
+                result.update(query_result.copy())
+            else:
+                result.set_attrs(query_result.copy())
+        return result
+
+    async def get_many(self, ids, columns=['*'], shard_value=None, chunk_size=1000):
+        '''
+        按主键批量查询, 返回与 ids 顺序一致的模型列表, 不存在的 id 对应 None
+        ids 去重后按 chunk_size 分批执行 IN 查询, 各批次依次执行
+        '''
+        if list(columns) != ['*'] and self.primary_key not in columns:
+            columns = list(columns) + [self.primary_key]
+
+        rows = {}
+        for executor, group_ids in self._group_ids(ids, shard_value):
+            for chunk in chunk_values(group_ids, max_rows=chunk_size):
+                for row in await executor.select(sql=self._get_many_sql(columns, len(chunk)), params=tuple(chunk)):
+                    rows[row[self.primary_key]] = row
+        return self._ordered_models(ids, rows)
+
+    def query_columnar(self, sql='', params=None, shard_value=None, batch_size=10000):
+        raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Columnar query is not supported by async repository.')
+
+    def bulk_load(self, rows_or_path, columns=None, shard_value=None, chunk_rows=100000, insert_chunk_size=1000, fallback=True, tmp_dir=None, timeout=None):
+        raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Bulk load is not supported by async repository.')
+
+    async def page_by(self, columns=['*'], where='', page_num=1, page_size=1, params=None, yield_able=False, shard_value=None, row_format=None):
+        sql, params = self.build_page_sql(columns=columns, where=where, page_num=page_num, page_size=page_size, params=params)
+        return await self.page(sql=sql, params=params, yield_able=yield_able, shard_value=shard_value, row_format=row_format)
+
+    async def page(self, sql='', params=None, yield_able=False, shard_value=None, row_format=None):
+        return await self.query(sql=sql, params=params, yield_able=yield_able, shard_value=shard_value, row_format=row_format)
+
+    async def update_by(self, models=[], columns=[], where='', params=None, shard_value=None):
+        if self.shard_router is not None and len(models) > 0 and shard_value is None:
+            return sum([await self.update_by(models=group, shard_value=value) for value, group in self._group_by_shard(models)])
+
+        sql, params = self.build_update_sql(models=models, columns=columns, where=where, params=params)
+        return await self.update(sql=sql, params=params, shard_value=shard_value)
+
+    async def update(self, sql='', params=None, shard_value=None):
+        self.__check_table(sql)
+        return await self._get_executor(shard_value).update(sql=sql, params=params)
+
+    async def delete_by(self, models=[], where='', params=None, shard_value=None):
+        if self.shard_router is not None and len(models) > 0 and shard_value is None:
+            return sum([await self.delete_by(models=group, shard_value=value) for value, group in self._group_by_shard(models)])
+
+        sql, params = self.build_delete_sql(models=models, where=where, params=params)
+        return await self.delete(sql=sql, params=params, shard_value=shard_value)
+
+    async def delete(self, sql='', params=None, shard_value=None):
+        self.__check_table(sql)
+        return await self._get_executor(shard_value).delete(sql=sql, params=params)
+
+    async def insert_by(self, models=[], shard_value=None):
+        if self.shard_router is not None and shard_value is None:
+            return sum([await self.insert_by(models=group, shard_value=value) for value, group in self._group_by_shard(models)])
+
+        sql, params = self.build_insert_sql(models=models)
+        return await self.insert(sql=sql, params=params, shard_value=shard_value)
+
+    async def insert(self, sql='', params=[()], shard_value=None):
+        self.__check_table(sql)
+        return await self._get_executor(shard_value).insert(sql=sql, params=params, execute_mode=ExecuteMode.MANY_MODE)
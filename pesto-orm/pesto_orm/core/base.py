@@ -14,23 +14,65 @@ class ResultMode(Enum):
 
 
 class CursorMode(Enum):
+    '''
+    查询结果的行格式
+    CURSOR_MODE: 普通游标, 按列名组装为 dict
+    DICT_CURSOR_MODE: 驱动原生的 dict 游标
+    TUPLE_CURSOR_MODE: 驱动返回的原始 tuple
+    NAMEDTUPLE_CURSOR_MODE: namedtuple, 每种列结构只生成一次类型
+    '''
     CURSOR_MODE = 0
     DICT_CURSOR_MODE = 1
+    TUPLE_CURSOR_MODE = 2
+    NAMEDTUPLE_CURSOR_MODE = 3
+
+
+def _get_bool(name, default_value=False):
+    value = Configer.get(name, default_value)
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
 
 
 db_config = {}
 if Configer.contains('db.'):
     db_config = {
-        'show_sql': bool(Configer.get('db.show_sql', False)),
+        'show_sql': _get_bool('db.show_sql', False),
         'user': Configer.get('db.user'),
         'password': Configer.get('db.password'),
         'host': Configer.get('db.host'),
         'port': Configer.get('db.port'),
         'database': Configer.get('db.database'),
-        'core_size': Configer.get('db.core_size', 20),
-        'max_size': Configer.get('db.max_size', 100),
-        'raise_on_warnings': bool(Configer.get('db.raise_on_warnings', False)),
+        'core_size': int(Configer.get('db.core_size', 20)),
+        'max_size': int(Configer.get('db.max_size', 100)),
+        'checkout_timeout': float(Configer.get('db.checkout_timeout', 30)),
+        'validation_interval': float(Configer.get('db.validation_interval', 30)),
+        'idle_timeout': float(Configer.get('db.idle_timeout', 600)),
+        'max_lifetime': float(Configer.get('db.max_lifetime', 1800)),
+        'lazy_init': _get_bool('db.lazy_init', False),
+        'warm_up': _get_bool('db.warm_up', False),
+        'adaptive_sizing': _get_bool('db.adaptive_sizing', False),
+        'sizing_interval': float(Configer.get('db.sizing_interval', 10)),
+        'sizing_cool_down': float(Configer.get('db.sizing_cool_down', 60)),
+        'replicas': [replica.strip() for replica in Configer.get('db.replicas', '').split(',') if replica.strip()],
+        'replica_balance': Configer.get('db.replica_balance', 'round_robin'),
+        'read_your_writes': float(Configer.get('db.read_your_writes', 0)),
+        'query_cache_size': int(Configer.get('db.query_cache_size', 10000)),
+        'entity_cache_size': int(Configer.get('db.entity_cache_size', 0)),
+        'entity_cache_ttl': float(Configer.get('db.entity_cache_ttl', 0)),
+        'max_allowed_packet': int(Configer.get('db.max_allowed_packet', 4 * 1024 * 1024)),
+        'statement_timeout': float(Configer.get('db.statement_timeout', 0)),
+        'max_retries': int(Configer.get('db.max_retries', 2)),
+        'retry_backoff': float(Configer.get('db.retry_backoff', 0.05)),
+        'retry_max_backoff': float(Configer.get('db.retry_max_backoff', 1)),
+        'slow_threshold_ms': float(Configer.get('db.slow_threshold_ms', 0)),
+        'query_stats_size': int(Configer.get('db.query_stats_size', 1000)),
+        'query_stats_interval': float(Configer.get('db.query_stats_interval', 0)),
+        'query_stats_top': int(Configer.get('db.query_stats_top', 10)),
+        'raise_on_warnings': _get_bool('db.raise_on_warnings', False),
         'charset': Configer.get('db.charset', 'utf8mb4'),
         'connection_timeout': int(Configer.get('db.connection_timeout', 180)),
-        'autocommit': bool(Configer.get('db.autocommit', True)),
+        'autocommit': _get_bool('db.autocommit', True),
+        # 开启后服务端可以请求读取客户端的任意文件, 只在信任服务端时开启; 关闭时 bulk_load 退回多行 insert
+        'allow_local_infile': _get_bool('db.allow_local_infile', False),
     }
@@ -0,0 +1,75 @@
+'''
+批量操作工具: 按行数和估算的 sql 字节数切分参数, 保证拼接后的语句不超过 max_allowed_packet
+'''
+import datetime
+import decimal
+import re
+
+DEFAULT_MAX_ALLOWED_PACKET = 4 * 1024 * 1024
+# 预留给协议头和 sql 其他部分的字节数
+PACKET_RESERVED_SIZE = 1024
+
+# 单行 INSERT/REPLACE ... VALUES (...) [ON DUPLICATE KEY UPDATE ...], 一行的括号内允许一层函数调用, 不允许字符串常量
+_values_row_pattern = re.compile(r'^(.*?\bVALUES?\s*)(\((?:[^()\'"]|\([^()\'"]*\))*\))(\s*(?:ON\s+DUPLICATE\s+KEY\s+UPDATE\b.*)?)$', re.I | re.S)
+
+
+def estimate_size(value):
+    '''
+    估算参数转义为 sql 字面量后的字节数, 偏大估计
+    '''
+    if value is None:
+        return 4
+    if isinstance(value, bool):
+        return 5
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return len(str(value))
+    if isinstance(value, str):
+        # 转义最多翻倍, 再加引号
+        return len(value.encode('utf-8')) * 2 + 2
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) * 2 + 3
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+        return 28
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_size(item) + 1 for item in value) + 2
+    return len(str(value)) * 2 + 2
+
+
+def chunk_values(values, max_rows=None, max_bytes=None, base_size=0, size_of=estimate_size):
+    '''
+    按顺序切分 values, 每组最多 max_rows 个, 且 base_size + 各值估算大小(含分隔符)不超过 max_bytes
+    单个值超过 max_bytes 时单独成组
+    '''
+    chunk = []
+    chunk_size = base_size
+    for value in values:
+        size = size_of(value) + 1
+        if chunk and ((max_rows is not None and len(chunk) >= max_rows) or (max_bytes is not None and chunk_size + size > max_bytes)):
+            yield chunk
+            chunk = []
+            chunk_size = base_size
+        chunk.append(value)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+def split_insert_values(sql):
+    '''
+    拆分单行 insert 为 (VALUES 及之前的部分, 一行的占位符, 之后的部分), 用于改写为多行 VALUES (...), (...)
+    INSERT ... SELECT、命名参数、一行中有字符串常量时返回 None
+    '''
+    if '%(' in sql:
+        return None
+    match = _values_row_pattern.match(sql)
+    if match is None:
+        return None
+    return match.groups()
+
+
+def multi_row_sql(parts, count):
+    '''
+    split_insert_values 的结果拼接为 count 行的 insert
+    '''
+    prefix, row, suffix = parts
+    return prefix + ', '.join([row] * count) + suffix
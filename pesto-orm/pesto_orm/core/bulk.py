@@ -0,0 +1,173 @@
+'''
+批量导入工具: 逐行读取可迭代的行、csv 文件(FileUtils.save_dict 格式)或 pickle 文件(FileUtils.add_to_pickle 格式),
+每 chunk_rows 行写入一个临时文件后执行 LOAD DATA LOCAL INFILE, 导入后删除, 内存和磁盘中最多保留一个批次
+客户端或服务端不允许 LOCAL INFILE 时退回多行 insert(Executor.insert_many)
+'''
+import csv
+import datetime
+import itertools
+import os
+import tempfile
+import time
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_common.utils.file_utils import FileUtils
+from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.statement import quote_identifier
+
+logger = LoggerFactory.get_logger('core.bulk')
+
+# LOAD DATA 默认格式的转义: 字段以 \t 分隔, 行以 \n 结束, \ 为转义符
+_escape_table = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+_escape_bytes = ((b'\\', b'\\\\'), (b'\t', b'\\t'), (b'\n', b'\\n'), (b'\r', b'\\r'), (b'\0', b'\\0'))
+
+
+def infile_value(value):
+    '''
+    值转换为 LOAD DATA 默认格式的字段(utf-8 字节), None 为 \\N
+    '''
+    if value is None:
+        return b'\\N'
+    if isinstance(value, bool):
+        return b'1' if value else b'0'
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value)
+        for old, new in _escape_bytes:
+            value = value.replace(old, new)
+        return value
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat(' ')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.translate(_escape_table).encode('utf-8')
+
+
+def write_infile(rows, _file):
+    '''
+    按 LOAD DATA 默认格式写入行, rows 中每行为与列顺序一致的值序列
+    '''
+    for row in rows:
+        _file.write(b'\t'.join(map(infile_value, row)) + b'\n')
+
+
+def _read_csv(path):
+    if not os.path.exists(path):
+        raise IOError('the file [{}] is not exist!'.format(path))
+    with open(path, 'r', newline='', encoding='utf-8-sig') as _file:
+        header = next(csv.reader(_file, dialect='excel'), None)
+
+    def rows():
+        # 遍历时才打开文件, 生成器没有被使用时不会占用文件句柄
+        with open(path, 'r', newline='', encoding='utf-8-sig') as _file:
+            reader = csv.reader(_file, dialect='excel')
+            next(reader, None)
+            for row in reader:
+                # save_dict 把 None 写为空字符串, 读回时作为 NULL
+                yield [None if value == '' else value for value in row]
+
+    return header, rows()
+
+
+def _read_pickle(path):
+    for item in FileUtils.read_pickle(path):
+        # 一次 add_to_pickle 可以写入一行, 也可以写入一批行
+        if isinstance(item, list) and item and isinstance(item[0], (dict, tuple, list)):
+            for row in item:
+                yield row
+        else:
+            yield item
+
+
+def read_source(source):
+    '''
+    数据来源: .csv 文件路径(第一行为列名)、其他文件路径(pickle)或可迭代的行, 返回 (文件中的列名或 None, 行迭代器)
+    '''
+    if isinstance(source, str):
+        if source.lower().endswith('.csv'):
+            return _read_csv(source)
+        return None, _read_pickle(source)
+    return None, iter(source)
+
+
+def row_attrs(row):
+    get_attrs = getattr(row, 'get_attrs', None)
+    return get_attrs() if get_attrs is not None else row
+
+
+def row_values(row, columns):
+    '''
+    行(dict、模型、tuple/list)转换为与 columns 顺序一致的值序列
+    '''
+    row = row_attrs(row)
+    if isinstance(row, dict):
+        return [row.get(column) for column in columns]
+    return row
+
+
+def bulk_load(executor, table, source, columns=None, build_insert_sql=None, chunk_rows=100000, insert_chunk_size=1000, fallback=True, timeout=None,
+              tmp_dir=None):
+    '''
+    :param source: 可迭代的行(dict、模型、tuple/list)、csv 文件路径或 pickle 文件路径
+    :param columns: 列名, 为空时使用 csv 的第一行或第一行数据(dict/模型)的键, 行为 tuple/list 时必须指定
+    :param build_insert_sql: 按列名(已用反引号引用)生成单行 insert 的方法, 退回多行 insert 时使用
+    :param chunk_rows: 每个临时文件(一条 LOAD DATA 语句)的行数, 每个批次单独提交
+    :param fallback: 不允许 LOCAL INFILE 时是否退回多行 insert, 否则抛出异常
+    :return: {'rows': 读取的行数, 'rowcount': 导入的行数, 'seconds': 耗时, 'rows_per_second': 每秒行数, 'method': load_data 或 insert}
+    '''
+    start = time.time()
+    header, rows = read_source(source)
+    first = next(rows, None)
+    if columns is None:
+        columns = header
+    if columns is None and first is not None:
+        attrs = row_attrs(first)
+        if not isinstance(attrs, dict):
+            raise DBError(key=DBErrorType.SQL_BUILD_ERROR, message='Columns is required when rows are not dict or model.')
+        columns = list(attrs.keys())
+    columns = list(columns or [])
+
+    method = 'load_data'
+    total = 0
+    rowcount = 0
+    rows = itertools.chain([] if first is None else [first], rows)
+    while True:
+        chunk = [row_values(row, columns) for row in itertools.islice(rows, chunk_rows)]
+        if not chunk:
+            break
+
+        chunk_start = time.time()
+        count = None
+        if method == 'load_data':
+            try:
+                count = _load_chunk(executor, table, columns, chunk, timeout, tmp_dir)
+            except DBError as e:
+                if not fallback or build_insert_sql is None or e.code not in executor.local_infile_error_codes:
+                    raise
+                logger.warning('Load data local infile not allowed ({}), fallback to multi-row insert: {}'.format(e.code, e))
+                method = 'insert'
+        if method == 'insert':
+            results = executor.insert_many(build_insert_sql([quote_identifier(column) for column in columns]), chunk, chunk_size=insert_chunk_size, timeout=timeout)
+            count = sum(result['rowcount'] for result in results)
+
+        total += len(chunk)
+        rowcount += count
+        logger.info('Bulk load {} chunk: {} rows in {:.2f}s, total {} rows'.format(table, len(chunk), time.time() - chunk_start, total))
+
+    seconds = time.time() - start
+    rows_per_second = total / seconds if seconds > 0 else 0.0
+    executor.metrics.inc('executor_bulk_load_rows', total, labels={'method': method})
+    logger.info('Bulk load {} finished: {} rows in {:.2f}s, {:.0f} rows/s, method: {}'.format(table, total, seconds, rows_per_second, method))
+    return {'rows': total, 'rowcount': rowcount, 'seconds': seconds, 'rows_per_second': rows_per_second, 'method': method}
+
+
+def _load_chunk(executor, table, columns, chunk, timeout, tmp_dir):
+    _file = tempfile.NamedTemporaryFile(prefix='pesto-bulk-', suffix='.tsv', dir=tmp_dir, delete=False)
+    try:
+        with _file:
+            write_infile(chunk, _file)
+        return executor.load_data(_file.name, table, columns, timeout=timeout)
+    finally:
+        try:
+            os.remove(_file.name)
+        except OSError as e:
+            logger.warning('Remove bulk load file error: {}'.format(e))
@@ -0,0 +1,304 @@
+'''
+查询缓存相关工具
+
+LRUCache: 线程安全的 LRU + TTL 缓存, 容量按 weigher 计算的权重限制(默认每个条目权重为 1)
+SingleFlight: 同一个 key 的并发调用只执行一次, 其他调用等待并共享结果
+QueryCache: 按 (sql, params) 缓存查询结果, 记录每个结果涉及的表, 写操作按表失效
+EntityCache: 按 (表, 主键) 缓存实体属性的接口, LocalEntityCache 为进程内 LRU 实现, 也可以实现为共享缓存(例如 redis)
+'''
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size=10000, ttl=None, weigher=None):
+        '''
+        :param max_size: 最大总权重, 超出后淘汰最久未使用的条目
+        :param ttl: 默认过期时间(秒), None 表示不过期
+        :param weigher: 计算条目权重的函数, 默认每个条目权重为 1
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self._weigher = weigher
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (value, expire_at, weight)
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def weight(self):
+        return self._weight
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expire_at, weight = entry
+            if expire_at is not None and expire_at <= time.time():
+                self.__remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        weight = self._weigher(value) if self._weigher is not None else 1
+        if weight > self.max_size:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self.__remove(key)
+            self._entries[key] = (value, None if ttl is None else time.time() + ttl, weight)
+            self._weight += weight
+            while self._weight > self.max_size and self._entries:
+                self.__remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self.__remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def __remove(self, key):
+        value, expire_at, weight = self._entries.pop(key)
+        self._weight -= weight
+        self._on_remove(key, value)
+
+    def _on_remove(self, key, value):
+        pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._entries), 'weight': self._weight, 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_ratio': float(self.hits) / total if total > 0 else 0.0}
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    同一个 key 同时只有一个调用在执行, 其他线程等待该调用的结果(或异常)
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        '''
+        返回 (result, shared), shared 为 True 表示结果来自其他线程的调用
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+def make_key(sql, params, *extra):
+    '''
+    (sql, params) 转换为可哈希的缓存 key, 参数不可哈希时返回 None 表示不缓存
+    '''
+    if params is None:
+        params_key = None
+    elif isinstance(params, dict):
+        params_key = tuple(sorted(params.items()))
+    elif isinstance(params, (list, tuple)):
+        params_key = tuple(params)
+    else:
+        params_key = params
+    key = (sql, params_key) + extra
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class QueryCache(LRUCache):
+    '''
+    查询结果缓存, 容量按行数计算; 每张表维护一个版本号, 查询开始后表被写入则结果不再放入缓存, 避免缓存旧数据
+    '''
+
+    def __init__(self, max_size=10000, ttl=None):
+        super(QueryCache, self).__init__(max_size=max_size, ttl=ttl, weigher=lambda value: max(len(value[0]) if isinstance(value[0], list) else 1, 1))
+        self._table_keys = {}
+        self._versions = {}
+        self._global_version = 0
+        self.invalidations = 0
+
+    def versions(self, tables):
+        with self._lock:
+            return self._global_version, tuple(self._versions.get(table, 0) for table in tables)
+
+    def get_result(self, key):
+        entry = self.get(key)
+        return None if entry is None else entry[0]
+
+    def put_result(self, key, result, tables, versions, ttl=None):
+        with self._lock:
+            if self.versions(tables) != versions:
+                return False
+            if not self.put(key, (result, tables), ttl=ttl):
+                return False
+            for table in tables:
+                self._table_keys.setdefault(table, set()).add(key)
+            return True
+
+    def _on_remove(self, key, value):
+        for table in value[1]:
+            keys = self._table_keys.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._table_keys[table]
+
+    def clear(self):
+        with self._lock:
+            super(QueryCache, self).clear()
+            self._table_keys.clear()
+
+    def invalidate(self, tables=None):
+        '''
+        失效涉及这些表的缓存结果, tables 为 None 或空时失效全部
+        '''
+        with self._lock:
+            self.invalidations += 1
+            if not tables:
+                self._global_version += 1
+                self.clear()
+                return
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                for key in list(self._table_keys.get(table, ())):
+                    self.pop(key)
+
+    def stats(self):
+        stats = super(QueryCache, self).stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+
+class EntityCache(object):
+    '''
+    实体缓存接口, 值为实体属性 dict, 实现需要自行保证线程安全
+    '''
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def get(self, table, primary_value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, table, primary_value, attrs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def evict(self, table, primary_value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def evict_table(self, table):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LocalEntityCache(EntityCache):
+    '''
+    进程内的实体缓存, 最多保留 max_size 个实体, ttl 为空时不过期
+    '''
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = LRUCache(max_size=max_size, ttl=ttl)
+        self._cache._on_remove = self.__on_remove
+        self._table_keys = {}
+
+    def __on_remove(self, key, value):
+        keys = self._table_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._table_keys[key[0]]
+
+    def get(self, table, primary_value):
+        return self._cache.get((table, primary_value))
+
+    def put(self, table, primary_value, attrs):
+        key = (table, primary_value)
+        with self._cache._lock:
+            if self._cache.put(key, attrs):
+                self._table_keys.setdefault(table, set()).add(key)
+
+    def evict(self, table, primary_value):
+        self._cache.pop((table, primary_value))
+
+    def evict_table(self, table):
+        with self._cache._lock:
+            for key in list(self._table_keys.get(table, ())):
+                self._cache.pop(key)
+
+    def clear(self):
+        with self._cache._lock:
+            self._cache.clear()
+            self._table_keys.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,88 @@
+'''
+列式查询结果, 每列一个带 NULL 掩码的 numpy 数组(numpy.ma.MaskedArray), 需单独安装 numpy
+
+按 cursor.description 中的字段类型码选择 dtype, 类型码到 dtype 的映射由方言提供(见 MySQLDialect.columnar_types),
+没有映射的列使用 object 数组
+'''
+from pesto_orm.core.error import DBError, DBErrorType
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# NULL 在各类数组中的占位值, 通过掩码区分
+_FILL_VALUES = {
+    'b': False,
+    'i': 0,
+    'u': 0,
+    'f': float('nan'),
+    'M': 'NaT',
+    'm': 'NaT',
+}
+
+
+def check_numpy():
+    if numpy is None:
+        raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Columnar query needs numpy, please install it first.')
+
+
+class ColumnarBuilder(object):
+    '''
+    按批追加行, 每批转换为各列的数组片段, 最后拼接, 避免持有全部行对象
+    '''
+
+    def __init__(self, description, type_map=None):
+        check_numpy()
+        type_map = type_map or {}
+        self.column_names = [column[0] for column in description]
+        self.dtypes = [numpy.dtype(type_map.get(column[1], object)) for column in description]
+        self.__chunks = [[] for _ in self.column_names]
+        self.__masks = [[] for _ in self.column_names]
+
+    def __convert(self, values, dtype):
+        mask = numpy.fromiter((value is None for value in values), dtype=bool, count=len(values))
+        if dtype.kind == 'O':
+            # 逐个赋值, 避免 tuple/list 类型的值被展开为多维数组
+            data = numpy.empty(len(values), dtype=object)
+            data[:] = values
+        elif not mask.any():
+            data = numpy.array(values, dtype=dtype)
+        else:
+            fill = _FILL_VALUES.get(dtype.kind)
+            data = numpy.array([fill if value is None else value for value in values], dtype=dtype)
+        return data, mask
+
+    def append(self, rows):
+        if not rows:
+            return
+        for i, values in enumerate(zip(*rows)):
+            data, mask = self.__convert(values, self.dtypes[i])
+            self.__chunks[i].append(data)
+            self.__masks[i].append(mask)
+
+    def build(self):
+        result = {}
+        for i, name in enumerate(self.column_names):
+            if self.__chunks[i]:
+                data = numpy.concatenate(self.__chunks[i])
+                mask = numpy.concatenate(self.__masks[i])
+            else:
+                data = numpy.empty(0, dtype=self.dtypes[i])
+                mask = numpy.empty(0, dtype=bool)
+            # 没有 NULL 时使用 nomask, 不额外占用内存
+            result[name] = numpy.ma.array(data, mask=mask if mask.any() else numpy.ma.nomask)
+            self.__chunks[i] = None
+            self.__masks[i] = None
+        return result
+
+
+def concat_columnar(results):
+    '''
+    拼接多个列式结果(例如多个分片), 列名以第一个结果为准
+    '''
+    check_numpy()
+    results = [result for result in results if result]
+    if not results:
+        return {}
+    return dict((name, numpy.ma.concatenate([result[name] for result in results])) for name in results[0])
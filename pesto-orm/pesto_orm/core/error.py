@@ -14,6 +14,9 @@ class DBErrorType(Enum):
     CURSOR_MODE_ERROR = 100002
     OPERATE_NOT_SUPPORT_ERROR = 100003
     SQL_BUILD_ERROR = 100004
+    TOO_MANY_CONNECTIONS_ERROR = 100005
+    SHARD_ERROR = 100006
+    TIMEOUT_ERROR = 100007
 
 
 class BaseError(Exception):
@@ -38,6 +41,8 @@ class BaseError(Exception):
             if (self.key is None) & hasattr(cause, 'status'):
                 self.key = cause.status
 
+        # 保留原始错误码, 便于按错误码统计和判断
+        self.code = self.key.name if isinstance(self.key, Enum) else self.key
         self.key = '' if self.key is None else '%s: ' % str(self.key)
 
         if message is None:
@@ -1,23 +1,176 @@
+import os
+import itertools
+import random
+import re
 import sys
 import threading
+import time
+import weakref
 from abc import ABCMeta
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from pesto_common.log.logger_factory import LoggerFactory
-from pesto_orm.core.base import ExecuteMode, CursorMode
+from pesto_orm.core.base import ExecuteMode, CursorMode, ResultMode
+from pesto_orm.core.batch import DEFAULT_MAX_ALLOWED_PACKET, PACKET_RESERVED_SIZE, chunk_values, estimate_size, multi_row_sql, split_insert_values
+from pesto_orm.core.cache import QueryCache, SingleFlight, LocalEntityCache, make_key
+from pesto_orm.core.columnar import ColumnarBuilder, check_numpy
 from pesto_orm.core.error import DBErrorType, DBError, reraise
+from pesto_orm.core.hooks import HookContext, HookRegistry, global_hooks, CHECKOUT, STATEMENT, TRANSACTION
+from pesto_orm.core.metrics import Metrics, merge_prometheus
+from pesto_orm.core.query_stats import QueryStats
+from pesto_orm.core.statement import add_hint, check_statement, normalize_table, quote_identifier, statement_tables, statement_type
+from pesto_orm.core.watchdog import Watchdog
 from pesto_orm.db.pool import ConnectionPool
 
 logger = LoggerFactory.get_logger('core.executor')
 
+_AT_FORK = hasattr(os, 'register_at_fork')
+_executors = weakref.WeakSet()
+
+# 会修改已有行的 insert
+_upsert_pattern = re.compile(r'\bON\s+DUPLICATE\s+KEY\s+UPDATE\b', re.I)
+
+
+def backoff_delay(attempt, backoff, max_backoff):
+    '''
+    第 attempt 次重试(从 1 开始)前的等待时间(秒), 指数退避加随机抖动(full jitter): 第一次不超过 backoff, 之后每次翻倍, 不超过 max_backoff
+    '''
+    return random.uniform(0, min(max_backoff, backoff * (2 ** (attempt - 1))))
+
+
+@lru_cache(maxsize=256)
+def _row_class(column_names):
+    return namedtuple('Row', column_names, rename=True)
+
+
+def convert_rows(cursor_mode, column_names, rows):
+    '''
+    按游标模式转换一批行, column_names 为 tuple
+    '''
+    if not rows:
+        return []
+    if cursor_mode == CursorMode.TUPLE_CURSOR_MODE:
+        return rows if isinstance(rows, list) else list(rows)
+    if cursor_mode == CursorMode.NAMEDTUPLE_CURSOR_MODE:
+        return list(map(_row_class(column_names)._make, rows))
+    if isinstance(rows[0], dict):
+        return rows if isinstance(rows, list) else list(rows)
+    return [dict(zip(column_names, row)) for row in rows]
+
+
+def convert_row(cursor_mode, column_names, row):
+    '''
+    按游标模式转换单行, 没有数据时 dict 模式返回 {}, 其他模式返回 None
+    '''
+    if row is None or len(row) == 0:
+        if cursor_mode in (CursorMode.TUPLE_CURSOR_MODE, CursorMode.NAMEDTUPLE_CURSOR_MODE):
+            return None
+        return {}
+    return convert_rows(cursor_mode, column_names, [row])[0]
+
 
 class Executor(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, pool, show_sql=False):
+    # 不同结果模式下创建游标的参数, USE_RESULT_MODE 使用非缓冲游标, 结果集保留在服务端边读边取
+    result_mode_cursor_args = {
+        ResultMode.STORE_RESULT_MODE: {},
+        ResultMode.USE_RESULT_MODE: {'buffered': False},
+    }
+    # 不同游标模式下创建游标的参数, DICT_CURSOR_MODE 使用驱动原生的 dict 游标, 其他模式由执行器转换行格式
+    cursor_mode_cursor_args = {
+        CursorMode.CURSOR_MODE: {},
+        CursorMode.DICT_CURSOR_MODE: {'dictionary': True},
+        CursorMode.TUPLE_CURSOR_MODE: {},
+        CursorMode.NAMEDTUPLE_CURSOR_MODE: {},
+    }
+
+    # 指定超时时给 SELECT 加上的优化器提示(毫秒), 由服务端中断查询; 服务端不支持时设为 None, 改用看门狗
+    select_timeout_hint = '/*+ MAX_EXECUTION_TIME({}) */'
+    # 看门狗超时后在另一个连接上中断语句
+    kill_query_sql = 'KILL QUERY {}'
+    # 服务端执行超时的错误码(MAX_EXECUTION_TIME)
+    timeout_error_codes = (3024,)
+    # 可以在新连接上重试的临时错误: 1053 服务端正在关闭, 2003 无法连接, 2006 server has gone away, 2013/2055 查询中连接断开
+    transient_error_codes = (1053, 2003, 2006, 2013, 2055)
+    # 嵌套事务使用的保存点语句
+    savepoint_sql = 'SAVEPOINT {}'
+    release_savepoint_sql = 'RELEASE SAVEPOINT {}'
+    rollback_savepoint_sql = 'ROLLBACK TO SAVEPOINT {}'
+    # 导入文件, 使用 LOAD DATA 的默认格式(见 pesto_orm.core.bulk.write_infile)
+    load_data_sql = 'LOAD DATA LOCAL INFILE %s INTO TABLE {} CHARACTER SET utf8mb4 ({})'
+    # 不允许 LOCAL INFILE: 1148 服务端不支持, 3948 服务端 local_infile 关闭, 2068 客户端拒绝(allow_local_infile)
+    local_infile_error_codes = (1148, 2068, 3948)
+
+    def __cursor_args(self, cursor_mode, result_mode=ResultMode.STORE_RESULT_MODE):
+        args = dict(self.result_mode_cursor_args[result_mode])
+        args.update(self.cursor_mode_cursor_args[cursor_mode])
+        return args
+
+    def __init__(self, pool, show_sql=False, replica_pools=None, replica_balance='round_robin', read_your_writes=0, query_cache_size=10000, entity_cache=None,
+                 max_allowed_packet=DEFAULT_MAX_ALLOWED_PACKET, query_stats=None, statement_timeout=None, max_retries=2, retry_backoff=0.05, retry_max_backoff=1.0):
+        '''
+        :param pool: 主库连接池, 写操作和事务内的所有操作都使用主库
+        :param replica_pools: 从库连接池, 事务和会话外的 select/select_first 路由到从库
+        :param replica_balance: 从库负载均衡方式 round_robin 或 least_in_use
+        :param read_your_writes: 写操作之后该线程在多少秒内的读操作仍然使用主库
+        :param query_cache_size: 查询缓存最多保留的行数, select/select_first 指定 cache_ttl 时才使用缓存
+        :param entity_cache: 按 (表, 主键) 缓存实体属性的 EntityCache(表名按 normalize_table 转换, 主键统一转换为字符串), 为空时不使用实体缓存
+        :param max_allowed_packet: 服务端 max_allowed_packet, 批量操作据此切分语句
+        :param query_stats: 按 sql 指纹统计执行耗时和行数并记录慢查询的 QueryStats, 为空时不统计
+        :param statement_timeout: 默认的语句超时(秒), 为空时不限制, 各方法的 timeout 参数优先
+        :param max_retries: 事务外遇到连接断开等临时错误时的最多重试次数, 0 表示不重试
+        :param retry_backoff: 重试的初始退避时间(秒), 每次翻倍并加随机抖动, 不超过 retry_max_backoff
+        '''
+        if replica_balance not in ('round_robin', 'least_in_use'):
+            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support replica balance: {}'.format(replica_balance))
+
         self.__pool = pool
         self.__show_sql = show_sql
+        self.__replica_pools = list(replica_pools or [])
+        self.__replica_balance = replica_balance
+        self.__replica_counter = itertools.count()
+        self.__read_your_writes = read_your_writes
+        self.query_cache = QueryCache(max_size=query_cache_size)
+        self.__single_flight = SingleFlight()
+        self.entity_cache = entity_cache
+        self.max_allowed_packet = max_allowed_packet
+        self.query_stats = query_stats
+        self.statement_timeout = statement_timeout
+        self.__watchdog = Watchdog()
+        self.__max_retries = max_retries
+        self.__retry_backoff = retry_backoff
+        self.__retry_max_backoff = retry_max_backoff
+        # 只对该执行器生效的 hook, 全局 hook 见 pesto_orm.core.hooks.register_hook
+        self.hooks = HookRegistry()
+        self.__entity_versions = {}
+        self.__entity_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.metrics.gauge('executor_query_cache_rows', lambda: self.query_cache.weight())
 
         # 保留本地conn
+        self.__pid = os.getpid()
+        self.__local_conn = threading.local()
+        self.__local_conn.conn = None
+        self.__local_conn.use_transaction = False
+        _executors.add(self)
+
+    def _reset_after_fork(self):
+        '''
+        fork 后在子进程中丢弃线程本地的连接和事务状态, 连接池自行重建, 查询缓存和指标的锁可能被父进程的其他线程持有, 一并重建
+        '''
+        self.__pid = os.getpid()
+        self.metrics._reset_after_fork()
+        self.query_cache = QueryCache(max_size=self.query_cache.max_size)
+        self.__single_flight = SingleFlight()
+        if isinstance(self.entity_cache, LocalEntityCache):
+            self.entity_cache = LocalEntityCache(max_size=self.entity_cache.max_size, ttl=self.entity_cache.ttl)
+        self.__entity_lock = threading.Lock()
+        self.__watchdog._reset_after_fork()
+        if self.query_stats is not None:
+            self.query_stats._reset_after_fork()
         self.__local_conn = threading.local()
         self.__local_conn.conn = None
         self.__local_conn.use_transaction = False
@@ -29,6 +182,90 @@ class Executor(object):
         else:
             logger.info('Execute sql: {}, params: {}'.format(sql, params))
 
+    def get_metrics(self):
+        '''
+        执行器和连接池的监控指标快照
+        '''
+        metrics = {'executor': self.metrics.snapshot(), 'pool': self.__pool.get_metrics(), 'query_cache': self.query_cache.stats()}
+        if self.query_stats is not None:
+            metrics['slow_queries'] = self.query_stats.slow_count
+        if self.entity_cache is not None:
+            metrics['entity_cache'] = self.entity_cache.stats()
+        if self.__replica_pools:
+            metrics['replicas'] = [pool.get_metrics() for pool in self.__replica_pools]
+        return metrics
+
+    def to_prometheus(self, labels=None):
+        '''
+        执行器和连接池的指标, 连接池的指标带 pool="primary" 或 pool="replica-N" 标签, 同名指标只输出一次 TYPE
+        '''
+        sources = [(self.__pool.metrics, dict(labels or {}, pool='primary')), (self.metrics, labels)]
+        for i, pool in enumerate(self.__replica_pools):
+            sources.append((pool.metrics, dict(labels or {}, pool='replica-{}'.format(i))))
+        return merge_prometheus(sources)
+
+    def __observe(self, statement_type, start, sql=None, params=None, rows=None, error=None, context=None):
+        '''
+        记录语句耗时并调用 hook, rows 为返回或影响的行数, error 为空时 rows 为空表示执行失败
+        '''
+        seconds = time.time() - start
+        failed = rows is None if error is None else error
+        self.metrics.observe('executor_statement_seconds', seconds, labels={'type': statement_type})
+        if self.query_stats is not None and sql is not None:
+            self.query_stats.record(sql, seconds, rows=rows, params=params, error=failed)
+        if context is not None:
+            # 在 finally 中调用, 失败时 sys.exc_info() 为正在抛出的异常
+            context.finish(rowcount=rows, error=sys.exc_info()[1] if failed else None)
+
+    def __before_hooks(self, kind, statement_type, sql=None, params=None):
+        '''
+        没有注册 hook 时返回 None, 否则创建上下文并调用 before
+        '''
+        if not global_hooks.hooks and not self.hooks.hooks:
+            return None
+        return HookContext(global_hooks.hooks + self.hooks.hooks, self, kind, statement_type, sql=sql, params=params).before()
+
+    def __checkout(self, pool):
+        '''
+        从连接池借出连接, 调用 checkout hook
+        '''
+        context = self.__before_hooks(CHECKOUT, 'checkout')
+        if context is None:
+            return pool.get_connection()
+        try:
+            conn = pool.get_connection()
+        except Exception as e:
+            context.finish(error=e)
+            raise
+        context.set_connection(conn)
+        context.finish()
+        return conn
+
+    def __transaction_hook(self, statement_type, action):
+        context = self.__before_hooks(TRANSACTION, statement_type)
+        if context is None:
+            return action()
+        if self.__has_connection():
+            context.set_connection(self.__local_conn.conn)
+        try:
+            result = action()
+        except Exception as e:
+            context.finish(error=e)
+            raise
+        context.finish()
+        return result
+
+    def sql_report(self, n=10, order_by='total'):
+        '''
+        按 order_by(total/count/avg/p95/max/rows/errors) 排序的前 n 个 sql 指纹统计报告
+        '''
+        if self.query_stats is None:
+            return ''
+        return self.query_stats.report(n, order_by)
+
+    def __count_error(self, e):
+        self.metrics.inc('executor_errors', labels={'key': e.code})
+
     def set_database(self, database):
         self.__pool.set_config(**{'database': database})
 
@@ -38,71 +275,423 @@ class Executor(object):
     def __has_transaction(self):
         return hasattr(self.__local_conn, 'use_transaction') and self.__local_conn.use_transaction
 
-    def __get_connection(self):
+    def in_transaction(self):
+        return self.__has_transaction()
+
+    def pool_max_size(self):
+        '''
+        主库连接池的最大连接数
+        '''
+        return self.__pool.max_size()
+
+    def __in_session(self):
+        return getattr(self.__local_conn, 'session_depth', 0) > 0
+
+    def in_session(self):
+        return self.__in_session()
+
+    def session(self):
+        '''
+        会话上下文管理器, 会话内当前线程的所有语句(包括事务)使用同一个主库连接, 会话结束时归还连接池
+        第一条语句执行时才借出连接; 可以嵌套, 最外层结束时归还; 连接断开或超时被中断时丢弃, 下一条语句重新借出
+        事务外的流式查询(select_stream/select_columnar)遍历期间占用连接, 仍然使用单独的连接
+
+        with executor.session():
+            executor.select(...)
+            executor.select(...)
+        '''
+        return Session(self)
+
+    def open_session(self):
+        '''
+        开始会话, 每次 open_session 都要对应一次 close_session, 例如 web 请求开始和结束时
+        '''
+        self.__local_conn.session_depth = getattr(self.__local_conn, 'session_depth', 0) + 1
+
+    def close_session(self):
+        depth = getattr(self.__local_conn, 'session_depth', 0)
+        if depth <= 0:
+            return
+        self.__local_conn.session_depth = depth - 1
+        # 事务还没有结束时由 close_transaction 归还
+        if depth == 1 and self.__has_connection() and not self.__has_transaction():
+            if getattr(self.__local_conn, 'broken', False):
+                self.__local_conn.conn.discard()
+            else:
+                self.__local_conn.conn.close()
+            self.__local_conn.conn = None
+            self.__local_conn.broken = False
+
+    def __in_write_window(self):
+        last_write_at = getattr(self.__local_conn, 'last_write_at', None)
+        return last_write_at is not None and time.time() - last_write_at < self.__read_your_writes
+
+    def __mark_write(self):
+        if self.__read_your_writes > 0:
+            self.__local_conn.last_write_at = time.time()
+
+    def __choose_replica(self):
+        if self.__replica_balance == 'least_in_use':
+            return min(self.__replica_pools, key=lambda pool: pool.in_use_count())
+        return self.__replica_pools[next(self.__replica_counter) % len(self.__replica_pools)]
+
+    def __get_read_connection(self):
         '''
-        获取一个连接
+        从库连接, 从库不可用时退回主库
         '''
+        pool = self.__choose_replica()
+        try:
+            return self.__checkout(pool)
+        except Exception as e:
+            logger.warning('Replica connection error, fallback to primary: {}'.format(e))
+            self.metrics.inc('executor_replica_fallbacks')
+            return self.__checkout(self.__pool)
+
+    def __get_connection(self, read_only=False):
+        '''
+        获取一个连接, read_only 且不在事务和写后读窗口内时使用从库
+        '''
+        if not _AT_FORK and self.__pid != os.getpid():
+            self._reset_after_fork()
+
         if self.__has_connection():
             conn = self.__local_conn.conn
         else:
-            conn = self.__pool.get_connection()
+            if read_only and self.__replica_pools and not self.__has_transaction() and not self.__in_session() and not self.__in_write_window():
+                conn = self.__get_read_connection()
+            else:
+                conn = self.__checkout(self.__pool)
             self.__local_conn.conn = conn
+        return conn
 
-        if not conn.is_connected():
-            raise DBError(key=DBErrorType.NOT_CONNECT_ERROR, message='Connection is not connect.')
+    def __commit_connection(self, sql, entity_keys=None):
+        '''
+        提交当前连接, 并失效 sql 涉及的表的查询缓存和实体缓存
+        '''
+        self.__mark_write()
+        if self.__has_connection() and not self.__has_transaction():
+            self.__local_conn.conn.commit()
+        self.__invalidate(sql, entity_keys)
 
+    def __invalidate(self, sql, entity_keys=None):
+        '''
+        写操作后失效涉及的表的查询缓存, 识别不出表时失效全部; 事务内记录下来, 提交后再失效一次
+        entity_keys 为该语句影响的主键, 为空时失效涉及的表的全部实体缓存
+        '''
+        tables = statement_tables(sql)
+        self.query_cache.invalidate(tables)
+        self.__evict_entities(tables, entity_keys)
         if self.__has_transaction():
-            conn.autocommit = False
+            dirty_tables = getattr(self.__local_conn, 'dirty_tables', None)
+            if dirty_tables is None:
+                dirty_tables = self.__local_conn.dirty_tables = []
+            dirty_tables.append((tables, entity_keys))
+
+    def __invalidate_transaction(self):
+        dirty_tables = getattr(self.__local_conn, 'dirty_tables', None)
+        self.__local_conn.dirty_tables = None
+        if dirty_tables:
+            all_tables = set()
+            for tables, entity_keys in dirty_tables:
+                all_tables.update(tables or [None])
+                self.__evict_entities(tables, entity_keys)
+            self.query_cache.invalidate(None if None in all_tables else list(all_tables))
+
+    def entity_version(self, table):
+        '''
+        表的实体版本号, 每次写入该表都会增加
+        '''
+        return self.__entity_versions.get(normalize_table(table), 0)
+
+    def __evict_entities(self, tables, entity_keys=None):
+        # tables 来自 statement_tables, 已经是 normalize_table 之后的表名
+        if self.entity_cache is None:
+            return
+        with self.__entity_lock:
+            for table in tables:
+                self.__entity_versions[table] = self.__entity_versions.get(table, 0) + 1
+        if not tables:
+            self.entity_cache.clear()
+        elif entity_keys is None:
+            for table in tables:
+                self.entity_cache.evict_table(table)
         else:
-            conn.autocommit = True
+            for primary_value in entity_keys:
+                self.entity_cache.evict(tables[0], Executor.__entity_key(primary_value))
 
-        logger.debug('Connection autocommit: {}'.format(conn.autocommit))
-        return conn
+    @staticmethod
+    def __entity_key(primary_value):
+        # 主键统一为字符串, 参数 '1' 和数据库返回的 1 是同一个实体
+        return str(primary_value)
 
-    def __commit_connection(self):
+    def __use_entity_cache(self, primary_value):
+        return self.entity_cache is not None and primary_value is not None and not self.__has_transaction() and not self.__in_write_window()
+
+    def get_entity(self, table, primary_value, load):
         '''
-        关闭当前连接
+        按 (表, 主键) 读取实体属性, 未命中时调用 load() 加载并放入实体缓存
+        没有实体缓存、事务内、写后读窗口内直接调用 load()
         '''
-        if self.__has_connection() and not self.__has_transaction():
-            self.__local_conn.conn.commit()
+        if not self.__use_entity_cache(primary_value):
+            return load()
+
+        table = normalize_table(table)
+        attrs = self.entity_cache.get(table, Executor.__entity_key(primary_value))
+        if attrs is not None:
+            self.metrics.inc('executor_entity_cache_hits')
+            return dict(attrs)
+        self.metrics.inc('executor_entity_cache_misses')
+
+        version = self.entity_version(table)
+        attrs = load()
+        if attrs:
+            self.refresh_entity(table, primary_value, attrs, version)
+        return attrs
+
+    def peek_entity(self, table, primary_value):
+        '''
+        返回缓存中的实体属性副本, 不加载
+        '''
+        if not self.__use_entity_cache(primary_value):
+            return None
+        attrs = self.entity_cache.get(normalize_table(table), Executor.__entity_key(primary_value))
+        return None if attrs is None else dict(attrs)
+
+    def refresh_entity(self, table, primary_value, attrs, version):
+        '''
+        表的版本号仍为 version(期间没有其他写入)时更新实体缓存
+        '''
+        if not self.__use_entity_cache(primary_value):
+            return False
+        table = normalize_table(table)
+        with self.__entity_lock:
+            if self.entity_version(table) != version:
+                return False
+            self.entity_cache.put(table, Executor.__entity_key(primary_value), dict(attrs))
+        return True
 
     def __close_connection(self):
         '''
-        关闭当前连接
+        关闭当前连接, 连接已断开或者可能还有未生效的 KILL QUERY 时从连接池丢弃
         '''
-        if self.__has_connection() and not self.__has_transaction():
-            self.__local_conn.conn.close()
+        late_kill = self.__disarm()
+        if self.__has_transaction():
+            return
+        broken = getattr(self.__local_conn, 'broken', False)
+        self.__local_conn.broken = False
+        if self.__has_connection():
+            if late_kill or broken:
+                self.__local_conn.conn.discard()
+            elif self.__in_session():
+                # 会话内保留连接, 会话结束时归还
+                return
+            else:
+                self.__local_conn.conn.close()
             self.__local_conn.conn = None
             self.__local_conn.use_transaction = False
 
+    def __timeout(self, timeout):
+        return self.statement_timeout if timeout is None else timeout
+
+    def __arm(self, conn, sql, timeout):
+        '''
+        按超时时间处理 sql: SELECT 加上 MAX_EXECUTION_TIME 提示, 其他语句由看门狗超时后 KILL QUERY
+        '''
+        self.__local_conn.timeout = timeout
+        self.__local_conn.interrupted = False
+        if self.select_timeout_hint and statement_type(sql) == 'SELECT':
+            return add_hint(sql, self.select_timeout_hint.format(max(int(timeout * 1000), 1)))
+        self.__local_conn.watch = self.__watchdog.watch(timeout, lambda: self.__kill(conn))
+        return sql
+
+    def __disarm(self):
+        '''
+        取消看门狗, 返回是否需要丢弃连接: 已经超时但语句没有被中断时, KILL QUERY 可能落到该连接的下一条语句上
+        '''
+        watch = getattr(self.__local_conn, 'watch', None)
+        if watch is None:
+            return False
+        self.__local_conn.watch = None
+        return self.__watchdog.cancel(watch) and not self.__local_conn.interrupted
+
+    def __kill(self, conn):
+        '''
+        看门狗回调, 在另一个连接上中断 conn 正在执行的语句, 驱动不支持连接 id 时调用驱动的 cancel
+        '''
+        self.metrics.inc('executor_killed_queries')
+        connection_id = conn.connection_id()
+        if connection_id is None:
+            conn.cancel()
+            return
+        killer = conn.pool.open_connection()
+        try:
+            cursor = killer.cursor()
+            try:
+                cursor.execute(self.kill_query_sql.format(int(connection_id)))
+            finally:
+                cursor.close()
+        finally:
+            killer.close()
+        logger.warning('Statement timeout, killed query on connection: {}'.format(connection_id))
+
+    def __error(self, e, sql, params):
+        '''
+        转换为 DBError, 超时转换为 TIMEOUT_ERROR; 连接断开时标记连接, 关闭时从连接池丢弃
+        '''
+        error = e if isinstance(e, DBError) else DBError(e, sql=sql, params=params)
+        watch = getattr(self.__local_conn, 'watch', None)
+        if (watch is not None and watch.fired) or error.code in self.timeout_error_codes:
+            self.__local_conn.interrupted = True
+            return DBError(e, key=DBErrorType.TIMEOUT_ERROR, message='Statement timeout after {}s'.format(getattr(self.__local_conn, 'timeout', None)),
+                           sql=sql, params=params)
+        if error.code in self.transient_error_codes:
+            self.__local_conn.broken = True
+        return error
+
+    def __retry(self, statement_type, idempotent, action):
+        '''
+        事务外遇到连接断开等临时错误时在新连接上重试(断开的连接已经丢弃), 指数退避加随机抖动
+        只读语句总是可以重试, 写语句只在确定没有发送到服务端(获取连接时失败)时重试
+        '''
+        attempt = 0
+        while True:
+            try:
+                return action()
+            except DBError as e:
+                if attempt >= self.__max_retries or self.__has_transaction() or e.code not in self.transient_error_codes:
+                    raise
+                if not idempotent and getattr(self.__local_conn, 'sent', True):
+                    raise
+                attempt += 1
+                backoff = backoff_delay(attempt, self.__retry_backoff, self.__retry_max_backoff)
+                self.metrics.inc('executor_retries', labels={'type': statement_type})
+                logger.warning('Transient db error, retry {} after {:.0f}ms: {}'.format(attempt, backoff * 1000, e.message))
+                time.sleep(backoff)
+
+    def transaction(self):
+        '''
+        事务上下文管理器, 正常退出时提交, 异常时回滚并继续抛出异常
+        已经在事务中时为嵌套事务, 使用保存点, 异常只回滚到保存点, 外层捕获异常后可以继续执行或重试
+
+        with executor.transaction():
+            executor.insert(...)
+            try:
+                with executor.transaction():
+                    executor.update(...)
+            except DBError:
+                pass  # 只回滚了内层的 update
+        '''
+        return Transaction(self)
+
+    def transaction_depth(self):
+        '''
+        当前线程的事务嵌套层数, 0 表示不在事务中
+        '''
+        return len(getattr(self.__local_conn, 'savepoints', None) or ())
+
+    def __current_savepoint(self):
+        savepoints = getattr(self.__local_conn, 'savepoints', None)
+        return savepoints[-1] if savepoints else None
+
     def begin_transaction(self):
+        '''
+        开启事务, 已经在事务中时创建保存点; 每次 begin_transaction 都要对应一次 close_transaction
+        '''
+        if self.__has_transaction():
+            savepoints = self.__local_conn.savepoints
+            name = 'pesto_sp_{}'.format(len(savepoints))
+            # 先入栈, 创建保存点失败时 close_transaction 仍然按层出栈
+            savepoints.append(name)
+            self.__transaction_hook('savepoint', lambda: self.__savepoint(self.savepoint_sql, name))
+        else:
+            self.__local_conn.savepoints = [None]
+            self.__transaction_hook('begin', self.__begin_transaction)
+
+    def __begin_transaction(self):
         self.__local_conn.use_transaction = True
-        self.__local_conn.conn.begin()
+        self.__get_connection().begin()
+
+    def __savepoint(self, sql, name):
+        sql = sql.format(name)
+        if self.__show_sql:
+            self.show_sql(sql=sql)
+        cursor = None
+        try:
+            cursor = self.__local_conn.conn.cursor()
+            cursor.execute(sql)
+        except Exception as e:
+            error = self.__error(e, sql=sql, params=None)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
+        finally:
+            if cursor:
+                cursor.close()
 
     def commit_transaction(self):
+        '''
+        提交事务, 嵌套事务只释放保存点, 由最外层提交
+        '''
+        name = self.__current_savepoint()
+        if name is not None:
+            self.__transaction_hook('release', lambda: self.__savepoint(self.release_savepoint_sql, name))
+        else:
+            self.__transaction_hook('commit', self.__commit_transaction)
+
+    def __commit_transaction(self):
         if self.__has_connection():
             self.__local_conn.conn.commit()
+        self.__invalidate_transaction()
 
     def rollback_transaction(self):
+        '''
+        回滚事务, 嵌套事务只回滚到保存点
+        '''
+        name = self.__current_savepoint()
+        if name is not None:
+            self.__transaction_hook('rollback_to_savepoint', lambda: self.__savepoint(self.rollback_savepoint_sql, name))
+        else:
+            self.__transaction_hook('rollback', self.__rollback_transaction)
+
+    def __rollback_transaction(self):
         if self.__has_connection():
             self.__local_conn.conn.rollback()
+        self.__local_conn.dirty_tables = None
 
     def close_transaction(self):
+        '''
+        结束一层事务, 嵌套事务不关闭连接, 最外层归还连接
+        '''
+        savepoints = getattr(self.__local_conn, 'savepoints', None)
+        if savepoints and savepoints.pop() is not None:
+            return
+        self.__local_conn.savepoints = None
         if self.__has_connection():
-            self.__local_conn.conn.close()
-            self.__local_conn.conn = None
-            self.__local_conn.use_transaction = False
+            if getattr(self.__local_conn, 'broken', False):
+                self.__local_conn.conn.discard()
+                self.__local_conn.conn = None
+            elif not self.__in_session():
+                self.__local_conn.conn.close()
+                self.__local_conn.conn = None
+        self.__local_conn.use_transaction = False
+        self.__local_conn.broken = False
 
-    def __execute(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE):
+    def __execute(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE, read_only=False, context=None, timeout=None):
         '''
         通用sql执行工具
         '''
         if self.__show_sql:
             self.show_sql(sql=sql, params=params)
 
-        conn = self.__get_connection()
-        cursor = conn.cursor()
+        self.__local_conn.sent = False
+        conn = self.__get_connection(read_only=read_only)
+        if context is not None:
+            context.set_connection(conn)
+        cursor = conn.cursor(**self.__cursor_args(cursor_mode))
 
+        timeout = self.__timeout(timeout)
+        if timeout:
+            sql = self.__arm(conn, sql, timeout)
+        self.__local_conn.sent = True
         if execute_mode == ExecuteMode.ONE_MODE:
             cursor.execute(sql, params)
         else:
@@ -110,180 +699,486 @@ class Executor(object):
 
         return {'conn': conn, 'cursor': cursor}
 
-    def execute(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE):
-        if sql.upper().startswith('INSERT') | sql.upper().startswith('SELECT') | sql.upper().startswith('UPDATE') | sql.upper().startswith('DELETE'):
-            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+    def execute(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE, timeout=None):
+        '''
+        :param timeout: 语句超时(秒), 为空时使用执行器的 statement_timeout
+        '''
+        check_statement(sql, ('INSERT', 'SELECT', 'UPDATE', 'DELETE'))
+        return self.__retry('execute', False, lambda: self.__do_execute(sql, params, execute_mode, cursor_mode, timeout))
+
+    def load_data(self, path, table, columns, timeout=None):
+        '''
+        LOAD DATA LOCAL INFILE 导入本地文件, 返回导入的行数; 客户端需要 allow_local_infile, 服务端需要 local_infile=ON
+        columns 可能来自 csv 的第一行, 用反引号引用后拼接
+        '''
+        sql = self.load_data_sql.format(table, ', '.join(quote_identifier(column) for column in columns))
+        return self.__retry('execute', False, lambda: self.__do_execute(sql, (path,), ExecuteMode.ONE_MODE, CursorMode.CURSOR_MODE, timeout, rowcount=True))
 
+    def __do_execute(self, sql, params, execute_mode, cursor_mode, timeout, rowcount=False):
+        start = time.time()
         conn = None
         cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, 'execute', sql, params)
         try:
-            execute_result = self.__execute(sql=sql, params=params, execute_mode=execute_mode, cursor_mode=cursor_mode)
+            execute_result = self.__execute(sql=sql, params=params, execute_mode=execute_mode, cursor_mode=cursor_mode, context=context, timeout=timeout)
             conn = execute_result['conn']
             cursor = execute_result['cursor']
 
-            self.__commit_connection()
-            return True
+            self.__commit_connection(sql)
+            rows = cursor.rowcount
+            return rows if rowcount else True
         except DBError as e:
+            self.__count_error(e)
             raise e
         except Exception as e:
-            reraise(DBError(e, sql=sql, params=params), sys.exc_info()[2])
+            error = self.__error(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
         finally:
             if cursor:
                 cursor.close()
-            if conn:
-                self.__close_connection()
+            self.__close_connection()
+            self.__observe('execute', start, sql, params, rows, context=context)
+
+    def insert(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE, timeout=None):
+        '''
+        :param timeout: 语句超时(秒), 为空时使用执行器的 statement_timeout
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'SELECT', 'UPDATE', 'DELETE'))
+        return self.__retry('insert', False, lambda: self.__insert(sql, params, execute_mode, cursor_mode, timeout))
+
+    def insert_many(self, sql, params, chunk_size=1000, parallel=False, max_workers=4, timeout=None):
+        '''
+        批量 insert, 单行的 INSERT ... VALUES (...) 改写为多行 VALUES (...), (...), 按 chunk_size 行和 max_allowed_packet 切分为多条语句
+        串行执行时所有批次在一个事务中(已经在事务中时为嵌套事务); parallel 时各批次在不同的连接上并行执行并各自提交, 部分批次失败时其他批次不回滚(事务内串行)
+        不能改写的语句(INSERT ... SELECT、命名参数、VALUES 中有字符串常量)按批次 executemany
+        :return: 每个批次的 {'rows': 参数行数, 'rowcount': 影响行数, 'first_id': 该批次第一行的自增 id(mysql 多行 insert 的 lastrowid), executemany 时为 None}
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'SELECT', 'UPDATE', 'DELETE'))
+        params = list(params or [])
+        if not params:
+            return []
+
+        parts = split_insert_values(sql)
+        if parts is None:
+            base_size = len(sql) + PACKET_RESERVED_SIZE
+        else:
+            base_size = len(parts[0]) + len(parts[2]) + PACKET_RESERVED_SIZE
+        chunks = list(chunk_values(params, max_rows=chunk_size, max_bytes=self.max_allowed_packet, base_size=base_size, size_of=estimate_size))
+        self.metrics.inc('executor_insert_chunks', len(chunks))
 
-    def insert(self, sql, params=None, execute_mode=ExecuteMode.ONE_MODE, cursor_mode=CursorMode.CURSOR_MODE):
+        def load(chunk):
+            if parts is None:
+                chunk_sql, chunk_params, execute_mode = sql, chunk, ExecuteMode.MANY_MODE
+            else:
+                chunk_sql, chunk_params, execute_mode = multi_row_sql(parts, len(chunk)), tuple(itertools.chain.from_iterable(chunk)), ExecuteMode.ONE_MODE
+            result = self.__retry('insert', False, lambda: self.__insert(chunk_sql, chunk_params, execute_mode, CursorMode.CURSOR_MODE, timeout, chunk=True))
+            result['rows'] = len(chunk)
+            return result
 
-        if sql.upper().startswith('DROP') | sql.upper().startswith('CREATE') | sql.upper().startswith('SELECT') | sql.upper().startswith('UPDATE') | sql.upper().startswith(
-                'DELETE'):
-            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+        if len(chunks) == 1:
+            return [load(chunks[0])]
+        if parallel and not self.__has_transaction():
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)), thread_name_prefix='pesto-insert-many') as pool:
+                return list(pool.map(load, chunks))
+        with self.transaction():
+            return [load(chunk) for chunk in chunks]
 
+    def __insert(self, sql, params, execute_mode, cursor_mode, timeout, chunk=False):
+        start = time.time()
         conn = None
         cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, 'insert', sql, params)
         try:
-            insert_result = self.__execute(sql=sql, params=params, execute_mode=execute_mode, cursor_mode=cursor_mode)
+            insert_result = self.__execute(sql=sql, params=params, execute_mode=execute_mode, cursor_mode=cursor_mode, context=context, timeout=timeout)
             conn = insert_result['conn']
             cursor = insert_result['cursor']
             rowcount = cursor.rowcount
 
-            if execute_mode == ExecuteMode.ONE_MODE:
+            if chunk:
+                result = {'rowcount': rowcount, 'first_id': cursor.lastrowid if execute_mode == ExecuteMode.ONE_MODE else None}
+            elif execute_mode == ExecuteMode.ONE_MODE:
                 result = cursor.lastrowid
             else:
                 result = rowcount
 
-            self.__commit_connection()
+            # 普通 insert 不会修改已缓存的实体, replace 和 on duplicate key update 需要失效
+            upsert = statement_type(sql) == 'REPLACE' or _upsert_pattern.search(sql) is not None
+            self.__commit_connection(sql, entity_keys=None if upsert else ())
+            rows = rowcount
             return result
         except DBError as e:
+            self.__count_error(e)
             raise e
         except Exception as e:
-            reraise(DBError(e, sql=sql, params=params), sys.exc_info()[2])
+            error = self.__error(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
         finally:
             if cursor:
                 cursor.close()
-            if conn:
-                self.__close_connection()
+            self.__close_connection()
+            self.__observe('insert', start, sql, params, rows, context=context)
+
+    @staticmethod
+    def __copy_result(result):
+        '''
+        缓存中的结果复制后返回, 避免调用方修改缓存中的 dict
+        '''
+        if isinstance(result, list):
+            return [dict(row) if isinstance(row, dict) else row for row in result]
+        if isinstance(result, dict):
+            return dict(result)
+        return result
+
+    def __cached(self, statement_type, sql, params, cursor_mode, cache_ttl, coalesce, load):
+        '''
+        cache_ttl 不为空时使用查询缓存; coalesce 为 True 或使用查询缓存时, 并发执行同一个 (sql, params) 只查询一次, 其他调用等待并获得结果的副本
+        事务内和写后读窗口内两者都不使用
+        '''
+        if not (cache_ttl or coalesce) or self.__has_transaction() or self.__in_write_window():
+            return load()
+        key = make_key(sql, params, statement_type, cursor_mode)
+        if key is None:
+            return load()
+
+        if cache_ttl:
+            entry = self.query_cache.get(key)
+            if entry is not None:
+                self.metrics.inc('executor_query_cache_hits')
+                return self.__copy_result(entry[0])
+            self.metrics.inc('executor_query_cache_misses')
+
+            tables = statement_tables(sql)
 
-    def select_first(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+            def leader_load():
+                # 先记录表版本, 查询期间表被写入则不放入缓存
+                versions = self.query_cache.versions(tables)
+                result = load()
+                self.query_cache.put_result(key, result, tables, versions, ttl=cache_ttl)
+                return result
+        else:
+            leader_load = load
+
+        result, shared = self.__single_flight.do(key, leader_load)
+        if shared:
+            self.metrics.inc('executor_coalesced', labels={'type': statement_type})
+        else:
+            self.metrics.inc('executor_coalesce_leaders', labels={'type': statement_type})
+        # 结果放入了缓存或者被其他调用共享时返回副本, 避免调用方修改相互影响
+        return self.__copy_result(result) if cache_ttl or shared else result
 
-        if sql.upper().startswith('DROP') | sql.upper().startswith('CREATE') | sql.upper().startswith('INSERT') | sql.upper().startswith('UPDATE') | sql.upper().startswith(
-                'DELETE'):
-            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+    def select_first(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE, cache_ttl=None, coalesce=False, timeout=None):
+        '''
+        :param cache_ttl: 结果缓存时间(秒), 为空时不使用查询缓存
+        :param coalesce: 为 True 时合并并发的相同查询, 同一时刻相同 (sql, params) 只执行一次
+        :param timeout: 语句超时(秒), 为空时使用执行器的 statement_timeout
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE'))
+        return self.__cached('select_first', sql, params, cursor_mode, cache_ttl, coalesce,
+                             lambda: self.__retry('select', True, lambda: self.__select_first(sql, params, cursor_mode, timeout)))
 
+    def __select_first(self, sql, params, cursor_mode, timeout):
+        start = time.time()
         conn = None
         cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, 'select', sql, params)
         try:
-            select_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode)
+            select_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode, read_only=True, context=context, timeout=timeout)
             conn = select_result['conn']
             cursor = select_result['cursor']
 
-            result = {}
-            column_values = cursor.fetchone()
-            if column_values is not None and len(column_values) > 0:
-                column_names = [i[0] for i in cursor.description]
-                for i, value in enumerate(column_values):
-                    result[column_names[i]] = value
-
-            return result
+            column_names = tuple(i[0] for i in cursor.description)
+            row = cursor.fetchone()
+            rows = 0 if row is None or len(row) == 0 else 1
+            return convert_row(cursor_mode, column_names, row)
         except DBError as e:
+            self.__count_error(e)
             raise e
         except Exception as e:
-            reraise(DBError(e, sql=sql, params=params), sys.exc_info()[2])
+            error = self.__error(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
         finally:
             if cursor:
                 cursor.close()
-            if conn:
-                self.__close_connection()
+            self.__close_connection()
+            self.__observe('select', start, sql, params, rows, context=context)
 
-    def select(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
-
-        if sql.upper().startswith('DROP') | sql.upper().startswith('CREATE') | sql.upper().startswith('INSERT') | sql.upper().startswith('UPDATE') | sql.upper().startswith(
-                'DELETE'):
-            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+    def select(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE, cache_ttl=None, coalesce=False, timeout=None):
+        '''
+        :param cache_ttl: 结果缓存时间(秒), 为空时不使用查询缓存
+        :param coalesce: 为 True 时合并并发的相同查询, 同一时刻相同 (sql, params) 只执行一次
+        :param timeout: 语句超时(秒), 为空时使用执行器的 statement_timeout
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE'))
+        return self.__cached('select', sql, params, cursor_mode, cache_ttl, coalesce,
+                             lambda: self.__retry('select', True, lambda: self.__select(sql, params, cursor_mode, timeout)))
 
+    def __select(self, sql, params, cursor_mode, timeout):
+        start = time.time()
         conn = None
         cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, 'select', sql, params)
         try:
-            select_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode)
+            select_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode, read_only=True, context=context, timeout=timeout)
             conn = select_result['conn']
             cursor = select_result['cursor']
 
-            result = []
-            column_values = cursor.fetchall()
-            if column_values is not None and len(column_values) > 0:
-                column_names = [i[0] for i in cursor.description]
-
-                for i, row in enumerate(column_values):
-                    tmp = {}
-                    for j, value in enumerate(row):
-                        tmp[column_names[j]] = value
-                    result.append(tmp)
+            column_names = tuple(i[0] for i in cursor.description)
+            result = convert_rows(cursor_mode, column_names, cursor.fetchall())
+            rows = len(result)
             return result
 
         except DBError as e:
+            self.__count_error(e)
             raise e
         except Exception as e:
-            reraise(DBError(e, sql=sql, params=params), sys.exc_info()[2])
+            error = self.__error(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
         finally:
             if cursor:
                 cursor.close()
-            if conn:
-                self.__close_connection()
+            self.__close_connection()
+            self.__observe('select', start, sql, params, rows, context=context)
 
-    def update(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+    def select_stream(self, sql, params=None, batch_size=1000, cursor_mode=CursorMode.CURSOR_MODE):
+        '''
+        流式查询, 使用非缓冲游标每次 fetchmany(batch_size), 返回逐行产出 dict 的生成器
+        事务外独占一个连接直到生成器耗尽或关闭, 提前关闭时丢弃该连接(未读完的结果集无法复用);
+        事务内使用事务连接, 提前关闭时读完剩余结果, 遍历期间不要在同一事务中执行其他语句
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE'))
 
-        if sql.upper().startswith('DROP') | sql.upper().startswith('CREATE') | sql.upper().startswith('INSERT') | sql.upper().startswith('SELECT') | sql.upper().startswith(
-                'DELETE'):
-            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+        return self.__stream(sql=sql, params=params, batch_size=max(int(batch_size), 1), cursor_mode=cursor_mode)
 
+    def __get_stream_connection(self):
+        if self.__has_transaction():
+            return self.__get_connection()
+        if not _AT_FORK and self.__pid != os.getpid():
+            self._reset_after_fork()
+        if self.__replica_pools and not self.__in_write_window():
+            return self.__get_read_connection()
+        return self.__checkout(self.__pool)
+
+    def __stream(self, sql, params, batch_size, cursor_mode):
+        batches = self.__stream_batches(sql=sql, params=params, batch_size=batch_size, cursor_mode=cursor_mode, statement_type='stream')
+        try:
+            column_names = None
+            for description, rows in batches:
+                if column_names is None:
+                    column_names = tuple(i[0] for i in description)
+                for row in convert_rows(cursor_mode, column_names, rows):
+                    yield row
+        finally:
+            batches.close()
+
+    def __stream_batches(self, sql, params, batch_size, cursor_mode, statement_type):
+        '''
+        非缓冲游标分批读取, 产出 (cursor.description, rows), 没有数据时也会产出一次空批次
+        '''
+        start = time.time()
+        in_transaction = self.__has_transaction()
         conn = None
         cursor = None
+        finished = False
+        failed = False
+        rows_count = 0
+        context = self.__before_hooks(STATEMENT, statement_type, sql, params)
         try:
-            update_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode)
+            if self.__show_sql:
+                self.show_sql(sql=sql, params=params)
+
+            conn = self.__get_stream_connection()
+            if context is not None:
+                context.set_connection(conn)
+            cursor = conn.cursor(**self.__cursor_args(cursor_mode, ResultMode.USE_RESULT_MODE))
+            cursor.execute(sql, params)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    if rows_count == 0:
+                        yield cursor.description, []
+                    break
+                rows_count += len(rows)
+                yield cursor.description, rows
+            finished = True
+        except DBError as e:
+            failed = True
+            self.__count_error(e)
+            raise e
+        except Exception as e:
+            failed = True
+            error = DBError(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
+        finally:
+            if cursor:
+                if not finished and in_transaction:
+                    # 事务连接还要继续使用, 读完剩余结果
+                    try:
+                        while cursor.fetchmany(batch_size):
+                            pass
+                    except Exception as e:
+                        logger.warning('Drain stream result error: {}'.format(e))
+                cursor.close()
+            if conn is not None and not in_transaction:
+                if finished:
+                    conn.close()
+                else:
+                    conn.discard()
+            self.metrics.inc('executor_stream_rows', rows_count)
+            self.__observe(statement_type, start, sql, params, rows_count, error=failed, context=context)
+
+    def select_columnar(self, sql, params=None, batch_size=10000, type_map=None):
+        '''
+        列式查询, 分批读取并按 cursor.description 的字段类型码转换为 numpy 数组, 返回 {列名: numpy.ma.MaskedArray}
+        NULL 通过掩码表示, type_map 为字段类型码到 dtype 的映射, 没有映射的列为 object 数组, 需要安装 numpy
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE'))
+        check_numpy()
+
+        builder = None
+        batches = self.__stream_batches(sql=sql, params=params, batch_size=max(int(batch_size), 1), cursor_mode=CursorMode.TUPLE_CURSOR_MODE,
+                                        statement_type='columnar')
+        try:
+            for description, rows in batches:
+                if builder is None:
+                    builder = ColumnarBuilder(description, type_map)
+                builder.append(rows)
+        finally:
+            batches.close()
+        return builder.build()
+
+    def update(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE, entity_keys=None, timeout=None):
+        '''
+        :param entity_keys: 该语句只影响这些主键时传入, 只失效这些实体缓存, 为空时失效整张表的实体缓存
+        :param timeout: 语句超时(秒), 为空时使用执行器的 statement_timeout
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'SELECT', 'DELETE'))
+        return self.__retry('update', False, lambda: self.__update(sql, params, cursor_mode, entity_keys, timeout))
+
+    def __update(self, sql, params, cursor_mode, entity_keys, timeout):
+        start = time.time()
+        conn = None
+        cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, 'update', sql, params)
+        try:
+            update_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode, context=context, timeout=timeout)
             conn = update_result['conn']
             cursor = update_result['cursor']
 
-            self.__commit_connection()
-            return cursor.rowcount
+            self.__commit_connection(sql, entity_keys=entity_keys)
+            rows = cursor.rowcount
+            return rows
         except DBError as e:
+            self.__count_error(e)
             raise e
         except Exception as e:
-            reraise(DBError(e, sql=sql, params=params), sys.exc_info()[2])
+            error = self.__error(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
         finally:
             if cursor:
                 cursor.close()
-            if conn:
-                self.__close_connection()
-
-    def delete(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE):
+            self.__close_connection()
+            self.__observe('update', start, sql, params, rows, context=context)
 
-        if sql.upper().startswith('DROP') | sql.upper().startswith('CREATE') | sql.upper().startswith('INSERT') | sql.upper().startswith('SELECT') | sql.upper().startswith(
-                'UPDATE'):
-            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+    def delete(self, sql, params=None, cursor_mode=CursorMode.CURSOR_MODE, entity_keys=None, timeout=None):
+        '''
+        :param entity_keys: 该语句只影响这些主键时传入, 只失效这些实体缓存, 为空时失效整张表的实体缓存
+        :param timeout: 语句超时(秒), 为空时使用执行器的 statement_timeout
+        '''
+        check_statement(sql, ('DROP', 'CREATE', 'INSERT', 'SELECT', 'UPDATE'))
+        return self.__retry('delete', False, lambda: self.__delete(sql, params, cursor_mode, entity_keys, timeout))
 
+    def __delete(self, sql, params, cursor_mode, entity_keys, timeout):
+        start = time.time()
         conn = None
         cursor = None
+        rows = None
+        context = self.__before_hooks(STATEMENT, 'delete', sql, params)
         try:
-            delete_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode)
+            delete_result = self.__execute(sql=sql, params=params, cursor_mode=cursor_mode, context=context, timeout=timeout)
             conn = delete_result['conn']
             cursor = delete_result['cursor']
 
-            self.__commit_connection()
-            return cursor.rowcount
+            self.__commit_connection(sql, entity_keys=entity_keys)
+            rows = cursor.rowcount
+            return rows
         except DBError as e:
+            self.__count_error(e)
             raise e
         except Exception as e:
-            reraise(DBError(e, sql=sql, params=params), sys.exc_info()[2])
+            error = self.__error(e, sql=sql, params=params)
+            self.__count_error(error)
+            reraise(error, sys.exc_info()[2])
         finally:
             if cursor:
                 cursor.close()
-            if conn:
-                self.__close_connection()
+            self.__close_connection()
+            self.__observe('delete', start, sql, params, rows, context=context)
 
     def close(self):
+        if self.query_stats is not None:
+            self.query_stats.stop_dump()
         self.__pool.close()
+        for pool in self.__replica_pools:
+            pool.close()
         self.__local_conn = None
         self.__pool = None
+        self.__replica_pools = []
+
+
+class Transaction(object):
+    '''
+    Executor.transaction() 返回的事务上下文管理器
+    '''
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    def __enter__(self):
+        try:
+            self.executor.begin_transaction()
+        except Exception:
+            self.executor.close_transaction()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.executor.commit_transaction()
+            else:
+                self.executor.rollback_transaction()
+        finally:
+            self.executor.close_transaction()
+        return False
+
+
+class Session(object):
+    '''
+    Executor.session() 返回的会话上下文管理器
+    '''
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    def __enter__(self):
+        self.executor.open_session()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.close_session()
+        return False
 
 
 class ExecutorFactory(object):
@@ -297,6 +1192,12 @@ class ExecutorFactory(object):
     def __init__(self):
         pass
 
+    @staticmethod
+    def _reset_after_fork():
+        ExecutorFactory.__lock = threading.Condition()
+        for executor in list(_executors):
+            executor._reset_after_fork()
+
     @staticmethod
     def __get_pool_key(db_config):
         if 'database' not in db_config:
@@ -312,6 +1213,9 @@ class ExecutorFactory(object):
         if key not in ExecutorFactory.__connection_pools:
             ExecutorFactory.__lock.acquire()
             try:
+                if key in ExecutorFactory.__connection_pools:
+                    return ExecutorFactory.__connection_pools[key]
+
                 _db_config = db_config.copy()
                 if 'password' in _db_config:
                     _db_config['password'] = '******'
@@ -321,9 +1225,44 @@ class ExecutorFactory(object):
                 del db_config['target']
                 show_sql = db_config['show_sql']
                 del db_config['show_sql']
+                replicas = db_config.pop('replicas', [])
+                replica_balance = db_config.pop('replica_balance', 'round_robin')
+                read_your_writes = db_config.pop('read_your_writes', 0)
+                query_cache_size = db_config.pop('query_cache_size', 10000)
+                entity_cache_size = db_config.pop('entity_cache_size', 0)
+                entity_cache_ttl = db_config.pop('entity_cache_ttl', 0)
+                entity_cache = LocalEntityCache(max_size=entity_cache_size, ttl=entity_cache_ttl or None) if entity_cache_size > 0 else None
+                max_allowed_packet = db_config.pop('max_allowed_packet', DEFAULT_MAX_ALLOWED_PACKET)
+                statement_timeout = db_config.pop('statement_timeout', 0)
+                max_retries = db_config.pop('max_retries', 2)
+                retry_backoff = db_config.pop('retry_backoff', 0.05)
+                retry_max_backoff = db_config.pop('retry_max_backoff', 1.0)
+                query_stats_size = db_config.pop('query_stats_size', 1000)
+                slow_threshold_ms = db_config.pop('slow_threshold_ms', 0)
+                query_stats_interval = db_config.pop('query_stats_interval', 0)
+                query_stats_top = db_config.pop('query_stats_top', 10)
+                query_stats = None
+                if query_stats_size > 0:
+                    query_stats = QueryStats(max_fingerprints=query_stats_size, slow_threshold_ms=slow_threshold_ms)
+                    if query_stats_interval > 0:
+                        query_stats.start_dump(query_stats_interval, n=query_stats_top)
                 pool = ConnectionPool(target=target, **db_config)
 
-                ExecutorFactory.__connection_pools[key] = Executor(pool=pool, show_sql=show_sql)
+                replica_pools = []
+                for replica in replicas:
+                    replica_config = db_config.copy()
+                    host, _, port = replica.partition(':')
+                    replica_config['host'] = host
+                    if port:
+                        replica_config['port'] = port
+                    logger.info('Init db replica pool info - host: %s, port: %s' % (replica_config['host'], replica_config.get('port')))
+                    replica_pools.append(ConnectionPool(target=target, **replica_config))
+
+                ExecutorFactory.__connection_pools[key] = Executor(pool=pool, show_sql=show_sql, replica_pools=replica_pools, replica_balance=replica_balance,
+                                                                   read_your_writes=read_your_writes, query_cache_size=query_cache_size,
+                                                                   entity_cache=entity_cache, max_allowed_packet=max_allowed_packet, query_stats=query_stats,
+                                                                   statement_timeout=statement_timeout or None, max_retries=max_retries, retry_backoff=retry_backoff,
+                                                                   retry_max_backoff=retry_max_backoff)
                 ExecutorFactory.__lock.notifyAll()
             except Exception as e:
                 reraise(DBError(e), sys.exc_info()[2])
@@ -340,3 +1279,7 @@ class ExecutorFactory(object):
         except KeyError:
             pass
         return True
+
+
+if _AT_FORK:
+    os.register_at_fork(after_in_child=ExecutorFactory._reset_after_fork)
@@ -0,0 +1,140 @@
+'''
+执行器拦截器(hook), 用于链路追踪、自定义计时和采样, 不需要修改执行器的私有方法
+
+继承 ExecutorHook 并覆盖需要的方法, 通过 register_hook 注册为全局 hook(所有执行器), 或者 executor.hooks.add(hook) 只对一个执行器生效
+每次执行语句、从连接池借出连接、开始/提交/回滚事务时, 按注册顺序调用 before, 结束后按相反顺序调用 after 或 on_error
+没有注册 hook 时不创建 HookContext, 不产生额外开销; hook 抛出的异常只记录日志, 不影响执行
+
+class TraceHook(ExecutorHook):
+    def before(self, context):
+        context.data['span'] = tracer.start_span(context.statement_type)
+
+    def after(self, context):
+        context.data['span'].finish(tags={'sql': context.sql, 'rows': context.rowcount})
+
+    def on_error(self, context):
+        context.data['span'].finish(error=context.error)
+
+register_hook(TraceHook())
+'''
+import threading
+import time
+
+from pesto_common.log.logger_factory import LoggerFactory
+
+logger = LoggerFactory.get_logger('core.hooks')
+
+# HookContext.kind
+STATEMENT = 'statement'
+CHECKOUT = 'checkout'
+TRANSACTION = 'transaction'
+
+
+class ExecutorHook(object):
+    '''
+    拦截器基类, 所有方法默认不做任何事, 按需覆盖
+    '''
+
+    def before(self, context):
+        pass
+
+    def after(self, context):
+        pass
+
+    def on_error(self, context):
+        pass
+
+
+class HookContext(object):
+    '''
+    一次调用的上下文, before/after/on_error 收到的是同一个对象, hook 之间或 before 和 after 之间可以通过 data 传递数据
+
+    kind: statement(执行语句), checkout(借出连接), transaction(事务)
+    statement_type: 语句为 execute/insert/select/update/delete/stream/columnar, 借出连接为 checkout, 事务为 begin/commit/rollback,
+        嵌套事务为 savepoint/release/rollback_to_savepoint
+    connection_id: 服务端连接 id, 驱动不支持或还没有连接时为 None
+    elapsed: 耗时(秒), rowcount: 返回或影响的行数, error: 异常, 只在 after/on_error 中有值
+    '''
+    __slots__ = ('hooks', 'executor', 'kind', 'statement_type', 'sql', 'params', 'connection_id', 'start', 'elapsed', 'rowcount', 'error', 'data')
+
+    def __init__(self, hooks, executor, kind, statement_type, sql=None, params=None):
+        self.hooks = hooks
+        self.executor = executor
+        self.kind = kind
+        self.statement_type = statement_type
+        self.sql = sql
+        self.params = params
+        self.connection_id = None
+        self.start = time.time()
+        self.elapsed = None
+        self.rowcount = None
+        self.error = None
+        self.data = {}
+
+    def set_connection(self, conn):
+        try:
+            # 连接池的连接为 connection_id(), 异步驱动的原生连接为 thread_id()
+            connection_id = getattr(conn, 'connection_id', None) or getattr(conn, 'thread_id', None)
+            self.connection_id = connection_id() if callable(connection_id) else connection_id
+        except Exception:
+            self.connection_id = None
+
+    def before(self):
+        for hook in self.hooks:
+            try:
+                hook.before(self)
+            except Exception as e:
+                logger.warning('Hook {} before error: {}'.format(type(hook).__name__, e))
+        return self
+
+    def finish(self, rowcount=None, error=None):
+        self.elapsed = time.time() - self.start
+        self.rowcount = rowcount
+        self.error = error
+        for hook in reversed(self.hooks):
+            try:
+                if error is None:
+                    hook.after(self)
+                else:
+                    hook.on_error(self)
+            except Exception as e:
+                logger.warning('Hook {} {} error: {}'.format(type(hook).__name__, 'after' if error is None else 'on_error', e))
+
+
+class HookRegistry(object):
+    '''
+    hook 列表, 写时复制, 执行时无锁读取 hooks
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hooks = ()
+
+    def add(self, hook):
+        with self._lock:
+            self.hooks = self.hooks + (hook,)
+
+    def remove(self, hook):
+        with self._lock:
+            self.hooks = tuple(item for item in self.hooks if item is not hook)
+
+    def clear(self):
+        with self._lock:
+            self.hooks = ()
+
+    def __len__(self):
+        return len(self.hooks)
+
+
+global_hooks = HookRegistry()
+
+
+def register_hook(hook):
+    '''
+    注册全局 hook, 对所有执行器生效
+    '''
+    global_hooks.add(hook)
+
+
+def unregister_hook(hook):
+    global_hooks.remove(hook)
@@ -0,0 +1,186 @@
+'''
+连接池和执行器的监控指标, 支持快照(dict)和 Prometheus 文本格式导出
+'''
+import threading
+from collections import OrderedDict
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for i, bound in enumerate(self.buckets):
+            cumulative += self.counts[i]
+            buckets[bound] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'avg': self.sum / self.count if self.count else 0.0, 'max': self.max, 'buckets': buckets}
+
+
+class Metrics(object):
+    '''
+    计数器(counter), 直方图(histogram)和瞬时值(gauge, 读取时回调)
+    指标名不带前缀, 导出 Prometheus 时统一加上 prefix
+    '''
+
+    def __init__(self, prefix='pesto', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def __key(name, labels):
+        # 标签值统一为字符串(例如错误码可能是 int、枚举名或 None), 保证键可以排序
+        if labels:
+            return name, tuple(sorted((str(k), 'unknown' if v is None else str(v)) for k, v in labels.items()))
+        return name, ()
+
+    def inc(self, name, amount=1, labels=None):
+        key = Metrics.__key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        key = Metrics.__key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    def get_counter(self, name, labels=None):
+        return self._counters.get(Metrics.__key(name, labels), 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def _reset_after_fork(self):
+        '''
+        fork 后在子进程中清空计数, 父进程的其他线程可能正持有锁, 不能获取旧锁, 直接重建
+        '''
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def __label_name(key):
+        name, labels = key
+        if not labels:
+            return name
+        return '%s{%s}' % (name, ','.join('%s=%s' % (k, v) for k, v in labels))
+
+    def snapshot(self):
+        with self._lock:
+            counters = {Metrics.__label_name(key): value for key, value in self._counters.items()}
+            histograms = {Metrics.__label_name(key): histogram.snapshot() for key, histogram in self._histograms.items()}
+        gauges = {}
+        for name, func in self._gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        return {'gauges': gauges, 'counters': counters, 'histograms': histograms}
+
+    @staticmethod
+    def __format_labels(labels, extra=None):
+        items = list(labels)
+        if extra:
+            items.extend(extra)
+        if not items:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+
+    def to_prometheus(self, labels=None):
+        '''
+        导出 Prometheus text format(0.0.4), labels 为附加到所有指标上的标签
+        '''
+        return merge_prometheus([(self, labels)])
+
+    def families(self, labels=None):
+        '''
+        按指标族分组的样本 [(指标名, 类型, [样本行])], labels 为附加到所有样本上的标签
+        '''
+        const_labels = tuple(sorted(labels.items())) if labels else ()
+        families = []
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            metric = '%s_%s' % (self.prefix, name)
+            families.append((metric, 'gauge', ['%s%s %s' % (metric, Metrics.__format_labels(const_labels), value)]))
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, histogram.snapshot()) for key, histogram in self._histograms.items())
+
+        grouped = {}
+        for (name, label_items), value in counters:
+            metric = '%s_%s_total' % (self.prefix, name)
+            samples = grouped.get(metric)
+            if samples is None:
+                samples = grouped[metric] = []
+                families.append((metric, 'counter', samples))
+            samples.append('%s%s %s' % (metric, Metrics.__format_labels(const_labels + label_items), value))
+
+        for (name, label_items), snapshot in histograms:
+            metric = '%s_%s' % (self.prefix, name)
+            samples = grouped.get(metric)
+            if samples is None:
+                samples = grouped[metric] = []
+                families.append((metric, 'histogram', samples))
+            all_labels = const_labels + label_items
+            for bound, count in snapshot['buckets'].items():
+                samples.append('%s_bucket%s %s' % (metric, Metrics.__format_labels(all_labels, [('le', bound)]), count))
+            samples.append('%s_bucket%s %s' % (metric, Metrics.__format_labels(all_labels, [('le', '+Inf')]), snapshot['count']))
+            samples.append('%s_sum%s %s' % (metric, Metrics.__format_labels(all_labels), snapshot['sum']))
+            samples.append('%s_count%s %s' % (metric, Metrics.__format_labels(all_labels), snapshot['count']))
+
+        return families
+
+
+def merge_prometheus(sources):
+    '''
+    多个 Metrics 合并导出为一份 Prometheus text format, sources 为 [(metrics, labels)]
+    同名指标族的样本合并到一起, 每个指标族只输出一次 TYPE(重复的 TYPE 会导致整个抓取失败), 不同来源用 labels 区分
+    '''
+    families = OrderedDict()
+    for metrics, labels in sources:
+        for metric, metric_type, samples in metrics.families(labels):
+            family = families.get(metric)
+            if family is None:
+                families[metric] = (metric_type, list(samples))
+            else:
+                family[1].extend(samples)
+
+    lines = []
+    for metric, (metric_type, samples) in families.items():
+        lines.append('# TYPE %s %s' % (metric, metric_type))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
@@ -120,42 +120,74 @@ class BaseModel(Model):
     def get_executor(self):
         raise NotImplementedError
 
-    def save(self):
+    def build_save_sql(self):
         attrs = self.get_attrs()
         columns = [column for column in attrs.keys() if column != self.primary_key]
         params = [attrs[column] for column in columns]
         sql = self.get_dialect().insert(columns=columns, table=self.table_name, primary_key=self.primary_key, sequence=self.sequence)
-        primary_value = self.get_executor().insert(sql=sql, params=tuple(params))
+        return sql, tuple(params)
+
+    def save(self):
+        '''
+        保存后不放入实体缓存(可能缺少数据库默认值等列), 第一次 query 时加载
+        '''
+        sql, params = self.build_save_sql()
+        primary_value = self.get_executor().insert(sql=sql, params=params)
         self.set_attr(self.primary_key, primary_value)
         return primary_value
 
-    '''
-    根据主键更新单个对象
-    '''
-
-    def update(self):
+    def build_update_sql(self):
         attrs = self.get_attrs()
         columns = [column for column in attrs.keys() if column != self.primary_key]
         params = [attrs[column] for column in columns]
         params.append(attrs[self.primary_key])
         sql = self.get_dialect().update(columns=columns, table=self.table_name, alias=self.table_alias, where='`%s`= %s' % (self.primary_key, '%s'))
-        return self.get_executor().update(sql=sql, params=tuple(params))
+        return sql, tuple(params)
+
+    '''
+    根据主键更新单个对象
+    '''
+
+    def update(self):
+        sql, params = self.build_update_sql()
+        executor = self.get_executor()
+        primary_value = self.get_attr(self.primary_key)
+        if executor.entity_cache is None:
+            return executor.update(sql=sql, params=params, entity_keys=[primary_value])
+
+        # 已缓存的实体合并本次更新的属性, 期间有其他写入时只失效不更新
+        version = executor.entity_version(self.table_name)
+        cached = executor.peek_entity(self.table_name, primary_value)
+        rowcount = executor.update(sql=sql, params=params, entity_keys=[primary_value])
+        if cached is not None and rowcount:
+            cached.update(self.get_attrs())
+            executor.refresh_entity(self.table_name, primary_value, cached, version + 1)
+        return rowcount
+
+    def build_delete_sql(self):
+        sql = self.get_dialect().delete(table=self.table_name, where='`%s`= %s' % (self.primary_key, '%s'))
+        return sql, tuple([self.get_attr(self.primary_key)])
 
     '''
     根据主键删除单个对象
     '''
 
     def delete(self):
-        sql = self.get_dialect().delete(table=self.table_name, where='`%s`= %s' % (self.primary_key, '%s'))
-        return self.get_executor().delete(sql, tuple([self.get_attr(self.primary_key)]))
+        sql, params = self.build_delete_sql()
+        return self.get_executor().delete(sql, params, entity_keys=[self.get_attr(self.primary_key)])
 
-        '''
-        根据主键查询单个对象
-        '''
+    def build_query_sql(self):
+        sql = self.get_dialect().select(columns=['*'], table=self.table_name, alias=self.table_alias, where='`%s`= %s' % (self.primary_key, '%s'))
+        return sql, tuple([self.get_attr(self.primary_key)])
+
+    '''
+    根据主键查询单个对象
+    '''
 
     def query(self):
-        sql = self.get_dialect().select(columns=['*'], table=self.table_name, alias=self.table_alias, where='`%s`= %s' % (self.primary_key, '%s'))
-        result = self.get_executor().select_first(sql=sql, params=tuple([self.get_attr(self.primary_key)]))
+        sql, params = self.build_query_sql()
+        executor = self.get_executor()
+        result = executor.get_entity(self.table_name, self.get_attr(self.primary_key), lambda: executor.select_first(sql=sql, params=params))
 
         self.clear_attrs()
         self.set_attrs(result.copy())
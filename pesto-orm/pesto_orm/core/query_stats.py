@@ -0,0 +1,206 @@
+'''
+慢查询日志和按 sql 指纹聚合的执行统计
+
+指纹: 去掉注释, 字符串/数字字面量和占位符替换为 ?, IN (...) 和 VALUES (...), (...) 列表折叠为一个, 空白合并, 统一小写,
+同一类语句(只有参数不同)聚合到同一个指纹下, 记录次数、总耗时/平均/p95/最大耗时和返回(影响)行数
+'''
+import re
+import threading
+from functools import lru_cache
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_orm.core.statement import CACHE_MAX_SQL_LENGTH, CACHE_SIZE
+
+logger = LoggerFactory.get_logger('core.query_stats')
+
+# 计算 p95 时每个指纹保留的最近耗时样本数
+SAMPLE_SIZE = 256
+# 超过最大指纹数后新的指纹都计入该指纹
+OTHER_FINGERPRINT = '<other>'
+
+# 字符串和注释一起从左到右匹配, 避免字符串中的 # 或 -- 被当作注释
+_string_comment_pattern = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\")|/\*.*?\*/|--[^\n]*|#[^\n]*", re.S)
+_placeholder_pattern = re.compile(r'%\(\w+\)s|%s|\?')
+_number_pattern = re.compile(r'(?<![\w`.])[-+]?(?:0x[0-9a-f]+|\d+(?:\.\d+)?(?:e[-+]?\d+)?)\b', re.I)
+_in_list_pattern = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+_values_pattern = re.compile(r'\b(values?)\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))+', re.I)
+_space_pattern = re.compile(r'\s+')
+
+
+def _fingerprint(sql):
+    sql = _string_comment_pattern.sub(lambda match: '?' if match.group(1) else ' ', sql)
+    sql = _placeholder_pattern.sub('?', sql)
+    sql = _number_pattern.sub('?', sql)
+    sql = _space_pattern.sub(' ', sql).strip().lower()
+    sql = _in_list_pattern.sub('in (...)', sql)
+    sql = _values_pattern.sub(r'\1 \2, ...', sql)
+    return sql
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached_fingerprint(sql):
+    return _fingerprint(sql)
+
+
+def fingerprint(sql):
+    '''
+    sql 指纹, 例如 SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'a' -> select * from t where id in (...) and name = ?
+    '''
+    if len(sql) > CACHE_MAX_SQL_LENGTH:
+        return _fingerprint(sql)
+    return _cached_fingerprint(sql)
+
+
+class _FingerprintStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.samples = [0.0] * SAMPLE_SIZE
+        self.sample_index = 0
+
+    def record(self, seconds, rows, error):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if rows:
+            self.rows += rows
+        if error:
+            self.errors += 1
+        self.samples[self.sample_index % SAMPLE_SIZE] = seconds
+        self.sample_index += 1
+
+    def snapshot(self, sql):
+        samples = sorted(self.samples[:min(self.sample_index, SAMPLE_SIZE)])
+        p95 = samples[min(int(len(samples) * 0.95), len(samples) - 1)] if samples else 0.0
+        return {'fingerprint': sql, 'count': self.count, 'errors': self.errors, 'total': self.total, 'avg': self.total / self.count if self.count else 0.0,
+                'p95': p95, 'max': self.max, 'rows': self.rows, 'avg_rows': float(self.rows) / self.count if self.count else 0.0}
+
+
+class QueryStats(object):
+    '''
+    按指纹聚合语句的执行统计, 超过 slow_threshold_ms 的语句记录慢查询日志
+    '''
+
+    ORDER_KEYS = ('total', 'count', 'avg', 'p95', 'max', 'rows', 'errors')
+
+    def __init__(self, max_fingerprints=1000, slow_threshold_ms=0):
+        '''
+        :param max_fingerprints: 最多统计的指纹数, 超出后新的指纹计入 <other>
+        :param slow_threshold_ms: 慢查询阈值(毫秒), 0 表示不记录慢查询日志
+        '''
+        self.max_fingerprints = max_fingerprints
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_count = 0
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._dump_stop = None
+        self._dump_args = None
+
+    def record(self, sql, seconds, rows=None, params=None, error=False):
+        '''
+        记录一次执行, rows 为返回或影响的行数
+        '''
+        key = fingerprint(sql)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    key = OTHER_FINGERPRINT
+                    stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = _FingerprintStats()
+            stats.record(seconds, rows, error)
+
+        if self.slow_threshold_ms and seconds * 1000 >= self.slow_threshold_ms:
+            self.slow_count += 1
+            logger.warning('Slow sql - {:.1f}ms, rows: {}, sql: {}, params: {}'.format(seconds * 1000, rows, sql, self.__format_params(params)))
+
+    @staticmethod
+    def __format_params(params):
+        # executemany 的参数只记录前 5 组
+        if isinstance(params, list) and params and isinstance(params[0], (tuple, list, dict)):
+            return '{} ... ({} rows)'.format(params[:5], len(params)) if len(params) > 5 else str(params)
+        return params
+
+    def top(self, n=10, order_by='total'):
+        '''
+        按 order_by 倒序返回前 n 个指纹的统计
+        '''
+        if order_by not in QueryStats.ORDER_KEYS:
+            raise ValueError('Not support order by: {}, use one of {}'.format(order_by, QueryStats.ORDER_KEYS))
+        with self._lock:
+            snapshots = [stats.snapshot(key) for key, stats in self._stats.items()]
+        snapshots.sort(key=lambda item: item[order_by], reverse=True)
+        return snapshots[:n]
+
+    def report(self, n=10, order_by='total'):
+        '''
+        前 n 个指纹的文本报告
+        '''
+        lines = ['Top {} sql by {}:'.format(n, order_by),
+                 '{:>8} {:>10} {:>9} {:>9} {:>9} {:>10} {:>6}  {}'.format('count', 'total(ms)', 'avg(ms)', 'p95(ms)', 'max(ms)', 'rows', 'errors', 'fingerprint')]
+        for item in self.top(n, order_by):
+            lines.append('{:>8} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>6}  {}'.format(
+                item['count'], item['total'] * 1000, item['avg'] * 1000, item['p95'] * 1000, item['max'] * 1000, item['rows'], item['errors'], item['fingerprint']))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.slow_count = 0
+
+    def start_dump(self, interval, n=10, order_by='total', reset=False):
+        '''
+        后台线程每 interval 秒输出一次报告, reset 为 True 时输出后清空统计(每次报告只包含该周期)
+        '''
+        self.stop_dump()
+        self._dump_args = (interval, n, order_by, reset)
+        stop = self._dump_stop = threading.Event()
+
+        def dump():
+            while not stop.wait(interval):
+                try:
+                    if self._stats:
+                        logger.info(self.report(n, order_by))
+                        if reset:
+                            self.reset()
+                except Exception as e:
+                    logger.warning('Dump sql stats error: {}'.format(e))
+
+        thread = threading.Thread(target=dump, name='pesto-sql-stats')
+        thread.daemon = True
+        thread.start()
+
+    def stop_dump(self):
+        if self._dump_stop is not None:
+            self._dump_stop.set()
+            self._dump_stop = None
+            self._dump_args = None
+
+    def _reset_after_fork(self):
+        '''
+        fork 后锁可能被父进程的其他线程持有, 重建; 后台线程不会复制到子进程, 重新启动
+        '''
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.slow_count = 0
+        if self._dump_args is not None:
+            self.start_dump(*self._dump_args)
+
+
+def main():
+    sqls = ["SELECT * FROM example WHERE id IN (1, 2, 3) AND name = 'a''b#1' -- comment",
+            'select *  from example where id in (%s,%s) and name = %s',
+            '/* report */ INSERT INTO example (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)',
+            'UPDATE example SET v = v + 1.5e3 WHERE t2.id = -42']
+    for sql in sqls:
+        print('{}\n  -> {}'.format(sql, fingerprint(sql)))
+
+
+if __name__ == '__main__':
+    main()
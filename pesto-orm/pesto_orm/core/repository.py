@@ -1,21 +1,39 @@
 # -*- coding:utf8 -*-
+import re
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from pesto_common.log.logger_factory import LoggerFactory
 from pesto_common.utils.reflect_utils import ReflectUtils
-from pesto_orm.core.base import ExecuteMode
+from pesto_orm.core.base import ExecuteMode, CursorMode
+from pesto_orm.core.batch import chunk_values, estimate_size, PACKET_RESERVED_SIZE
+from pesto_orm.core.bulk import bulk_load
+from pesto_orm.core.columnar import concat_columnar
 from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.shard import ShardMerge
 
 logger = LoggerFactory.get_logger('core.repository')
 
+_primary_where_pattern = re.compile(r'^\s*`?(\w+)`?\s*=\s*%s\s*$')
+
 
 class BaseRepository(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, model_class, module=None, class_name=None):
+    def __init__(self, model_class, module=None, class_name=None, shard_key=None, shard_router=None, cache_ttl=None, coalesce=False, timeout=None):
         self.model_class = model_class
         self.module = module  # model_class.__module__
         self.class_name = class_name  # model_class.__name__
+        # 分片键和分片路由, 见 pesto_orm.core.shard
+        self.shard_key = shard_key
+        self.shard_router = shard_router
+        # 查询结果缓存时间(秒), 为空时不缓存, 流式查询不缓存; 通过同一个执行器的写操作会按表失效缓存
+        self.cache_ttl = cache_ttl
+        # 合并并发的相同查询(singleflight), 热点查询同一时刻只执行一次, 不缓存结果
+        self.coalesce = coalesce
+        # 语句超时(秒), 为空时使用执行器的 statement_timeout, 各查询和写入方法的 timeout 参数优先
+        self.timeout = timeout
 
         self.db_name = None
         self.table_name = None
@@ -46,15 +64,21 @@ class BaseRepository(object):
             return {}
 
     def _yield_result(self, query_result):
-        if query_result is not None and len(query_result) > 0:
-
-            for row in query_result:
-                model = self._create_instance()
-                if isinstance(model, dict):
-                    model.update(row.copy())
-                else:
-                    model.set_attrs(row.copy())
-                yield model
+        '''
+        query_result 可以是列表或者执行器的流式生成器, 提前结束时关闭生成器以释放连接
+        '''
+        if query_result is not None:
+            try:
+                for row in query_result:
+                    model = self._create_instance()
+                    if isinstance(model, dict):
+                        model.update(row.copy())
+                    else:
+                        model.set_attrs(row.copy())
+                    yield model
+            finally:
+                if hasattr(query_result, 'close'):
+                    query_result.close()
 
     def _return_result(self, query_result):
         result = []
@@ -76,38 +100,130 @@ class BaseRepository(object):
     def get_executor(self):
         raise NotImplementedError
 
+    def __timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    def _get_executor(self, shard_value=None):
+        '''
+        未分片时返回 get_executor(), 分片时返回 shard_value 对应分片的执行器
+        '''
+        if self.shard_router is None:
+            return self.get_executor()
+        if shard_value is None:
+            raise DBError(key=DBErrorType.SHARD_ERROR, message='Shard value of `{}` is required for table {}.'.format(self.shard_key, self.table_name))
+        return self.shard_router.get_executor(shard_value)
+
+    def _group_by_shard(self, models):
+        '''
+        按模型上的分片键分组, 返回 [(shard_value, models)]
+        '''
+        groups = self.shard_router.group_by_shard(models, lambda model: model.get_attr(self.shard_key))
+        return [(group[0].get_attr(self.shard_key), group) for group in groups.values()]
+
     def build_query_sql(self, columns=['*'], where='', params=None):
         sql = self.get_dialect().select(columns=columns, table=self.table_name, alias=self.table_alias, where=where)
         return sql, params
 
-    def query_by(self, columns=['*'], where='', params=None, yield_able=False):
+    def query_by(self, columns=['*'], where='', params=None, yield_able=False, shard_value=None, batch_size=1000, row_format=None, timeout=None):
         sql, params = self.build_query_sql(columns=columns, where=where, params=params)
-        return self.query(sql=sql, params=params, yield_able=yield_able)
-
-    def query(self, sql='', params=None, yield_able=False):
+        return self.query(sql=sql, params=params, yield_able=yield_able, shard_value=shard_value, batch_size=batch_size, row_format=row_format, timeout=timeout)
+
+    def __stream_shards(self, sql, params, batch_size, cursor_mode):
+        merge = ShardMerge(sql)
+        streams = [executor.select_stream(sql=merge.sql, params=params, batch_size=batch_size, cursor_mode=cursor_mode) for executor in self.shard_router.executors]
+        for row in merge.merge_stream(streams):
+            yield row
+
+    def query(self, sql='', params=None, yield_able=False, shard_value=None, batch_size=1000, row_format=None, timeout=None):
+        '''
+        分片时不指定 shard_value 会并行查询所有分片, 按 sql 末尾的 ORDER BY 归并并按 LIMIT 截取(见 ShardMerge), 没有 ORDER BY 时按分片顺序拼接
+        yield_able 时使用流式游标每次读取 batch_size 行, 边读边产出模型, 分片时同时打开各分片的游标
+        row_format 为 CursorMode 时直接返回该格式的行, 不创建模型
+        '''
         if self.table_name is not None and self.table_name not in sql:
             logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
 
-        query_result = self.get_executor().select(sql=sql, params=params)
-
+        timeout = self.__timeout(timeout)
+        cursor_mode = row_format or CursorMode.CURSOR_MODE
         if yield_able:
-            return self._yield_result(query_result)
+            if self.shard_router is not None and shard_value is None:
+                stream = self.__stream_shards(sql=sql, params=params, batch_size=batch_size, cursor_mode=cursor_mode)
+            else:
+                stream = self._get_executor(shard_value).select_stream(sql=sql, params=params, batch_size=batch_size, cursor_mode=cursor_mode)
+            return stream if row_format is not None else self._yield_result(stream)
+
+        if self.shard_router is not None and shard_value is None:
+            merge = ShardMerge(sql)
+            shard_results = self.shard_router.fan_out(lambda executor: executor.select(sql=merge.sql, params=params, cursor_mode=cursor_mode, cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout))
+            query_result = merge.merge(shard_results)
         else:
-            return self._return_result(query_result)
+            query_result = self._get_executor(shard_value).select(sql=sql, params=params, cursor_mode=cursor_mode, cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout)
+
+        return query_result if row_format is not None else self._return_result(query_result)
+
+    def query_columnar_by(self, columns=['*'], where='', params=None, shard_value=None, batch_size=10000):
+        sql, params = self.build_query_sql(columns=columns, where=where, params=params)
+        return self.query_columnar(sql=sql, params=params, shard_value=shard_value, batch_size=batch_size)
+
+    def query_columnar(self, sql='', params=None, shard_value=None, batch_size=10000):
+        '''
+        列式查询, 返回 {列名: numpy.ma.MaskedArray}, 列类型来自方言的 columnar_types, 分片时拼接各分片结果
+        '''
+        if self.table_name is not None and self.table_name not in sql:
+            logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
+
+        type_map = self.get_dialect().columnar_types
+        if self.shard_router is not None and shard_value is None:
+            shard_results = self.shard_router.fan_out(lambda executor: executor.select_columnar(sql=sql, params=params, batch_size=batch_size, type_map=type_map))
+            return concat_columnar(shard_results)
+        return self._get_executor(shard_value).select_columnar(sql=sql, params=params, batch_size=batch_size, type_map=type_map)
 
     def build_query_first_sql(self, columns=['*'], where='', params=None):
         sql = self.get_dialect().paginate(columns=columns, table=self.table_name, alias=self.table_alias, where=where, page_number=1, page_size=1)
         return sql, params
 
-    def query_first_by(self, columns=['*'], where='', params=None):
+    def query_first_by(self, columns=['*'], where='', params=None, shard_value=None, row_format=None, timeout=None):
         sql, params = self.build_query_first_sql(columns=columns, where=where, params=params)
-        return self.query_first(sql=sql, params=params)
-
-    def query_first(self, sql='', params=None):
+        return self.query_first(sql=sql, params=params, shard_value=shard_value, row_format=row_format, primary_value=self.__primary_value(columns, where, params),
+                                timeout=timeout)
+
+    def __primary_value(self, columns, where, params):
+        '''
+        where 为主键等值条件(例如 `id` = %s)且查询全部列时返回主键值, 用于实体缓存
+        '''
+        if self.primary_key is None or list(columns) != ['*'] or not isinstance(params, (list, tuple)) or len(params) != 1:
+            return None
+        match = _primary_where_pattern.match(where or '')
+        if match is None or match.group(1) != self.primary_key:
+            return None
+        return params[0]
+
+    def query_first(self, sql='', params=None, shard_value=None, row_format=None, primary_value=None, timeout=None):
+        '''
+        primary_value 不为空时表示按主键查询, 执行器开启实体缓存时先从实体缓存读取
+        '''
         if self.table_name is not None and self.table_name not in sql:
             logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
 
-        query_result = self.get_executor().select_first(sql=sql, params=params)
+        timeout = self.__timeout(timeout)
+        cursor_mode = row_format or CursorMode.CURSOR_MODE
+        if primary_value is not None and row_format is None and (self.shard_router is None or shard_value is not None):
+            executor = self._get_executor(shard_value)
+            query_result = executor.get_entity(self.table_name, primary_value,
+                                               lambda: executor.select_first(sql=sql, params=params, cursor_mode=cursor_mode, cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout))
+        elif self.shard_router is not None and shard_value is None:
+            merge = ShardMerge(sql)
+            if merge.offset:
+                shard_results = self.shard_router.fan_out(lambda executor: executor.select(sql=merge.sql, params=params, cursor_mode=cursor_mode, cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout))
+            else:
+                shard_results = self.shard_router.fan_out(lambda executor: executor.select_first(sql=merge.sql, params=params, cursor_mode=cursor_mode, cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout))
+                shard_results = [[shard_result] for shard_result in shard_results if shard_result]
+            query_result = next(iter(merge.merge(shard_results)), None)
+        else:
+            query_result = self._get_executor(shard_value).select_first(sql=sql, params=params, cursor_mode=cursor_mode, cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout)
+
+        if row_format is not None:
+            return query_result
 
         result = None
         if query_result is not None and len(query_result) > 0:
@@ -118,18 +234,108 @@ class BaseRepository(object):
                 result.set_attrs(query_result.copy())
         return result
 
+    def get_many(self, ids, columns=['*'], shard_value=None, chunk_size=1000, parallel=False, max_workers=4, timeout=None):
+        '''
+        按主键批量查询, 返回与 ids 顺序一致的模型列表, 不存在的 id 对应 None
+        ids 去重后按 chunk_size 和执行器的 max_allowed_packet 分批执行 IN 查询, parallel 时各批次在不同的连接上并行执行(事务内串行)
+        查询全部列时先读取实体缓存, 查询到的行放入实体缓存
+        '''
+        rows = {}
+        timeout = self.__timeout(timeout)
+        for executor, group_ids in self._group_ids(ids, shard_value):
+            rows.update(self.__get_many(executor, group_ids, columns, chunk_size, parallel, max_workers, timeout))
+
+        return self._ordered_models(ids, rows)
+
+    def _group_ids(self, ids, shard_value=None):
+        '''
+        去重后的主键按执行器分组, 返回 [(executor, ids)]
+        分片键为主键时按分片分组, 否则每个分片都查询全部主键
+        '''
+        unique_ids = list(OrderedDict.fromkeys(ids))
+        if self.shard_router is not None and shard_value is None:
+            if self.shard_key == self.primary_key:
+                return [(self.shard_router.executors[shard], group) for shard, group in self.shard_router.group_by_shard(unique_ids, lambda value: value).items()]
+            return [(executor, unique_ids) for executor in self.shard_router.executors]
+        return [(self._get_executor(shard_value), unique_ids)]
+
+    def _ordered_models(self, ids, rows):
+        '''
+        rows 为 {主键: 行}, 返回与 ids 顺序一致的模型列表, 不存在的 id 对应 None
+        '''
+        result = []
+        str_rows = None
+        for value in ids:
+            row = rows.get(value)
+            if row is None:
+                # 参数类型和数据库返回的主键类型不同时(例如 '1' 和 1)按字符串匹配
+                if str_rows is None:
+                    str_rows = dict((str(key), row) for key, row in rows.items())
+                row = str_rows.get(str(value))
+            if row is None:
+                result.append(None)
+            else:
+                model = self._create_instance()
+                if isinstance(model, dict):
+                    model.update(row.copy())
+                else:
+                    model.set_attrs(row.copy())
+                result.append(model)
+        return result
+
+    def _get_many_sql(self, columns, count):
+        where = '`%s` IN (%s)' % (self.primary_key, self.get_dialect().get_placeholders(count))
+        return self.get_dialect().select(columns=columns, table=self.table_name, alias=self.table_alias, where=where)
+
+    def __get_many(self, executor, ids, columns, chunk_size, parallel, max_workers, timeout):
+        full_row = list(columns) == ['*']
+        rows = {}
+        missing = []
+        for value in ids:
+            attrs = executor.peek_entity(self.table_name, value) if full_row else None
+            if attrs is None:
+                missing.append(value)
+            else:
+                rows[value] = attrs
+        if not missing:
+            return rows
+
+        if not full_row and self.primary_key not in columns:
+            columns = list(columns) + [self.primary_key]
+        version = executor.entity_version(self.table_name)
+        base_size = len(self._get_many_sql(columns, 0)) + PACKET_RESERVED_SIZE
+        chunks = list(chunk_values(missing, max_rows=chunk_size, max_bytes=executor.max_allowed_packet, base_size=base_size, size_of=estimate_size))
+
+        def load(chunk):
+            return executor.select(sql=self._get_many_sql(columns, len(chunk)), params=tuple(chunk), cache_ttl=self.cache_ttl, coalesce=self.coalesce, timeout=timeout)
+
+        if parallel and len(chunks) > 1 and not executor.in_transaction():
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)), thread_name_prefix='pesto-get-many') as pool:
+                results = list(pool.map(load, chunks))
+        else:
+            results = [load(chunk) for chunk in chunks]
+
+        for chunk_rows in results:
+            for row in chunk_rows:
+                primary_value = row[self.primary_key]
+                rows[primary_value] = row
+                if full_row:
+                    executor.refresh_entity(self.table_name, primary_value, row, version)
+        return rows
+
     def build_page_sql(self, columns=['*'], where='', page_num=1, page_size=1, params=None):
         sql = self.get_dialect().paginate(columns=columns, table=self.table_name, alias=self.table_alias, where=where, page_number=page_num, page_size=page_size)
         return sql, params
 
-    def page_by(self, columns=['*'], where='', page_num=1, page_size=1, params=None, yield_able=False):
+    def page_by(self, columns=['*'], where='', page_num=1, page_size=1, params=None, yield_able=False, shard_value=None, batch_size=1000, row_format=None,
+                timeout=None):
         sql, params = self.build_page_sql(columns=columns, where=where, page_num=page_num, page_size=page_size, params=params)
-        return self.page(sql=sql, params=params, yield_able=yield_able)
+        return self.page(sql=sql, params=params, yield_able=yield_able, shard_value=shard_value, batch_size=batch_size, row_format=row_format, timeout=timeout)
 
-    def page(self, sql='', params=None, yield_able=False):
+    def page(self, sql='', params=None, yield_able=False, shard_value=None, batch_size=1000, row_format=None, timeout=None):
         if self.table_name is not None and self.table_name not in sql:
             logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
-        return self.query(sql=sql, params=params, yield_able=yield_able)
+        return self.query(sql=sql, params=params, yield_able=yield_able, shard_value=shard_value, batch_size=batch_size, row_format=row_format, timeout=timeout)
 
     def build_update_sql(self, models=[], columns=[], where='', params=None):
         if len(models) > 0:
@@ -155,15 +361,19 @@ class BaseRepository(object):
 
         return sql, params
 
-    def update_by(self, models=[], columns=[], where='', params=None):
+    def update_by(self, models=[], columns=[], where='', params=None, shard_value=None, timeout=None):
+        if self.shard_router is not None and len(models) > 0 and shard_value is None:
+            return sum(self.update_by(models=group, shard_value=value, timeout=timeout) for value, group in self._group_by_shard(models))
+
+        entity_keys = [model.get_attr(self.primary_key) for model in models] if len(models) > 0 else None
         sql, params = self.build_update_sql(models=models, columns=columns, where=where, params=params)
-        return self.update(sql=sql, params=params)
+        return self.update(sql=sql, params=params, shard_value=shard_value, entity_keys=entity_keys, timeout=timeout)
 
-    def update(self, sql='', params=None):
+    def update(self, sql='', params=None, shard_value=None, entity_keys=None, timeout=None):
         if self.table_name is not None and self.table_name not in sql:
             logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
 
-        return self.get_executor().update(sql=sql, params=params)
+        return self._get_executor(shard_value).update(sql=sql, params=params, entity_keys=entity_keys, timeout=self.__timeout(timeout))
 
     def build_delete_sql(self, models=[], where='', params=None):
         if len(models) > 0:
@@ -176,15 +386,22 @@ class BaseRepository(object):
         sql = self.get_dialect().delete(table=self.table_name, where=where)
         return sql, params
 
-    def delete_by(self, models=[], where='', params=None):
+    def delete_by(self, models=[], where='', params=None, shard_value=None, timeout=None):
+        if self.shard_router is not None and len(models) > 0 and shard_value is None:
+            return sum(self.delete_by(models=group, shard_value=value, timeout=timeout) for value, group in self._group_by_shard(models))
+
+        entity_keys = [model.get_attr(self.primary_key) for model in models] if len(models) > 0 else None
         sql, params = self.build_delete_sql(models=models, where=where, params=params)
-        return self.delete(sql=sql, params=params)
+        return self.delete(sql=sql, params=params, shard_value=shard_value, entity_keys=entity_keys, timeout=timeout)
 
-    def delete(self, sql='', params=None):
+    def delete(self, sql='', params=None, shard_value=None, entity_keys=None, timeout=None):
+        '''
+        entity_keys 为删除的主键, 只失效这些实体缓存, 为空时失效整张表的实体缓存
+        '''
         if self.table_name is not None and self.table_name not in sql:
             logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
 
-        return self.get_executor().delete(sql=sql, params=params)
+        return self._get_executor(shard_value).delete(sql=sql, params=params, entity_keys=entity_keys, timeout=self.__timeout(timeout))
 
     def build_insert_sql(self, models=[]):
         params = []
@@ -202,12 +419,36 @@ class BaseRepository(object):
         sql = self.get_dialect().insert(columns=columns, table=self.table_name, primary_key=self.primary_key, sequence=self.sequence)
         return sql, params
 
-    def insert_by(self, models=[]):
-        sql, params = self.build_insert_sql(models=models)
-        return self.insert(sql=sql, params=params)
+    def insert_by(self, models=[], shard_value=None, chunk_size=1000, parallel=False, max_workers=4, timeout=None):
+        '''
+        批量插入, 返回插入的行数; 改写为多行 insert 后按 chunk_size 和执行器的 max_allowed_packet 分批, 见 Executor.insert_many
+        '''
+        if self.shard_router is not None and shard_value is None:
+            return sum(self.insert_by(models=group, shard_value=value, chunk_size=chunk_size, parallel=parallel, max_workers=max_workers, timeout=timeout)
+                       for value, group in self._group_by_shard(models))
 
-    def insert(self, sql='', params=[()]):
+        sql, params = self.build_insert_sql(models=models)
+        results = self._get_executor(shard_value).insert_many(sql=sql, params=params, chunk_size=chunk_size, parallel=parallel, max_workers=max_workers,
+                                                              timeout=self.__timeout(timeout))
+        return sum(result['rowcount'] for result in results)
+
+    def bulk_load(self, rows_or_path, columns=None, shard_value=None, chunk_rows=100000, insert_chunk_size=1000, fallback=True, tmp_dir=None, timeout=None):
+        '''
+        大批量导入, 逐行读取可迭代的行(dict、模型、tuple/list)、csv 文件(FileUtils.save_dict)或 pickle 文件(FileUtils.add_to_pickle),
+        每 chunk_rows 行写入临时文件后 LOAD DATA LOCAL INFILE, 不允许 LOCAL INFILE 时退回多行 insert, 见 pesto_orm.core.bulk
+        :return: {'rows', 'rowcount', 'seconds', 'rows_per_second', 'method'}
+        '''
+        if self.shard_router is not None and shard_value is None:
+            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Bulk load on sharded table {} requires shard_value.'.format(self.table_name))
+
+        def build_insert_sql(load_columns):
+            return self.get_dialect().insert(columns=load_columns, table=self.table_name, primary_key=self.primary_key, sequence=self.sequence)
+
+        return bulk_load(self._get_executor(shard_value), self.table_name, rows_or_path, columns=columns, build_insert_sql=build_insert_sql,
+                         chunk_rows=chunk_rows, insert_chunk_size=insert_chunk_size, fallback=fallback, timeout=self.__timeout(timeout), tmp_dir=tmp_dir)
+
+    def insert(self, sql='', params=[()], shard_value=None, timeout=None):
         if self.table_name is not None and self.table_name not in sql:
             logger.warning('This model only for table {}, please check sql, is it contains this table?'.format(self.table_name))
 
-        return self.get_executor().insert(sql=sql, params=params, execute_mode=ExecuteMode.MANY_MODE)
+        return self._get_executor(shard_value).insert(sql=sql, params=params, execute_mode=ExecuteMode.MANY_MODE, timeout=self.__timeout(timeout))
@@ -0,0 +1,230 @@
+'''
+水平分片: 按分片键把仓库操作路由到对应的执行器
+'''
+import bisect
+import heapq
+import itertools
+import re
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_common.utils.hash_utils import HashUtils
+from pesto_orm.core.error import DBError, DBErrorType
+
+logger = LoggerFactory.get_logger('core.shard')
+
+
+class ShardStrategy(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def shard_for(self, value, shard_count):
+        '''
+        返回分片键对应的分片下标
+        '''
+        raise NotImplementedError
+
+
+class ModuloShardStrategy(ShardStrategy):
+    '''
+    按整数取模分片, 非整数先做 md5
+    '''
+
+    def shard_for(self, value, shard_count):
+        try:
+            return int(value) % shard_count
+        except (TypeError, ValueError):
+            return int(HashUtils.md5(str(value).encode('utf-8'))[:8], 16) % shard_count
+
+
+class RangeShardStrategy(ShardStrategy):
+    '''
+    按区间分片, bounds 为每个分片的上界(不含), 例如 [1000000, 2000000] 表示
+    < 1000000 在分片 0, < 2000000 在分片 1, 其余在分片 2
+    '''
+
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+
+    def shard_for(self, value, shard_count):
+        index = bisect.bisect_right(self.bounds, value)
+        if index >= shard_count:
+            raise DBError(key=DBErrorType.SHARD_ERROR, message='Shard value {} out of range, shard count: {}'.format(value, shard_count))
+        return index
+
+
+class ConsistentHashShardStrategy(ShardStrategy):
+    '''
+    一致性哈希环, 每个分片 virtual_nodes 个虚拟节点, 增减分片时只迁移相邻区间的数据
+    '''
+
+    def __init__(self, virtual_nodes=160):
+        self.virtual_nodes = virtual_nodes
+        self._shard_count = None
+        self._ring = []
+        self._shards = []
+
+    @staticmethod
+    def __hash(value):
+        return int(HashUtils.md5(str(value).encode('utf-8'))[:8], 16)
+
+    def __build(self, shard_count):
+        ring = sorted((ConsistentHashShardStrategy.__hash('shard-%s#%s' % (shard, i)), shard) for shard in range(shard_count) for i in range(self.virtual_nodes))
+        self._ring = [point for point, shard in ring]
+        self._shards = [shard for point, shard in ring]
+        self._shard_count = shard_count
+
+    def shard_for(self, value, shard_count):
+        if self._shard_count != shard_count:
+            self.__build(shard_count)
+        index = bisect.bisect(self._ring, ConsistentHashShardStrategy.__hash(value))
+        return self._shards[index % len(self._shards)]
+
+
+class ShardRouter(object):
+    '''
+    分片路由: executors 为各分片的执行器(下标即分片号), strategy 为分片策略
+    max_workers 为所有请求线程共享的跨分片查询线程数, 默认为各分片(除调用线程执行的第一个分片外)连接池最大连接数之和
+    '''
+
+    def __init__(self, executors, strategy=None, parallel=True, max_workers=None):
+        if not executors:
+            raise DBError(key=DBErrorType.SHARD_ERROR, message='Shard router needs at least one executor.')
+        self.executors = list(executors)
+        self.strategy = strategy if strategy is not None else ModuloShardStrategy()
+        self.parallel = parallel and len(self.executors) > 1
+        self.max_workers = max_workers
+        self._pool = None
+        self._pool_lock = Lock()
+
+    def shard_for(self, value):
+        return self.strategy.shard_for(value, len(self.executors))
+
+    def get_executor(self, value):
+        return self.executors[self.shard_for(value)]
+
+    def group_by_shard(self, items, get_value):
+        '''
+        按分片分组, 返回 {分片号: [item]}
+        '''
+        groups = {}
+        for item in items:
+            groups.setdefault(self.shard_for(get_value(item)), []).append(item)
+        return groups
+
+    def __get_pool(self):
+        # 第一次跨分片查询时创建, asyncio 仓库(AsyncBaseRepository)不使用线程池
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    max_workers = self.max_workers
+                    if max_workers is None:
+                        max_workers = sum(executor.pool_max_size() for executor in self.executors[1:])
+                    self._pool = ThreadPoolExecutor(max_workers=max(max_workers, 1), thread_name_prefix='pesto-shard')
+        return self._pool
+
+    def fan_out(self, func):
+        '''
+        在所有分片上执行 func(executor), 按分片顺序返回结果
+        第一个分片在调用线程上执行, 其余分片提交到共享线程池
+        当前线程在任一分片上有事务时串行执行, 保证使用事务连接
+        '''
+        if not self.parallel or any(executor.in_transaction() for executor in self.executors):
+            return [func(executor) for executor in self.executors]
+
+        futures = [self.__get_pool().submit(func, executor) for executor in self.executors[1:]]
+        try:
+            first = func(self.executors[0])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return [first] + [future.result() for future in futures]
+
+
+class _Descending(object):
+    '''
+    倒序排序的键
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class ShardMerge(object):
+    '''
+    跨分片查询的合并: 解析 sql 末尾的 ORDER BY 和 LIMIT
+    各分片执行的 sql(self.sql) 取前 offset + limit 行, 合并后按 ORDER BY 重新排序(各分片结果已有序, 归并即可)再截取 offset 之后的 limit 行
+    ORDER BY 只支持列名(可带表别名和反引号), 包含表达式时或 tuple 格式的行按分片顺序拼接
+    '''
+
+    _limit_pattern = re.compile(r'\s+LIMIT\s+(\d+)(?:\s*,\s*(\d+)|\s+OFFSET\s+(\d+))?\s*$', re.I)
+    _order_pattern = re.compile(r'\s+ORDER\s+BY\s+', re.I)
+    _order_item_pattern = re.compile(r'^(?:`?\w+`?\.)?`?(\w+)`?(?:\s+(ASC|DESC))?$', re.I)
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.order = []
+        self.limit = None
+        self.offset = 0
+
+        body = sql
+        match = ShardMerge._limit_pattern.search(sql)
+        if match is not None:
+            body = sql[:match.start()]
+            if match.group(2) is not None:
+                # LIMIT offset, count
+                self.offset, self.limit = int(match.group(1)), int(match.group(2))
+            else:
+                self.limit, self.offset = int(match.group(1)), int(match.group(3) or 0)
+            self.sql = '%s LIMIT %d' % (body, self.offset + self.limit)
+
+        # 只取最外层(最后一个右括号之后)的 ORDER BY
+        orders = list(ShardMerge._order_pattern.finditer(body))
+        if orders and orders[-1].start() > body.rfind(')'):
+            for item in body[orders[-1].end():].split(','):
+                item_match = ShardMerge._order_item_pattern.match(item.strip())
+                if item_match is None:
+                    logger.warning('Unsupported order by item for shard merge: {}, results are concatenated in shard order'.format(item.strip()))
+                    self.order = []
+                    break
+                self.order.append((item_match.group(1), (item_match.group(2) or '').upper() == 'DESC'))
+
+    def __sort_key(self, row):
+        if isinstance(row, dict):
+            values = [row.get(column) for column, desc in self.order]
+        elif hasattr(row, '_fields'):
+            values = [getattr(row, column) for column, desc in self.order]
+        else:
+            # tuple 行没有列名, 键相同时 heapq.merge 按分片顺序输出
+            return ()
+        # 与 mysql 一致: 正序时 NULL 在前, 倒序时 NULL 在后
+        return tuple(_Descending((value is not None, value)) if desc else (value is not None, value) for value, (column, desc) in zip(values, self.order))
+
+    def __slice(self, rows):
+        if self.limit is None:
+            return rows
+        return itertools.islice(rows, self.offset, self.offset + self.limit)
+
+    def merge(self, shard_results):
+        '''
+        合并各分片的结果列表
+        '''
+        return list(self.merge_stream(shard_results))
+
+    def merge_stream(self, streams):
+        '''
+        合并各分片的结果(列表或流式游标), 有 ORDER BY 时同时读取各分片并归并
+        '''
+        if not self.order:
+            return self.__slice(itertools.chain.from_iterable(streams))
+        return self.__slice(heapq.merge(*streams, key=self.__sort_key))
@@ -0,0 +1,152 @@
+'''
+sql 语句分类, 跳过开头的空白、注释和括号后读取第一个关键字, 不复制整条 sql
+结果按 sql 文本缓存在有界的 LRU 中, 过长的 sql 不缓存(只扫描开头, 本身开销很小, 避免缓存持有大字符串)
+
+性能对比: python -m pesto_orm.core.statement
+'''
+import re
+from functools import lru_cache
+
+from pesto_orm.core.error import DBError, DBErrorType
+
+CACHE_SIZE = 1024
+CACHE_MAX_SQL_LENGTH = 4096
+
+_table_name = r'(?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?'
+# LOAD DATA ... INTO TABLE t 中 INTO 之后的 TABLE 是关键字
+_table_pattern = re.compile(r'\b(?:FROM|JOIN|INTO(?:\s+TABLE)?|UPDATE|TABLE)\s+(' + _table_name + ')', re.I)
+# FROM a, b 形式的多表
+_from_list_pattern = re.compile(r'\bFROM\s+(' + _table_name + r'(?:\s+(?:AS\s+)?\w+)?(?:\s*,\s*' + _table_name + r'(?:\s+(?:AS\s+)?\w+)?)+)', re.I)
+
+
+def _scan(sql):
+    start, end = _scan_span(sql)
+    return sql[start:end].upper()
+
+
+def _scan_span(sql):
+    '''
+    第一个关键字的起止位置
+    '''
+    length = len(sql)
+    i = 0
+    while i < length:
+        char = sql[i]
+        if char.isspace() or char == '(':
+            i += 1
+        elif char == '-' and sql.startswith('--', i) or char == '#':
+            end = sql.find('\n', i)
+            if end < 0:
+                return length, length
+            i = end + 1
+        elif char == '/' and sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            if end < 0:
+                return length, length
+            i = end + 2
+        else:
+            break
+
+    start = i
+    while i < length and (sql[i].isalpha() or sql[i] == '_'):
+        i += 1
+    return start, i
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached_scan(sql):
+    return _scan(sql)
+
+
+def statement_type(sql):
+    '''
+    返回语句的第一个关键字(大写), 例如 SELECT/INSERT/UPDATE, 没有关键字时返回空字符串
+    '''
+    if len(sql) > CACHE_MAX_SQL_LENGTH:
+        return _scan(sql)
+    return _cached_scan(sql)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached_tables(sql):
+    names = [match.group(1) for match in _table_pattern.finditer(sql)]
+    for match in _from_list_pattern.finditer(sql):
+        names.extend(part.split()[0] for part in match.group(1).split(','))
+
+    tables = []
+    for name in names:
+        table = normalize_table(name)
+        if table and table not in tables:
+            tables.append(table)
+    return tuple(tables)
+
+
+def normalize_table(name):
+    '''
+    db.table 只保留表名, 去掉反引号, 统一小写, 与 statement_tables 返回的表名一致
+    '''
+    return name.replace('`', '').split('.')[-1].strip().lower()
+
+
+def quote_identifier(name):
+    '''
+    用反引号引用列名等标识符, 名字中的反引号转义为两个, 用于拼接来自调用方或文件的列名
+    '''
+    return '`%s`' % str(name).replace('`', '``')
+
+
+def statement_tables(sql):
+    '''
+    返回语句涉及的表名(FROM/JOIN/INTO/UPDATE/TABLE 之后的名字), 用于按表失效缓存, 子查询中的表也会包含在内
+    '''
+    if len(sql) > CACHE_MAX_SQL_LENGTH:
+        return _cached_tables.__wrapped__(sql)
+    return _cached_tables(sql)
+
+
+def add_hint(sql, hint):
+    '''
+    在第一个关键字之后加上优化器提示, 例如 SELECT /*+ MAX_EXECUTION_TIME(1000) */ ...
+    '''
+    start, end = _scan_span(sql)
+    if start == end:
+        return sql
+    return '{} {}{}'.format(sql[:end], hint, sql[end:])
+
+
+def check_statement(sql, forbidden):
+    '''
+    语句类型在 forbidden 中时抛出 OPERATE_NOT_SUPPORT_ERROR
+    '''
+    if statement_type(sql) in forbidden:
+        raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+
+
+def cache_info():
+    return _cached_scan.cache_info()
+
+
+def main():
+    import timeit
+
+    forbidden = ('DROP', 'CREATE', 'INSERT', 'UPDATE', 'DELETE')
+
+    def upper_guard(sql):
+        if sql.upper().startswith('DROP') | sql.upper().startswith('CREATE') | sql.upper().startswith('INSERT') | sql.upper().startswith('UPDATE') | sql.upper().startswith(
+                'DELETE'):
+            raise DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='Not support this operate')
+
+    small_sql = 'SELECT * FROM example WHERE `id` = %s'
+    comment_sql = '/* report */ -- daily\n  SELECT * FROM example WHERE `id` = %s'
+    large_sql = 'SELECT * FROM example WHERE `id` IN (%s)' % ','.join(['%s'] * 20000)
+
+    number = 20000
+    for name, sql in (('small', small_sql), ('comment', comment_sql), ('large', large_sql)):
+        upper_cost = timeit.timeit(lambda: upper_guard(sql), number=number) / number
+        check_cost = timeit.timeit(lambda: check_statement(sql, forbidden), number=number) / number
+        print('{:<8} length: {:>7}, sql.upper() guard: {:>9.3f}us, check_statement: {:>7.3f}us'.format(name, len(sql), upper_cost * 1e6, check_cost * 1e6))
+    print(cache_info())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+语句超时看门狗, 一个后台线程按截止时间处理所有被监视的语句, 超时后调用回调(例如 KILL QUERY)
+'''
+import heapq
+import itertools
+import threading
+import time
+
+from pesto_common.log.logger_factory import LoggerFactory
+
+logger = LoggerFactory.get_logger('core.watchdog')
+
+
+class Watch(object):
+    '''
+    一次监视, fired 为 True 表示已经超时并调用了回调
+    '''
+    __slots__ = ('timeout', 'deadline', 'callback', 'fired', 'cancelled', 'done')
+
+    def __init__(self, timeout, callback):
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.callback = callback
+        self.fired = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+class Watchdog(object):
+    # 已取消的监视超过堆的一半且堆至少这么大时重建堆, 避免长超时下已取消的监视堆积到截止时间
+    COMPACT_MIN_SIZE = 64
+
+    def __init__(self, name='pesto-watchdog'):
+        self.name = name
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Condition()
+        self._heap = []
+        self._cancelled = 0
+        self._counter = itertools.count()
+        self._thread = None
+
+    def _reset_after_fork(self):
+        '''
+        fork 后父进程的后台线程不存在, 重建状态, 下次 watch 时重新启动
+        '''
+        self._reset()
+
+    def watch(self, timeout, callback):
+        '''
+        timeout 秒后调用 callback(), 返回 Watch, 语句结束后需要调用 cancel
+        '''
+        watch = Watch(timeout, callback)
+        with self._lock:
+            heapq.heappush(self._heap, (watch.deadline, next(self._counter), watch))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._lock.notify()
+        return watch
+
+    def cancel(self, watch):
+        '''
+        取消监视, 回调正在执行时等待其结束(避免 KILL 落到连接的下一条语句上), 返回是否已经超时
+        '''
+        with self._lock:
+            if not watch.fired:
+                if not watch.cancelled:
+                    watch.cancelled = True
+                    self._cancelled += 1
+                    if self._cancelled * 2 > len(self._heap) >= Watchdog.COMPACT_MIN_SIZE:
+                        self.__compact()
+                return False
+        watch.done.wait()
+        return True
+
+    def __compact(self):
+        self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+        heapq.heapify(self._heap)
+        self._cancelled = 0
+
+    def __run(self):
+        while True:
+            with self._lock:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if not self._heap:
+                    self._lock.wait()
+                    continue
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._lock.wait(wait)
+                    continue
+                watch = heapq.heappop(self._heap)[2]
+                watch.fired = True
+
+            try:
+                watch.callback()
+            except Exception as e:
+                logger.warning('Watchdog callback error: {}'.format(e))
+            finally:
+                watch.done.set()
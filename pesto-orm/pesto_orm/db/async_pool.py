@@ -0,0 +1,219 @@
+'''
+asyncio 连接池
+
+驱动约定(与 aiomysql 兼容): target.connect(**kwargs) 返回连接(可以是协程),
+连接提供 cursor()/begin()/commit()/rollback()/close(), 游标提供 execute()/executemany()/fetchone()/fetchall()/fetchmany()/close(),
+这些方法既可以是协程也可以是普通方法, 便于在测试中使用假驱动
+'''
+import asyncio
+import inspect
+import time
+from collections import deque
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.metrics import Metrics
+from pesto_orm.db.pool import TooManyConnections
+
+logger = LoggerFactory.get_logger('db.async_pool')
+
+
+async def maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+        self._transaction = False
+        self.created_at = self.last_used_at = time.time()
+
+    async def cursor(self, *args, **kwargs):
+        return AsyncCursor(await maybe_await(self._conn.cursor(*args, **kwargs)))
+
+    async def begin(self):
+        self._transaction = True
+        await maybe_await(self._conn.begin())
+
+    async def commit(self):
+        self._transaction = False
+        await maybe_await(self._conn.commit())
+
+    async def rollback(self):
+        self._transaction = False
+        await maybe_await(self._conn.rollback())
+
+    async def reset(self):
+        if self._transaction:
+            try:
+                await self.rollback()
+            except Exception:
+                pass
+
+    async def close(self):
+        try:
+            if hasattr(self._conn, 'ensure_closed'):
+                await self._conn.ensure_closed()
+            else:
+                await maybe_await(self._conn.close())
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class AsyncCursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    async def execute(self, sql, params=None):
+        return await maybe_await(self._cursor.execute(sql, params))
+
+    async def executemany(self, sql, params):
+        return await maybe_await(self._cursor.executemany(sql, params))
+
+    async def fetchone(self):
+        return await maybe_await(self._cursor.fetchone())
+
+    async def fetchall(self):
+        return await maybe_await(self._cursor.fetchall())
+
+    async def fetchmany(self, size):
+        return await maybe_await(self._cursor.fetchmany(size))
+
+    async def close(self):
+        try:
+            await maybe_await(self._cursor.close())
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class AsyncConnectionPool(object):
+    def __init__(self, target, core_size=20, max_size=100, checkout_timeout=30, **kwargs):
+        '''
+        :param target: 驱动, 需提供 connect(**kwargs)
+        :param core_size: 保留的空闲连接数
+        :param max_size: 最大连接数
+        :param checkout_timeout: 获取连接的最长等待时间(秒), None 表示一直等待
+        '''
+        self._target = target
+        self._core_size = core_size
+        self._max_size = max(max_size, 1)
+        self._checkout_timeout = checkout_timeout
+        self._kwargs = kwargs
+        self._curr_size = 0
+        self._closed = False
+        self._idle_conns = deque()
+        self._using_conns = set()
+        self._waiters = deque()
+        self.metrics = Metrics()
+        self.metrics.gauge('async_pool_size', lambda: self._curr_size)
+        self.metrics.gauge('async_pool_in_use', lambda: len(self._using_conns))
+        self.metrics.gauge('async_pool_idle', lambda: len(self._idle_conns))
+
+    async def __connection(self):
+        conn = AsyncConnection(await maybe_await(self._target.connect(**self._kwargs)))
+        self.metrics.inc('async_pool_connections_created')
+        return conn
+
+    def __hand_over(self, conn):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return True
+        return False
+
+    def __release_slot(self):
+        if self._closed or not self.__hand_over(None):
+            self._curr_size -= 1
+
+    async def get_connection(self, timeout=None):
+        if self._closed:
+            raise DBError(key=DBErrorType.NOT_CONNECT_ERROR, message='Connection pool is closed.')
+        if timeout is None:
+            timeout = self._checkout_timeout
+
+        start = time.time()
+        if not self._waiters and self._idle_conns:
+            conn = self._idle_conns.pop()
+        elif not self._waiters and self._curr_size < self._max_size:
+            # 先占用名额再建立连接, 避免并发建立超过 max_size
+            self._curr_size += 1
+            try:
+                conn = await self.__connection()
+            except Exception:
+                self.__release_slot()
+                raise
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                conn = await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                self.metrics.inc('async_pool_checkout_timeouts')
+                raise TooManyConnections(key=DBErrorType.TOO_MANY_CONNECTIONS_ERROR,
+                                         message='Wait for connection timeout after {}s, max size: {}.'.format(timeout, self._max_size))
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            if conn is None:
+                # 拿到的是新建连接的名额
+                try:
+                    conn = await self.__connection()
+                except Exception:
+                    self.__release_slot()
+                    raise
+
+        self._using_conns.add(conn)
+        self.metrics.observe('async_pool_checkout_wait_seconds', time.time() - start)
+        return conn
+
+    async def return_connection(self, conn):
+        if conn not in self._using_conns:
+            return
+        self._using_conns.discard(conn)
+        await conn.reset()
+        conn.last_used_at = time.time()
+
+        if self._closed:
+            await conn.close()
+        elif self.__hand_over(conn):
+            self._using_conns.add(conn)
+        elif len(self._idle_conns) < self._core_size:
+            self._idle_conns.append(conn)
+        else:
+            self._curr_size -= 1
+            await conn.close()
+
+    async def discard_connection(self, conn):
+        if conn not in self._using_conns:
+            return
+        self._using_conns.discard(conn)
+        self.__release_slot()
+        await conn.close()
+
+    def in_use_count(self):
+        return len(self._using_conns)
+
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
+    async def close(self):
+        self._closed = True
+        conns = list(self._idle_conns) + list(self._using_conns)
+        self._idle_conns.clear()
+        self._using_conns.clear()
+        self._curr_size = 0
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(DBError(key=DBErrorType.NOT_CONNECT_ERROR, message='Connection pool is closed.'))
+        for conn in conns:
+            await conn.close()
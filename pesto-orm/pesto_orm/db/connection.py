@@ -1,4 +1,5 @@
 import sys
+import time
 
 from pesto_orm.core.error import DBError
 
@@ -13,6 +14,8 @@ class Connection(object):
         self._closed = True
         self._transaction = False
         self._usage = 0
+        self.created_at = None
+        self.last_used_at = None
         try:
             self._target = target.connect
             self._db_api = target
@@ -59,6 +62,7 @@ class Connection(object):
             self._transaction = False
             self._closed = False
             self._usage = 0
+            self.created_at = self.last_used_at = time.time()
         except Exception as e:
             self.close()
             raise e
@@ -68,17 +72,43 @@ class Connection(object):
             return self._conn.is_connected()
         except Exception as e:
             pass
+        return False
+
+    def ping(self):
+        '''
+        校验连接是否可用, 驱动没有 ping 时退化为 is_connected
+        '''
+        if self._closed:
+            return False
+        try:
+            ping = self._conn.ping
+        except AttributeError:
+            return self.is_connected()
+        try:
+            ping()
+        except Exception as e:
+            return False
         return True
 
+    def connection_id(self):
+        '''
+        服务端的连接 id(mysql 的 thread id), 驱动不支持时返回 None
+        '''
+        conn_id = getattr(self._conn, 'connection_id', None)
+        if conn_id is None:
+            # pymysql 等驱动为 thread_id()
+            conn_id = getattr(self._conn, 'thread_id', None)
+        return conn_id() if callable(conn_id) else conn_id
+
     def cursor(self, *args, **kwargs):
         return Cursor(self._conn, self._conn.cursor(*args, **kwargs))
 
     def begin(self, *args, **kwargs):
         self._transaction = True
-        try:
-            self._conn.begin(*args, **kwargs)
-        except AttributeError:
-            pass
+        # mysql.connector 为 start_transaction, pymysql 等驱动为 begin
+        begin = getattr(self._conn, 'start_transaction', None) or getattr(self._conn, 'begin', None)
+        if begin is not None:
+            begin(*args, **kwargs)
 
     def commit(self):
         self._transaction = False
@@ -106,16 +136,23 @@ class Connection(object):
 
     def close(self):
         if not self._closed:
+            # 事务中先回滚, 无论回滚是否成功都关闭底层连接
+            self.reset()
             try:
-                if self._transaction:
-                    self.reset()
-                else:
-                    self._conn.close()
+                self._conn.close()
             except Exception as e:
                 pass
             self._transaction = False
             self._closed = True
 
+    def detach(self):
+        '''
+        解除对底层连接的引用但不关闭, 用于 fork 后的子进程丢弃父进程的连接
+        '''
+        self._conn = None
+        self._transaction = False
+        self._closed = True
+
     def cancel(self):
         self._transaction = False
         try:
@@ -1,88 +1,451 @@
-from threading import Condition
+import os
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Lock, Thread
 
 from pesto_common.log.logger_factory import LoggerFactory
-from pesto_orm.core.error import DBError
+from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.metrics import Metrics
 from pesto_orm.db.connection import Connection, InvalidConnection
+from pesto_orm.db.sizing import AdaptiveSizing
 
 logger = LoggerFactory.get_logger('db.pool')
 
+# 支持 os.register_at_fork 时由 fork 回调重建连接池, 否则借出连接时检查 pid
+_AT_FORK = hasattr(os, 'register_at_fork')
+_pools = weakref.WeakSet()
+
+
+def _reset_pools_after_fork():
+    for pool in list(_pools):
+        pool._reset_after_fork()
+
+
+if _AT_FORK:
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
 
 class TooManyConnections(DBError):
     pass
 
 
+class _Waiter(object):
+    '''
+    排队等待连接的线程，归还的连接按 FIFO 顺序直接交给队首的等待者
+    '''
+    __slots__ = ('condition', 'conn', 'granted')
+
+    def __init__(self, lock):
+        self.condition = Condition(lock)
+        self.conn = None
+        self.granted = False
+
+
 class ConnectionPool(object):
-    def __init__(self, target, core_size=20, max_size=100, max_wait=100, *args, **kwargs):
+    def __init__(self, target, core_size=20, max_size=100, max_wait=None, checkout_timeout=30, validation_interval=30, idle_timeout=600, max_lifetime=1800,
+                 lazy_init=False, warm_up=False, warm_up_workers=8, adaptive_sizing=False, sizing_interval=10, sizing_cool_down=60, *args, **kwargs):
+        '''
+        :param core_size: 保留的空闲连接数
+        :param max_size: 最大连接数(空闲 + 使用中)
+        :param max_wait: 最大排队等待线程数, None 表示不限制
+        :param checkout_timeout: 获取连接的最长等待时间(秒), None 表示一直等待
+        :param validation_interval: 后台校验空闲连接的间隔(秒), 0 表示不启动后台线程
+        :param idle_timeout: 空闲超过该时间(秒)的连接会被关闭, 0 表示不限制
+        :param max_lifetime: 创建超过该时间(秒)的连接会被回收重建, 0 表示不限制
+        :param lazy_init: 初始化时不建立连接, 第一次使用时才建立
+        :param warm_up: 在后台线程中并行建立其余的 core_size 个连接
+        :param warm_up_workers: 预热时并行建立连接的线程数
+        :param adaptive_sizing: 根据等待和新建连接情况在 [core_size, max_size] 之间动态调整保留的空闲连接数
+        :param sizing_interval: 动态调整的统计周期(秒)
+        :param sizing_cool_down: 持续多久(秒)没有压力后开始缩小
+        '''
         self._target = target
         self._core_size = core_size
-        self._max_size = max_size
+        self._max_size = max(max_size, 1)
         self._max_wait = max_wait
+        self._checkout_timeout = checkout_timeout
+        self._validation_interval = validation_interval
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
         self._curr_size = 0
-        self._curr_wait = 0
-        self._lock = Condition()
+        self._closed = False
+        self._pid = os.getpid()
+        self._lock = Lock()
         self._args, self._kwargs = args, kwargs
-        self._using_conns = []
-        self._idle_conns = [self.__connection() for i in range(core_size)]
+        self._waiters = deque()
+        self._using_conns = set()
+        self._idle_conns = deque()
+        self._retain_size = core_size
+        self._sizing = None
+        if adaptive_sizing:
+            self._sizing = AdaptiveSizing(min_size=core_size, max_size=self._max_size, interval=sizing_interval, cool_down=sizing_cool_down)
+        self.metrics = Metrics()
+        self.metrics.gauge('pool_size', lambda: self._curr_size)
+        self.metrics.gauge('pool_in_use', lambda: len(self._using_conns))
+        self.metrics.gauge('pool_idle', lambda: len(self._idle_conns))
+        self.metrics.gauge('pool_waiting', lambda: len(self._waiters))
+        self.metrics.gauge('pool_retain_size', lambda: self._retain_size)
+        self._lazy_init = lazy_init
+        self._warm_up = warm_up
+        self._warm_up_workers = max(warm_up_workers, 1)
+        self._warm_up_started = False
+
+        if not lazy_init:
+            if warm_up:
+                self.__start_warm_up()
+            else:
+                start = time.time()
+                for i in range(min(core_size, self._max_size)):
+                    self._idle_conns.append(self.__connection())
+                    self._curr_size += 1
+                logger.info('Pool init - opened {} connections in {:.0f}ms'.format(self._curr_size, (time.time() - start) * 1000))
+
+        self._housekeeping_stop = Event()
+        self._housekeeper = None
+        self.__start_housekeeping()
+        _pools.add(self)
+
+    def __start_housekeeping(self):
+        if self._validation_interval and self._validation_interval > 0:
+            self._housekeeper = Thread(target=self.__housekeeping, name='pesto-pool-housekeeper')
+            self._housekeeper.daemon = True
+            self._housekeeper.start()
+
+    def _reset_after_fork(self):
+        '''
+        fork 后在子进程中调用: 父进程的连接只解除引用不关闭(关闭会在共享的 socket 上发送 COM_QUIT),
+        重建锁和后台线程, 需要时在后台重新预热
+        '''
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = Lock()
+        self._waiters = deque()
+        for conn in list(self._idle_conns) + list(self._using_conns):
+            conn.detach()
+        self._idle_conns = deque()
+        self._using_conns = set()
+        self._curr_size = 0
+        self._retain_size = self._core_size
+        if self._sizing is not None:
+            self._sizing = AdaptiveSizing(min_size=self._core_size, max_size=self._max_size, interval=self._sizing.interval, cool_down=self._sizing.cool_down)
+        self.metrics._reset_after_fork()
+        if self._closed:
+            return
+
+        self._housekeeping_stop = Event()
+        self.__start_housekeeping()
+        self._warm_up_started = False
+        if not self._lazy_init or self._warm_up:
+            self.__start_warm_up()
+        logger.info('Pool reset after fork, pid: {}'.format(self._pid))
 
     def __connection(self):
-        while self._curr_size > self._max_size:
-            if self._curr_wait > self._max_wait:
-                raise TooManyConnections
-            self._curr_wait += 1
-            self._lock.wait()
-        self._curr_wait -= 1
-        conn = Connection(target=self._target, *self._args, **self._kwargs)
-        self._curr_size += 1
-        return PoolConnection(pool=self, conn=conn)
+        conn = Connection(self._target, *self._args, **self._kwargs)
+        self.metrics.inc('pool_connections_created')
+        return conn
+
+    def __close(self, conn):
+        self.metrics.inc('pool_connections_closed')
+        conn.close()
+
+    def __start_warm_up(self):
+        self._warm_up_started = True
+        thread = Thread(target=self.warm_up, name='pesto-pool-warm-up')
+        thread.daemon = True
+        thread.start()
+
+    def __warm_up_connection(self):
+        with self._lock:
+            if self._closed or self._curr_size >= self._max_size or self._curr_size >= self._core_size:
+                return False
+            self._curr_size += 1
 
-    def get_connection(self):
-        self._lock.acquire()
         try:
-            if len(self._idle_conns) > 0:
-                conn = self._idle_conns.pop(0)
+            conn = self.__connection()
+        except Exception:
+            with self._lock:
+                self.__release_slot()
+            raise
+
+        close = False
+        with self._lock:
+            if self._closed:
+                close = True
+            elif not self.__hand_over(conn):
+                self._idle_conns.append(conn)
+        if close:
+            self.__close(conn)
+        return True
+
+    def warm_up(self):
+        '''
+        并行建立连接直到 core_size, 返回新建的连接数
+        '''
+        start = time.time()
+        with self._lock:
+            count = max(min(self._core_size, self._max_size) - self._curr_size, 0)
+        if count == 0:
+            return 0
+
+        opened = 0
+        with ThreadPoolExecutor(max_workers=min(count, self._warm_up_workers)) as executor:
+            futures = [executor.submit(self.__warm_up_connection) for i in range(count)]
+            for future in futures:
+                try:
+                    if future.result():
+                        opened += 1
+                except Exception as e:
+                    logger.warning('Pool warm up - open connection error: {}'.format(e))
+
+        logger.info('Pool warm up - opened {} connections in {:.0f}ms, size: {}'.format(opened, (time.time() - start) * 1000, self._curr_size))
+        return opened
+
+    def __expired(self, conn, now):
+        return self._max_lifetime and now - conn.created_at > self._max_lifetime
+
+    def __check_open(self):
+        if self._closed:
+            raise DBError(key=DBErrorType.NOT_CONNECT_ERROR, message='Connection pool is closed.')
+
+    def __hand_over(self, conn):
+        '''
+        把连接(或者新建连接的名额, conn 为 None)交给队首的等待者, 调用前必须持有锁
+        '''
+        if not self._waiters:
+            return False
+        waiter = self._waiters.popleft()
+        if conn is not None:
+            self._using_conns.add(conn)
+        waiter.conn = conn
+        waiter.granted = True
+        waiter.condition.notify()
+        return True
+
+    def __release_slot(self):
+        '''
+        释放一个连接名额, 有等待者时名额直接转交, 调用前必须持有锁
+        '''
+        if self._closed or not self.__hand_over(None):
+            self._curr_size -= 1
+
+    def get_connection(self, timeout=None):
+        '''
+        获取一个连接, 超过 timeout(默认 checkout_timeout) 秒仍拿不到则抛出 TooManyConnections
+        '''
+        if not _AT_FORK and self._pid != os.getpid():
+            self._reset_after_fork()
+        if timeout is None:
+            timeout = self._checkout_timeout
+
+        start = time.time()
+        conn = None
+        create = False
+        waited = False
+        with self._lock:
+            self.__check_open()
+            if not self._waiters and self._idle_conns:
+                conn = self._idle_conns.pop()
+            elif not self._waiters and self._curr_size < self._max_size:
+                self._curr_size += 1
+                create = True
             else:
+                if self._max_wait is not None and len(self._waiters) >= self._max_wait:
+                    self.metrics.inc('pool_checkout_timeouts')
+                    raise TooManyConnections(key=DBErrorType.TOO_MANY_CONNECTIONS_ERROR,
+                                             message='Too many threads waiting for connection, max wait: {}.'.format(self._max_wait))
+                waited = True
+                waiter = _Waiter(self._lock)
+                self._waiters.append(waiter)
+                deadline = None if timeout is None else time.time() + timeout
+                while not waiter.granted:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self._waiters.remove(waiter)
+                        self.metrics.inc('pool_checkout_timeouts')
+                        raise TooManyConnections(key=DBErrorType.TOO_MANY_CONNECTIONS_ERROR,
+                                                 message='Wait for connection timeout after {}s, max size: {}.'.format(timeout, self._max_size))
+                    waiter.condition.wait(remaining)
+
+                self.__check_open()
+                conn = waiter.conn
+                create = conn is None
+
+            if conn is not None:
+                self._using_conns.add(conn)
+
+            if self._sizing is not None:
+                self._sizing.record_checkout(len(self._using_conns) + (1 if create else 0), waited, create, time.time() - start)
+
+        if create:
+            try:
                 conn = self.__connection()
+            except Exception:
+                with self._lock:
+                    self.__release_slot()
+                raise
+            with self._lock:
+                self._using_conns.add(conn)
 
-            self._using_conns.append(conn)
-            self._lock.notify()
-        finally:
-            self._lock.release()
-        return conn
+            if self._warm_up and not self._warm_up_started:
+                self.__start_warm_up()
+
+        self.metrics.observe('pool_checkout_wait_seconds', time.time() - start)
+        return PoolConnection(pool=self, conn=conn)
 
     def return_connection(self, conn):
-        self._lock.acquire()
-        try:
-            if len(self._idle_conns) < self._core_size:
-                conn.reset()
+        conn.reset()
+        conn.last_used_at = time.time()
+
+        close = False
+        with self._lock:
+            if conn not in self._using_conns:
+                return
+            self._using_conns.discard(conn)
+
+            if self._closed:
+                close = True
+            elif self.__expired(conn, conn.last_used_at):
+                self.__release_slot()
+                close = True
+            elif self.__hand_over(conn):
+                pass
+            elif len(self._idle_conns) < self._retain_size:
                 self._idle_conns.append(conn)
             else:
-                conn.close()
+                self._curr_size -= 1
+                close = True
+
+            if self._sizing is not None:
+                self.__resize(conn.last_used_at)
+
+        if close:
+            self.__close(conn)
+
+    def __resize(self, now):
+        '''
+        调用前必须持有锁
+        '''
+        retain_size = self._sizing.evaluate(now, len(self._using_conns))
+        if retain_size is not None:
+            self._retain_size = retain_size
+
+    def get_sizing(self):
+        '''
+        动态调整的当前状态和最近的调整记录
+        '''
+        with self._lock:
+            if self._sizing is None:
+                return {'retain_size': self._retain_size, 'adaptive': False}
+            sizing = self._sizing.snapshot()
+        sizing['adaptive'] = True
+        return sizing
+
+    def open_connection(self):
+        '''
+        打开一个不属于连接池的连接(例如用于 KILL QUERY), 不占用连接池容量, 由调用方关闭
+        '''
+        return Connection(self._target, *self._args, **self._kwargs)
+
+    def discard_connection(self, conn):
+        '''
+        丢弃一个已损坏的连接, 不再放回连接池
+        '''
+        with self._lock:
+            if conn not in self._using_conns:
+                return
+            self._using_conns.discard(conn)
+            self.__release_slot()
+
+        self.__close(conn)
+
+    def __housekeeping(self):
+        while not self._housekeeping_stop.wait(self._validation_interval):
+            try:
+                self.housekeeping()
+            except Exception as e:
+                logger.warning('Pool housekeeping error: {}'.format(e))
+
+    def housekeeping(self):
+        '''
+        关闭空闲超时和超过最长生命周期的连接, 并校验剩余的空闲连接
+        从最久未使用的一端逐个取出检查, 检查期间不持有锁, 不阻塞借出
+        '''
+        evicted = 0
+        invalid = 0
+        valid_conns = []
+        with self._lock:
+            count = len(self._idle_conns)
+
+        for i in range(count):
+            with self._lock:
+                if self._closed or not self._idle_conns:
+                    break
+                conn = self._idle_conns.popleft()
+                self._using_conns.add(conn)
+
+            now = time.time()
+            if self.__expired(conn, now) or (self._idle_timeout and now - conn.last_used_at > self._idle_timeout):
+                evicted += 1
+                self.discard_connection(conn)
+            elif not conn.ping():
+                invalid += 1
+                self.discard_connection(conn)
+            else:
+                valid_conns.append(conn)
+
+        # 校验通过的连接放回最久未使用的一端, 超过保留数的空闲连接关闭
+        close_conns = []
+        with self._lock:
+            for conn in reversed(valid_conns):
+                if conn not in self._using_conns:
+                    continue
+                self._using_conns.discard(conn)
+                if self._closed:
+                    close_conns.append(conn)
+                elif not self.__hand_over(conn):
+                    self._idle_conns.appendleft(conn)
+
+            if self._sizing is not None:
+                self.__resize(time.time())
+            while len(self._idle_conns) > self._retain_size:
+                close_conns.append(self._idle_conns.popleft())
+                self._curr_size -= 1
+                evicted += 1
+        for conn in close_conns:
+            self.__close(conn)
 
-            self._lock.notify()
-        finally:
-            self._lock.release()
+        if evicted or invalid:
+            logger.info('Pool housekeeping - evicted: {}, invalid: {}, size: {}, idle: {}'.format(evicted, invalid, self._curr_size, len(self._idle_conns)))
+
+    def in_use_count(self):
+        return len(self._using_conns)
+
+    def max_size(self):
+        return self._max_size
+
+    def get_metrics(self):
+        return self.metrics.snapshot()
 
     def close(self):
-        self._lock.acquire()
-        try:
-            while self._idle_conns:  # close all idle connections
-                conn = self._idle_conns.pop(0)
-                try:
-                    conn.close()
-                    self._curr_size -= 1
-                except Exception:
-                    pass
-            while self._using_conns:
-                conn = self._using_conns.pop(0)
-                try:
-                    conn.close()
-                    self._curr_size -= 1
-                except Exception:
-                    pass
+        self._housekeeping_stop.set()
+        with self._lock:
+            self._closed = True
+            conns = list(self._idle_conns) + list(self._using_conns)
+            self._idle_conns.clear()
+            self._using_conns.clear()
+            self._curr_size = 0
 
-            self._lock.notifyAll()
-        finally:
-            self._lock.release()
+            while self._waiters:
+                self.__hand_over(None)
+
+        for conn in conns:
+            try:
+                self.__close(conn)
+            except Exception:
+                pass
 
     def __del__(self):
         try:
@@ -92,14 +455,29 @@ class ConnectionPool(object):
 
 
 class PoolConnection(object):
+    '''
+    每次借出连接时创建的包装对象, close 时归还连接池, 重复 close 无副作用
+    '''
+
     def __init__(self, pool, conn):
         self._pool = pool
         self._conn = conn
 
+    @property
+    def pool(self):
+        return self._pool
+
     def close(self):
         if self._conn:
-            self._pool.return_connection(self._conn)
+            conn = self._conn
+            self._conn = None
+            self._pool.return_connection(conn)
+
+    def discard(self):
+        if self._conn:
+            conn = self._conn
             self._conn = None
+            self._pool.discard_connection(conn)
 
     def __getattr__(self, name):
         if self._conn:
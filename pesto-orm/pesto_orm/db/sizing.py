@@ -0,0 +1,83 @@
+import time
+from collections import deque
+
+from pesto_common.log.logger_factory import LoggerFactory
+
+logger = LoggerFactory.get_logger('db.sizing')
+
+
+class AdaptiveSizing(object):
+    '''
+    根据借出连接时的等待和新建情况, 动态调整连接池保留的空闲连接数(retain_size)
+    retain_size 始终在 [min_size, max_size] 之间:
+    一个统计周期内出现等待或新建连接超过 grow_threshold 时扩大到本周期的峰值使用数,
+    持续 cool_down 秒没有等待和新建时每个周期缩小 shrink_step
+    所有方法都在连接池的锁内调用
+    '''
+
+    def __init__(self, min_size, max_size, interval=10, cool_down=60, grow_threshold=2, shrink_step=1, history_size=20):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.interval = interval
+        self.cool_down = cool_down
+        self.grow_threshold = grow_threshold
+        self.shrink_step = max(shrink_step, 1)
+        self.retain_size = min_size
+        self.history = deque(maxlen=history_size)
+
+        self._window_start = time.time()
+        self._last_pressure = self._window_start
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._created = 0
+        self._peak_in_use = 0
+
+    def record_checkout(self, in_use, waited, created, wait_seconds=0.0):
+        self._checkouts += 1
+        if waited:
+            self._waits += 1
+            self._wait_seconds += wait_seconds
+        if created:
+            self._created += 1
+        if in_use > self._peak_in_use:
+            self._peak_in_use = in_use
+
+    def evaluate(self, now, in_use):
+        '''
+        统计周期结束时计算新的 retain_size, 没有变化返回 None
+        '''
+        if now - self._window_start < self.interval:
+            return None
+
+        stats = {'checkouts': self._checkouts, 'waits': self._waits, 'wait_seconds': round(self._wait_seconds, 6),
+                 'created': self._created, 'peak_in_use': max(self._peak_in_use, in_use)}
+        old_size = self.retain_size
+        new_size = old_size
+        reason = None
+
+        if self._waits > 0 or self._created >= self.grow_threshold:
+            self._last_pressure = now
+            new_size = min(self.max_size, max(old_size + 1, stats['peak_in_use']))
+            reason = 'grow'
+        elif now - self._last_pressure >= self.cool_down and old_size > self.min_size:
+            new_size = max(self.min_size, old_size - self.shrink_step, stats['peak_in_use'])
+            reason = 'shrink'
+
+        self._window_start = now
+        self._checkouts = self._waits = self._created = self._peak_in_use = 0
+        self._wait_seconds = 0.0
+
+        if new_size == old_size:
+            return None
+
+        self.retain_size = new_size
+        decision = {'time': now, 'action': reason, 'from': old_size, 'to': new_size}
+        decision.update(stats)
+        self.history.append(decision)
+        logger.info('Pool sizing {} retain size {} -> {}, stats: {}'.format(reason, old_size, new_size, stats))
+        return new_size
+
+    def snapshot(self):
+        return {'retain_size': self.retain_size, 'min_size': self.min_size, 'max_size': self.max_size, 'interval': self.interval,
+                'cool_down': self.cool_down, 'history': list(self.history)}
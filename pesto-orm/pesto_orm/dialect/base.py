@@ -47,6 +47,9 @@ class Dialect(object):
 class DefaultDialect(Dialect):
     __metaclass__ = ABCMeta
 
+    # 列式查询时 cursor.description 字段类型码到 numpy dtype 的映射, 没有映射的列为 object
+    columnar_types = {}
+
     select_pattern = re.compile(r'^\s*SELECT\s+', re.M | re.I)
     order_pattern = re.compile(r'\s+ORDER\s+BY\s+', re.M | re.I)
     group_pattern = re.compile(r'\s+GROUP\s+BY\s+', re.M | re.I)
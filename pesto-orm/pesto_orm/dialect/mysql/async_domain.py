@@ -0,0 +1,92 @@
+# coding=utf-8
+'''
+mysql 的 asyncio 领域模型和仓库, 默认驱动为 aiomysql(需单独安装),
+也可以通过 set_async_executor 使用其他兼容驱动
+'''
+import threading
+
+from pesto_common.log.logger_factory import LoggerFactory
+from pesto_orm.core.async_executor import AsyncExecutor
+from pesto_orm.core.async_model import AsyncBaseModel
+from pesto_orm.core.async_repository import AsyncBaseRepository
+from pesto_orm.core.base import db_config
+from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.query_stats import QueryStats
+from pesto_orm.db.async_pool import AsyncConnectionPool
+from pesto_orm.dialect.mysql.domain import MySQLDialect
+
+logger = LoggerFactory.get_logger('dialect.mysql.async_domain')
+
+mysqlAsyncDialect = MySQLDialect()
+
+_lock = threading.Lock()
+_async_executor = None
+
+
+def set_async_executor(executor):
+    '''
+    替换默认的异步执行器, 例如使用其他驱动或者测试用的假驱动
+    '''
+    global _async_executor
+    _async_executor = executor
+
+
+def get_async_executor():
+    global _async_executor
+    if _async_executor is None:
+        with _lock:
+            if _async_executor is None:
+                try:
+                    import aiomysql
+                except ImportError:
+                    raise DBError(key=DBErrorType.NOT_CONNECT_ERROR, message='Async mysql executor needs aiomysql, please install it first.')
+
+                logger.info('Init async db pool info - host: {}, port: {}, database: {}'.format(db_config.get('host'), db_config.get('port'), db_config.get('database')))
+                pool = AsyncConnectionPool(target=aiomysql,
+                                           core_size=db_config.get('core_size', 20),
+                                           max_size=db_config.get('max_size', 100),
+                                           checkout_timeout=db_config.get('checkout_timeout', 30),
+                                           host=db_config.get('host'),
+                                           port=int(db_config.get('port') or 3306),
+                                           user=db_config.get('user'),
+                                           password=db_config.get('password') or '',
+                                           db=db_config.get('database'),
+                                           charset=db_config.get('charset', 'utf8mb4'),
+                                           autocommit=True)
+                query_stats = None
+                if db_config.get('query_stats_size', 1000) > 0:
+                    query_stats = QueryStats(max_fingerprints=db_config.get('query_stats_size', 1000), slow_threshold_ms=db_config.get('slow_threshold_ms', 0))
+                _async_executor = AsyncExecutor(pool=pool, query_stats=query_stats)
+    return _async_executor
+
+
+def async_transaction():
+    '''
+    async with async_transaction():
+        await model.save()
+    '''
+    return get_async_executor().transaction()
+
+
+class MysqlAsyncBaseModel(AsyncBaseModel):
+
+    def __init__(self, db_name=None, table_name=None, table_alias=None, primary_key='id'):
+        super(MysqlAsyncBaseModel, self).__init__(db_name, table_name, table_alias, primary_key)
+
+    def get_dialect(self):
+        return mysqlAsyncDialect
+
+    def get_executor(self):
+        return get_async_executor()
+
+
+class MysqlAsyncBaseRepository(AsyncBaseRepository):
+
+    def __init__(self, model_class=None, shard_key=None, shard_router=None):
+        super(MysqlAsyncBaseRepository, self).__init__(model_class, shard_key=shard_key, shard_router=shard_router)
+
+    def get_dialect(self):
+        return mysqlAsyncDialect
+
+    def get_executor(self):
+        return get_async_executor()
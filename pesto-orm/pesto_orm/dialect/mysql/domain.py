@@ -1,11 +1,13 @@
 # coding=utf-8
+import functools
 import re
+import time
 import traceback
 
 from pesto_common.config.configer import Configer
 from pesto_common.log.logger_factory import LoggerFactory
 from pesto_orm.core.base import db_config
-from pesto_orm.core.executor import ExecutorFactory
+from pesto_orm.core.executor import ExecutorFactory, backoff_delay
 from pesto_orm.core.model import BaseModel
 from pesto_orm.core.repository import BaseRepository
 from pesto_orm.dialect.base import DefaultDialect
@@ -14,6 +16,24 @@ logger = LoggerFactory.get_logger('dialect.mysql.domain')
 
 
 class MySQLDialect(DefaultDialect):
+    # mysql 字段类型码(mysql.connector.constants.FieldType) 到 numpy dtype 的映射, DECIMAL 转为 float64
+    columnar_types = {
+        0: 'float64',  # DECIMAL
+        1: 'int64',  # TINY
+        2: 'int64',  # SHORT
+        3: 'int64',  # LONG
+        4: 'float32',  # FLOAT
+        5: 'float64',  # DOUBLE
+        7: 'datetime64[us]',  # TIMESTAMP
+        8: 'int64',  # LONGLONG
+        9: 'int64',  # INT24
+        10: 'datetime64[D]',  # DATE
+        11: 'timedelta64[us]',  # TIME
+        12: 'datetime64[us]',  # DATETIME
+        13: 'int64',  # YEAR
+        14: 'datetime64[D]',  # NEWDATE
+        246: 'float64',  # NEWDECIMAL
+    }
 
     def get_db_type(self):
         return 'mysql'
@@ -74,8 +94,9 @@ class MysqlBaseModel(BaseModel):
 
 class MysqlBaseRepository(BaseRepository):
 
-    def __init__(self, model_class=None):
-        super(MysqlBaseRepository, self).__init__(model_class)
+    def __init__(self, model_class=None, shard_key=None, shard_router=None, cache_ttl=None, coalesce=False, timeout=None):
+        super(MysqlBaseRepository, self).__init__(model_class, shard_key=shard_key, shard_router=shard_router, cache_ttl=cache_ttl, coalesce=coalesce,
+                                                  timeout=timeout)
 
     def get_dialect(self):
         return mysqlDialect
@@ -84,8 +105,30 @@ class MysqlBaseRepository(BaseRepository):
         return mysqlExecutor
 
 
-def transaction(rollback_exceptions=[]):
+# innodb 死锁和锁等待超时, 重新执行通常可以成功
+DEADLOCK_ERROR_CODES = (1213, 1205)
+# 服务端已经回滚了整个事务的错误(死锁), 保存点随之失效, 嵌套事务不能在保存点上重试, 交给最外层处理
+TRANSACTION_ABORT_ERROR_CODES = (1213,)
+
+
+def _error_code(e):
+    code = getattr(e, 'code', None)
+    return getattr(e, 'errno', None) if code is None else code
+
+
+def transaction(rollback_exceptions=[], retry_on=(), max_attempts=3, backoff=0.05, max_backoff=1.0):
+    '''
+    :param retry_on: 需要重新执行整个方法的错误码, 例如 DEADLOCK_ERROR_CODES, 回滚后等待退避时间再重新开启事务执行
+    :param max_attempts: retry_on 不为空时最多执行的次数
+    :param backoff: 初始退避时间(秒), 每次翻倍并加随机抖动, 不超过 max_backoff
+    每个方法的重试次数见执行器指标 transaction_retries(按方法名和错误码), 重试用尽时回滚并抛出最后一次的异常, 见 transaction_retries_exhausted
+    在另一个事务方法中调用时为嵌套事务(保存点): 出错只回滚到保存点, 不提交也不关闭外层连接;
+    死锁时服务端已经回滚整个事务, 嵌套事务直接抛出异常, 由最外层回滚和重试
+    '''
+
     def wrap(func):
+        func_name = '{}.{}'.format(func.__module__, getattr(func, '__qualname__', func.__name__))
+
         def handle(result, **kwargs):  # 真实执行原方法.
             func = kwargs['func']
             args = kwargs['args']
@@ -94,24 +137,48 @@ def transaction(rollback_exceptions=[]):
             logger.info('Transaction method: ' + func.__name__)
             result.append(return_value)
 
+        @functools.wraps(func)
         def to_do(*args, **kwargs):
             new_kwargs = {'func': func, 'args': args, 'kwargs': kwargs}
 
-            result = []
-            try:
-                mysqlExecutor.begin_transaction()
-                handle(result, **new_kwargs)
-                mysqlExecutor.commit_transaction()
-            except Exception as e:
-
-                if len(rollback_exceptions) == 0 or e.__class__ in rollback_exceptions:
-                    mysqlExecutor.rollback_transaction()
-                    logger.error('Method execute error. method: ' + str(func.__name__) + ',  error:' + traceback.format_exc() + ', transaction roll back.')
-                else:
+            nested = mysqlExecutor.in_transaction()
+            attempts = max_attempts if retry_on else 1
+            attempt = 0
+            while True:
+                attempt += 1
+                result = []
+                retry = False
+                try:
+                    mysqlExecutor.begin_transaction()
+                    handle(result, **new_kwargs)
                     mysqlExecutor.commit_transaction()
-                    raise e
-            finally:
-                mysqlExecutor.close_transaction()
+                    return result[0]
+                except Exception as e:
+                    code = _error_code(e)
+                    if nested and code in TRANSACTION_ABORT_ERROR_CODES:
+                        raise
+                    if code in retry_on and attempt < attempts:
+                        mysqlExecutor.rollback_transaction()
+                        mysqlExecutor.metrics.inc('transaction_retries', labels={'func': func_name, 'code': code})
+                        retry = True
+                    elif len(rollback_exceptions) == 0 or e.__class__ in rollback_exceptions:
+                        mysqlExecutor.rollback_transaction()
+                        logger.error('Method execute error. method: ' + str(func.__name__) + ',  error:' + traceback.format_exc() + ', transaction roll back.')
+                        if code in retry_on:
+                            # 重试用尽时抛出, 避免调用方把一直失败的死锁当作成功
+                            mysqlExecutor.metrics.inc('transaction_retries_exhausted', labels={'func': func_name, 'code': code})
+                            raise
+                    else:
+                        mysqlExecutor.commit_transaction()
+                        raise e
+                finally:
+                    mysqlExecutor.close_transaction()
+
+                if not retry:
+                    return None
+                delay = backoff_delay(attempt, backoff, max_backoff)
+                logger.warning('Transaction method {} failed with {}, retry {} after {:.0f}ms'.format(func_name, code, attempt, delay * 1000))
+                time.sleep(delay)
 
         return to_do
 
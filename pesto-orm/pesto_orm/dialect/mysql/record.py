@@ -3,8 +3,8 @@ from pesto_orm.dialect.mysql.domain import MysqlBaseRepository
 
 class MysqlRecordRepository(MysqlBaseRepository):
 
-    def __init__(self, db_name=None, table_name=None, table_alias=None, primary_key='id', sequence=None, model_class=None):
-        MysqlBaseRepository.__init__(self, model_class=model_class)
+    def __init__(self, db_name=None, table_name=None, table_alias=None, primary_key='id', sequence=None, model_class=None, cache_ttl=None, coalesce=False, timeout=None):
+        MysqlBaseRepository.__init__(self, model_class=model_class, cache_ttl=cache_ttl, coalesce=coalesce, timeout=timeout)
         self.db_name = db_name
         self.table_name = table_name
         self.table_alias = table_alias
@@ -17,5 +17,6 @@ setup(name='pesto-orm',
       packages=find_packages(),
       include_package_data=True,
       install_requires=requirements,
+      extras_require={'numpy': ['numpy']},
       platforms=['all']
       )
@@ -0,0 +1,77 @@
+import pytest
+
+from pesto_orm.core.executor import Executor
+from pesto_orm.core.model import BaseModel
+from pesto_orm.core.repository import BaseRepository
+from pesto_orm.db.pool import ConnectionPool
+from pesto_orm.dialect.base import DefaultDialect
+from stub_db import StubDatabase
+
+CREATE_EXAMPLE_SQL = 'CREATE TABLE example (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, amount INTEGER)'
+
+
+class StubDialect(DefaultDialect):
+
+    def get_db_type(self):
+        return 'mysql'
+
+    def paginate_with(self, sql, page_number, page_size):
+        return '%s LIMIT %d OFFSET %d' % (sql, page_size, page_size * (page_number - 1))
+
+
+dialect = StubDialect()
+
+
+class Example(BaseModel):
+    executor = None
+
+    def __init__(self):
+        super(Example, self).__init__(table_name='example')
+
+    def get_dialect(self):
+        return dialect
+
+    def get_executor(self):
+        return Example.executor
+
+
+class ExampleRepository(BaseRepository):
+
+    def __init__(self, executor, **kwargs):
+        self.executor = executor
+        super(ExampleRepository, self).__init__(Example, **kwargs)
+
+    def get_dialect(self):
+        return dialect
+
+    def get_executor(self):
+        return self.executor
+
+
+@pytest.fixture
+def database():
+    database = StubDatabase()
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def pool(database):
+    pool = ConnectionPool(target=database, core_size=1, max_size=3, checkout_timeout=1, validation_interval=0)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def executor(pool):
+    executor = Executor(pool, max_retries=0)
+    executor.execute(CREATE_EXAMPLE_SQL)
+    Example.executor = executor
+    yield executor
+    executor.close()
+    Example.executor = None
+
+
+@pytest.fixture
+def repository(executor):
+    return ExampleRepository(executor)
@@ -0,0 +1,166 @@
+'''
+测试用的 DB-API 桩, 用 sqlite 共享内存库模拟 mysql.connector 的连接、游标和错误码
+每个 StubDatabase 是一个独立的库, 作为连接池的 target(提供 connect)
+'''
+import itertools
+import re
+import sqlite3
+import time
+
+_connection_ids = itertools.count(1)
+_database_ids = itertools.count(1)
+
+_load_data_pattern = re.compile(r'^LOAD DATA LOCAL INFILE %s INTO TABLE (\w+)\b.*\((.*)\)\s*$', re.I | re.S)
+
+
+class Error(Exception):
+    def __init__(self, msg='', errno=None):
+        super(Error, self).__init__(msg)
+        self.msg = msg
+        self.errno = errno
+
+
+class StubCursor(object):
+
+    def __init__(self, conn, dictionary=False, buffered=None):
+        self._conn = conn
+        self._cursor = conn.db.cursor()
+        self.dictionary = dictionary
+        self.rowcount = -1
+        self.lastrowid = None
+
+    @property
+    def description(self):
+        description = self._cursor.description
+        if description is None:
+            return None
+        return [(column[0], 253, None, None, None, None, 1, 0) for column in description]
+
+    def execute(self, sql, params=None):
+        database = self._conn.database
+        if self._conn.closed:
+            raise Error('MySQL Connection not available.', errno=2013)
+        if self._conn.fail_next:
+            self._conn.fail_next -= 1
+            raise Error('Lost connection to MySQL server during query', errno=2013)
+        database.statements.append(sql)
+        if database.delay:
+            time.sleep(database.delay)
+        if sql.upper().startswith(('KILL', 'SET')):
+            return
+
+        match = _load_data_pattern.match(sql)
+        if match is not None:
+            self.__load_data(match.group(1), match.group(2), params[0])
+            return
+
+        self._cursor.execute(sql.replace('%s', '?'), tuple(params) if params else ())
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+
+    def __load_data(self, table, columns, path):
+        if not self._conn.database.local_infile:
+            raise Error('Loading local data is disabled; this must be enabled on both the client and server sides', errno=3948)
+        with open(path, 'rb') as _file:
+            rows = [[None if value == b'\\N' else value.decode('utf-8') for value in line.rstrip(b'\n').split(b'\t')] for line in _file]
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, columns, ', '.join(['?'] * len(columns.split(','))))
+        self._cursor.executemany(sql, rows)
+        self.rowcount = len(rows)
+
+    def executemany(self, sql, params):
+        self._conn.database.statements.append(sql)
+        self._cursor.executemany(sql.replace('%s', '?'), params)
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+
+    def __convert(self, row):
+        if row is None:
+            return None
+        if self.dictionary:
+            return dict(zip([column[0] for column in self._cursor.description], row))
+        return tuple(row)
+
+    def fetchone(self):
+        return self.__convert(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self.__convert(row) for row in self._cursor.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [self.__convert(row) for row in self._cursor.fetchmany(size)]
+
+    def close(self):
+        self._cursor.close()
+
+
+class StubConnection(object):
+
+    def __init__(self, database, **kwargs):
+        self.database = database
+        self.kwargs = kwargs
+        self.db = sqlite3.connect(database.uri, uri=True, check_same_thread=False, isolation_level=None)
+        self.closed = False
+        self.connection_id = next(_connection_ids)
+        self.fail_next = 0
+
+    def cursor(self, *args, **kwargs):
+        return StubCursor(self, **kwargs)
+
+    def is_connected(self):
+        return not self.closed
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if self.closed:
+            raise Error('MySQL server has gone away', errno=2006)
+
+    def start_transaction(self):
+        self.db.execute('BEGIN')
+
+    def begin(self):
+        # aiomysql 的接口, 供 AsyncConnectionPool 使用
+        self.start_transaction()
+
+    def commit(self):
+        if self.db.in_transaction:
+            self.db.execute('COMMIT')
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.db.close()
+
+
+class StubDatabase(object):
+    '''
+    连接池的 target, connect() 返回 StubConnection
+    statements: 执行过的语句, connections: 建立过的连接
+    local_infile: 为 False 时 LOAD DATA LOCAL INFILE 返回 3948, fail_connect: 接下来多少次 connect 失败(2003), delay: 每条语句的耗时(秒)
+    '''
+
+    def __init__(self):
+        self.uri = 'file:pesto_stub_{}?mode=memory&cache=shared'.format(next(_database_ids))
+        # 共享内存库在最后一个连接关闭时删除, 保留一个连接
+        self._keep = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        self.statements = []
+        self.connections = []
+        self.local_infile = True
+        self.fail_connect = 0
+        self.delay = 0
+
+    def connect(self, **kwargs):
+        if self.fail_connect:
+            self.fail_connect -= 1
+            raise Error("Can't connect to MySQL server", errno=2003)
+        conn = StubConnection(self, **kwargs)
+        self.connections.append(conn)
+        return conn
+
+    def query(self, sql):
+        return self._keep.execute(sql).fetchall()
+
+    def close(self):
+        self._keep.close()
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from conftest import CREATE_EXAMPLE_SQL, Example, StubDialect
+from pesto_orm.core.async_executor import AsyncExecutor
+from pesto_orm.core.async_repository import AsyncBaseRepository
+from pesto_orm.core.error import DBError
+from pesto_orm.db.async_pool import AsyncConnectionPool
+
+INSERT_SQL = 'INSERT INTO example (name, amount) VALUES (%s, %s)'
+
+
+class AsyncExampleRepository(AsyncBaseRepository):
+
+    def __init__(self, executor):
+        self.executor = executor
+        super(AsyncExampleRepository, self).__init__(Example)
+
+    def get_dialect(self):
+        return StubDialect()
+
+    def get_executor(self):
+        return self.executor
+
+
+def run(database, action):
+    async def main():
+        executor = AsyncExecutor(AsyncConnectionPool(target=database, core_size=1, max_size=3, checkout_timeout=1))
+        await executor.execute(CREATE_EXAMPLE_SQL)
+        try:
+            return await action(executor, AsyncExampleRepository(executor))
+        finally:
+            await executor.close()
+
+    return asyncio.run(main())
+
+
+def test_async_get_many(database):
+    async def action(executor, repository):
+        for name in ('a', 'b', 'c'):
+            await executor.insert(INSERT_SQL, (name, 1))
+        return await repository.get_many([3, '1', 4, 3], columns=['name'], chunk_size=2)
+
+    models = run(database, action)
+    assert [model.get_attr('name') if model is not None else None for model in models] == ['c', 'a', None, 'c']
+
+
+def test_async_unsupported_operations(database):
+    async def action(executor, repository):
+        for call in (lambda: repository.bulk_load([('a', 1)], columns=['name', 'amount']), lambda: repository.query_columnar_by()):
+            with pytest.raises(DBError) as e:
+                call()
+            assert e.value.code == 'OPERATE_NOT_SUPPORT_ERROR'
+
+    run(database, action)
+
+
+def test_async_transaction_refuses_concurrent_tasks(database):
+    async def action(executor, repository):
+        async with executor.transaction():
+            await executor.insert(INSERT_SQL, ('a', 1))
+            results = await asyncio.gather(executor.select('SELECT * FROM example'), return_exceptions=True)
+            assert isinstance(results[0], DBError) and results[0].code == 'OPERATE_NOT_SUPPORT_ERROR'
+            return await executor.select('SELECT name FROM example')
+
+    assert run(database, action) == [{'name': 'a'}]
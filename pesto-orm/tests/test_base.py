@@ -0,0 +1,13 @@
+from pesto_common.config.configer import Configer
+from pesto_orm.core.base import _get_bool
+
+
+def test_get_bool_parses_config_strings(monkeypatch):
+    values = {'db.show_sql': 'false', 'db.raise_on_warnings': ' True ', 'db.autocommit': '0', 'db.warm_up': True}
+    monkeypatch.setattr(Configer, 'get', staticmethod(lambda name, default=None: values.get(name, default)))
+
+    assert _get_bool('db.show_sql') is False
+    assert _get_bool('db.raise_on_warnings') is True
+    assert _get_bool('db.autocommit', True) is False
+    assert _get_bool('db.warm_up') is True
+    assert _get_bool('db.lazy_init', True) is True
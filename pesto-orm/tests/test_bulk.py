@@ -0,0 +1,80 @@
+import pytest
+
+from pesto_common.utils.file_utils import FileUtils
+from pesto_orm.core.bulk import read_source
+from pesto_orm.core.error import DBError
+from pesto_orm.core.statement import statement_tables
+
+COUNT_SQL = 'SELECT count(*) AS n FROM example'
+
+
+def test_load_data_tables():
+    assert statement_tables('LOAD DATA LOCAL INFILE %s INTO TABLE example CHARACTER SET utf8mb4 (name)') == ('example',)
+    assert statement_tables('INSERT INTO example (name) VALUES (%s)') == ('example',)
+
+
+def test_load_data_invalidates_query_cache(executor, tmp_path):
+    assert executor.select(COUNT_SQL, cache_ttl=60)[0]['n'] == 0
+
+    path = tmp_path / 'example.tsv'
+    path.write_bytes(b'a\t1\nb\t\\N\n')
+    assert executor.load_data(str(path), 'example', ['name', 'amount']) == 2
+
+    assert executor.select(COUNT_SQL, cache_ttl=60)[0]['n'] == 2
+
+
+def test_bulk_load_rows(repository, database):
+    result = repository.bulk_load(({'name': 'n{}'.format(i), 'amount': i} for i in range(25)), chunk_rows=10)
+
+    assert (result['rows'], result['rowcount'], result['method']) == (25, 25, 'load_data')
+    assert database.query('SELECT count(*), sum(amount) FROM example') == [(25, 300)]
+
+
+def test_bulk_load_fallback_to_insert(repository, database):
+    database.local_infile = False
+
+    result = repository.bulk_load([('a', 1), ('b', 2), ('c', 3)], columns=['name', 'amount'], chunk_rows=2, insert_chunk_size=1)
+
+    assert (result['rows'], result['rowcount'], result['method']) == (3, 3, 'insert')
+    assert database.query('SELECT name FROM example ORDER BY id') == [('a',), ('b',), ('c',)]
+
+
+def test_bulk_load_csv(repository, database, tmp_path):
+    path = str(tmp_path / 'example.csv')
+    FileUtils.save_dict([{'name': 'a', 'amount': 1}, {'name': 'b', 'amount': None}], path)
+
+    assert repository.bulk_load(path)['rowcount'] == 2
+    assert database.query('SELECT name, amount FROM example ORDER BY id') == [('a', 1), ('b', None)]
+
+
+def test_read_csv_opens_file_lazily(tmp_path, monkeypatch):
+    path = str(tmp_path / 'example.csv')
+    FileUtils.save_dict([{'name': 'a'}], path)
+    opened = []
+    original = open
+
+    def counting_open(*args, **kwargs):
+        _file = original(*args, **kwargs)
+        opened.append(_file)
+        return _file
+
+    monkeypatch.setattr('builtins.open', counting_open)
+    header, rows = read_source(path)
+
+    assert header == ['name']
+    assert all(_file.closed for _file in opened)
+    assert list(rows) == [['a']]
+    assert all(_file.closed for _file in opened)
+
+
+@pytest.mark.parametrize('local_infile', [True, False])
+def test_bulk_load_quotes_csv_header(repository, database, tmp_path, local_infile):
+    database.local_infile = local_infile
+    path = tmp_path / 'example.csv'
+    path.write_text('name,"amount) SET name = 1; DROP TABLE example; --"\na,1\n', encoding='utf-8')
+
+    with pytest.raises(DBError):
+        repository.bulk_load(str(path))
+
+    assert any('`amount) SET name = 1; DROP TABLE example; --`' in sql for sql in database.statements)
+    assert database.query('SELECT count(*) FROM example') == [(0,)]
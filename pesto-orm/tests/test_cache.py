@@ -0,0 +1,81 @@
+import pytest
+
+from conftest import CREATE_EXAMPLE_SQL, Example, ExampleRepository, dialect
+from pesto_orm.core.cache import LocalEntityCache
+from pesto_orm.core.executor import Executor
+from pesto_orm.core.model import BaseModel
+
+INSERT_SQL = 'INSERT INTO example (name, amount) VALUES (%s, %s)'
+
+
+@pytest.fixture
+def cached_repository(pool):
+    executor = Executor(pool, max_retries=0, entity_cache=LocalEntityCache(max_size=100))
+    executor.execute(CREATE_EXAMPLE_SQL)
+    executor.insert(INSERT_SQL, ('a', 1))
+    yield ExampleRepository(executor)
+    executor.close()
+
+
+def example(id):
+    model = Example()
+    model.set_attrs({'id': id})
+    return model
+
+
+def test_entity_cache_evicts_str_and_int_keys(cached_repository):
+    # 以字符串主键查询放入缓存, 再以整数主键删除
+    assert cached_repository.query_first_by(where='`id` = %s', params=('1',)).get_attr('name') == 'a'
+    assert cached_repository.delete_by(models=[example(1)]) == 1
+
+    assert cached_repository.query_first_by(where='`id` = %s', params=('1',)) is None
+    assert cached_repository.get_many(['1', 1]) == [None, None]
+
+
+def test_get_many_cached_rows_evicted_by_update(cached_repository):
+    executor = cached_repository.get_executor()
+    # get_many 按数据库返回的整数主键放入缓存, 以字符串主键更新
+    assert cached_repository.get_many([1])[0].get_attr('name') == 'a'
+    assert executor.peek_entity('example', '1')['name'] == 'a'
+
+    assert cached_repository.update(sql='UPDATE example SET name = %s WHERE id = %s', params=('b', '1'), entity_keys=['1']) == 1
+
+    assert executor.peek_entity('example', 1) is None
+    assert cached_repository.query_first_by(where='`id` = %s', params=(1,)).get_attr('name') == 'b'
+
+
+class UserInfo(BaseModel):
+    executor = None
+
+    def __init__(self):
+        super(UserInfo, self).__init__(table_name='`main`.`UserInfo`')
+
+    def get_dialect(self):
+        return dialect
+
+    def get_executor(self):
+        return UserInfo.executor
+
+
+def test_entity_cache_evicts_mixed_case_schema_table(pool):
+    executor = Executor(pool, max_retries=0, entity_cache=LocalEntityCache(max_size=100))
+    executor.execute('CREATE TABLE UserInfo (id INTEGER PRIMARY KEY, name TEXT)')
+    executor.insert('INSERT INTO `main`.`UserInfo` (id, name) VALUES (%s, %s)', (1, 'a'))
+    UserInfo.executor = executor
+    try:
+        user = UserInfo()
+        user.set_attr('id', 1)
+        assert user.query().get_attr('name') == 'a'
+        assert executor.peek_entity('`main`.`UserInfo`', 1)['name'] == 'a'
+
+        user.set_attr('name', 'b')
+        assert user.update() == 1
+        assert executor.peek_entity('UserInfo', 1)['name'] == 'b'
+
+        assert user.delete() == 1
+        assert executor.peek_entity('`main`.`UserInfo`', 1) is None
+        assert not executor.get_entity('`main`.`UserInfo`', 1, lambda: executor.select_first('SELECT * FROM UserInfo WHERE id = %s', (1,)))
+    finally:
+        UserInfo.executor = None
+        executor.close()
+
@@ -0,0 +1,29 @@
+from pesto_orm.db.connection import Connection
+
+
+def test_close_in_transaction_rolls_back_and_closes(database):
+    database.query('CREATE TABLE example (id INTEGER)')
+    conn = Connection(database)
+    raw = database.connections[-1]
+    conn.begin()
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO example (id) VALUES (1)')
+
+    conn.close()
+
+    assert raw.closed
+    assert database.query('SELECT count(*) FROM example') == [(0,)]
+
+
+def test_close_closes_when_rollback_fails(database):
+    conn = Connection(database)
+    raw = database.connections[-1]
+    conn.begin()
+
+    def fail():
+        raise RuntimeError('rollback failed')
+
+    raw.rollback = fail
+    conn.close()
+
+    assert all(conn.closed for conn in database.connections)
@@ -0,0 +1,90 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork') or not hasattr(os, 'register_at_fork'), reason='fork not supported')
+
+
+def run_in_child(check, timeout=5):
+    '''
+    fork 后在子进程中执行 check, 返回子进程是否成功; timeout 秒内没有结束(死锁, 可能发生在 fork 回调中)时结束子进程并返回 False
+    '''
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            check()
+            code = 0
+        finally:
+            os._exit(code)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished:
+            return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        time.sleep(0.01)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return False
+
+
+def hold_lock(lock):
+    '''
+    另一个线程持有 lock, 返回释放锁的 Event
+    '''
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with lock:
+            acquired.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.daemon = True
+    thread.start()
+    acquired.wait()
+    return release
+
+
+def test_pool_metrics_after_fork_with_held_lock(pool):
+    release = hold_lock(pool.metrics._lock)
+    try:
+        def check():
+            conn = pool.get_connection()
+            conn.close()
+            assert pool.metrics.get_counter('pool_connections_created') >= 1
+
+        assert run_in_child(check)
+    finally:
+        release.set()
+
+
+def test_executor_metrics_after_fork_with_held_lock(executor):
+    release = hold_lock(executor.metrics._lock)
+    try:
+        def check():
+            assert executor.select('SELECT count(*) AS n FROM example')[0]['n'] == 0
+            assert executor.metrics.snapshot()['histograms']
+
+        assert run_in_child(check)
+    finally:
+        release.set()
+
+
+def test_pool_after_fork_does_not_reuse_parent_connections(pool, database):
+    parent_conn = pool.get_connection()
+    parent_id = parent_conn.connection_id()
+    try:
+        def check():
+            conn = pool.get_connection()
+            assert conn.connection_id() != parent_id
+            conn.close()
+
+        assert run_in_child(check)
+    finally:
+        parent_conn.close()
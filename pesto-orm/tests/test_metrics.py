@@ -0,0 +1,91 @@
+import pytest
+
+from pesto_orm.core.error import DBError, DBErrorType
+from pesto_orm.core.executor import Executor
+from pesto_orm.core.metrics import Metrics, merge_prometheus
+from pesto_orm.db.pool import ConnectionPool, TooManyConnections
+from stub_db import StubDatabase
+
+
+def parse_families(text):
+    '''
+    返回 {指标族: [样本行]}, 同时检查每个族只有一个 TYPE 且样本连续
+    '''
+    families = {}
+    current = None
+    for line in text.strip().split('\n'):
+        if line.startswith('# TYPE '):
+            current = line.split()[2]
+            assert current not in families, 'duplicate TYPE for {}'.format(current)
+            families[current] = []
+        else:
+            name = line.split('{')[0].split(' ')[0]
+            assert name == current or name.rsplit('_', 1)[0] == current, 'sample {} outside family {}'.format(name, current)
+            families[current].append(line)
+    return families
+
+
+@pytest.fixture
+def replicated_executor():
+    databases = [StubDatabase() for i in range(3)]
+    pools = [ConnectionPool(target=database, core_size=1, max_size=2, validation_interval=0) for database in databases]
+    executor = Executor(pools[0], replica_pools=pools[1:])
+    yield executor
+    executor.close()
+    for database in databases:
+        database.close()
+
+
+def test_to_prometheus_with_replicas(replicated_executor):
+    replicated_executor.execute('CREATE TABLE example (id INTEGER)')
+
+    families = parse_families(replicated_executor.to_prometheus(labels={'app': 'example'}))
+
+    pool_size = families['pesto_pool_size']
+    assert sorted(line.split(' ')[0] for line in pool_size) == ['pesto_pool_size{app="example",pool="primary"}',
+                                                              'pesto_pool_size{app="example",pool="replica-0"}',
+                                                              'pesto_pool_size{app="example",pool="replica-1"}']
+    assert len(families['pesto_pool_connections_created_total']) == 3
+    assert 'pesto_executor_statement_seconds' in families
+
+
+def test_merge_prometheus_counters():
+    first, second = Metrics(), Metrics()
+    first.inc('requests', labels={'code': 200})
+    second.inc('requests', 2, labels={'code': 500})
+    second.observe('latency', 0.01)
+
+    families = parse_families(merge_prometheus([(first, {'source': 'a'}), (second, {'source': 'b'})]))
+
+    assert families['pesto_requests_total'] == ['pesto_requests_total{source="a",code="200"} 1', 'pesto_requests_total{source="b",code="500"} 2']
+    assert families['pesto_latency'][-1] == 'pesto_latency_count{source="b"} 1'
+
+
+def test_error_labels_of_mixed_types(executor, database):
+    # 驱动错误码为 int, 没有错误码时为 None, 其他错误为枚举名
+    database.connections[0].fail_next = 1
+    with pytest.raises(DBError):
+        executor.select('SELECT * FROM example')
+    with pytest.raises(DBError):
+        executor.select('SELECT * FROM missing')
+    executor.metrics.inc('executor_errors', labels={'key': DBError(key=DBErrorType.OPERATE_NOT_SUPPORT_ERROR, message='').code})
+
+    families = parse_families(executor.to_prometheus())
+    samples = families['pesto_executor_errors_total']
+    assert any('key="2013"' in sample for sample in samples)
+    assert any('key="unknown"' in sample for sample in samples)
+    assert any('key="OPERATE_NOT_SUPPORT_ERROR"' in sample for sample in samples)
+    assert len(samples) == 3
+
+
+def test_pool_checkout_metrics(pool):
+    conns = [pool.get_connection() for i in range(3)]
+    with pytest.raises(TooManyConnections):
+        pool.get_connection(timeout=0.05)
+    for conn in conns:
+        conn.close()
+
+    snapshot = pool.get_metrics()
+    assert snapshot['counters']['pool_checkout_timeouts'] == 1
+    assert snapshot['histograms']['pool_checkout_wait_seconds']['count'] == 3
+    assert 'pesto_pool_checkout_timeouts_total 1' in pool.metrics.to_prometheus()
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from pesto_orm.db.pool import ConnectionPool, TooManyConnections
+
+
+def test_checkout_reuses_returned_connection(pool, database):
+    conn = pool.get_connection()
+    connection_id = conn.connection_id
+    conn.close()
+
+    conn = pool.get_connection()
+    assert conn.connection_id == connection_id
+    assert pool.in_use_count() == 1
+    conn.close()
+    assert pool.in_use_count() == 0
+    assert len(database.connections) == 1
+
+
+def test_checkout_timeout_when_max_size_reached(pool):
+    conns = [pool.get_connection() for i in range(3)]
+
+    start = time.time()
+    with pytest.raises(TooManyConnections):
+        pool.get_connection(timeout=0.1)
+    assert time.time() - start >= 0.1
+
+    for conn in conns:
+        conn.close()
+    pool.get_connection(timeout=0.1).close()
+
+
+def test_returned_connection_handed_to_waiter(pool):
+    conns = [pool.get_connection() for i in range(3)]
+    connection_id = conns[0].connection_id
+    result = {}
+
+    def wait():
+        conn = pool.get_connection(timeout=2)
+        result['id'] = conn.connection_id
+        conn.close()
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    time.sleep(0.1)
+    conns[0].close()
+    thread.join(2)
+
+    assert result['id'] == connection_id
+    for conn in conns[1:]:
+        conn.close()
+
+
+def test_max_wait_rejects_extra_waiters(database):
+    pool = ConnectionPool(target=database, core_size=0, max_size=1, max_wait=0, checkout_timeout=1, validation_interval=0)
+    try:
+        conn = pool.get_connection()
+        start = time.time()
+        with pytest.raises(TooManyConnections):
+            pool.get_connection()
+        assert time.time() - start < 0.5
+        conn.close()
+    finally:
+        pool.close()
+
+
+def test_failed_connect_releases_slot(database):
+    pool = ConnectionPool(target=database, core_size=0, max_size=1, checkout_timeout=0.1, validation_interval=0)
+    try:
+        database.fail_connect = 1
+        with pytest.raises(Exception):
+            pool.get_connection()
+
+        conn = pool.get_connection()
+        assert pool.in_use_count() == 1
+        conn.close()
+    finally:
+        pool.close()
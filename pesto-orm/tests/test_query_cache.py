@@ -0,0 +1,47 @@
+import pytest
+
+INSERT_SQL = 'INSERT INTO example (name, amount) VALUES (%s, %s)'
+SUM_SQL = 'SELECT count(*) AS n, sum(amount) AS total FROM example'
+
+
+@pytest.mark.parametrize('method, sql, params', [
+    ('insert', INSERT_SQL, ('b', 2)),
+    ('update', 'UPDATE example SET amount = %s WHERE id = %s', (5, 1)),
+    ('delete', 'DELETE FROM example WHERE id = %s', (1,)),
+])
+def test_query_cache_invalidated_by_write(executor, method, sql, params):
+    executor.insert(INSERT_SQL, ('a', 1))
+    before = executor.select(SUM_SQL, cache_ttl=60)
+
+    getattr(executor, method)(sql, params)
+
+    assert executor.select(SUM_SQL, cache_ttl=60) != before
+
+
+def test_query_cache_invalidated_after_transaction_commit(executor, database):
+    assert executor.select(SUM_SQL, cache_ttl=60) == [{'n': 0, 'total': None}]
+    executor.begin_transaction()
+    try:
+        executor.insert(INSERT_SQL, ('a', 1))
+        executor.commit_transaction()
+    finally:
+        executor.close_transaction()
+    assert executor.select(SUM_SQL, cache_ttl=60) == [{'n': 1, 'total': 1}]
+
+
+def test_query_cache_hit_skips_database(executor, database):
+    executor.select(SUM_SQL, cache_ttl=60)
+    count = database.statements.count(SUM_SQL)
+    executor.select(SUM_SQL, cache_ttl=60)
+    assert database.statements.count(SUM_SQL) == count
+
+
+def test_query_cache_keeps_other_tables(executor):
+    executor.execute('CREATE TABLE other (id INTEGER)')
+    before = executor.select(SUM_SQL, cache_ttl=60)
+    count = len(executor.query_cache)
+
+    executor.insert('INSERT INTO other (id) VALUES (%s)', (1,))
+
+    assert len(executor.query_cache) == count
+    assert executor.select(SUM_SQL, cache_ttl=60) == before
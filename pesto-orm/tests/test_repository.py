@@ -0,0 +1,62 @@
+import pytest
+
+from conftest import Example
+from pesto_orm.core.repository import BaseRepository
+
+
+def test_abstract_methods():
+    assert getattr(BaseRepository.get_dialect, '__isabstractmethod__', False)
+    assert getattr(BaseRepository.get_executor, '__isabstractmethod__', False)
+    assert not getattr(BaseRepository._BaseRepository__timeout, '__isabstractmethod__', False)
+
+
+@pytest.fixture
+def timeouts(executor, monkeypatch):
+    '''
+    记录各执行器方法收到的 timeout
+    '''
+    calls = []
+    for name in ('select', 'select_first', 'insert_many', 'update', 'delete', 'load_data'):
+        method = getattr(executor, name)
+
+        def spy(*args, _name=name, _method=method, **kwargs):
+            calls.append((_name, kwargs.get('timeout')))
+            return _method(*args, **kwargs)
+
+        monkeypatch.setattr(executor, name, spy)
+    return calls
+
+
+def new_example(name):
+    example = Example()
+    example.name = name
+    return example
+
+
+def test_default_timeout(repository, timeouts):
+    repository.timeout = 3
+    repository.insert_by([new_example('a'), new_example('b')])
+    repository.query_by(where='')
+    repository.query_first_by(where='`name` = %s', params=('a',))
+    repository.page_by(where='', page_num=1, page_size=1)
+    repository.get_many([1, 2])
+    repository.update(sql='UPDATE example SET amount = 1')
+    repository.bulk_load([{'name': 'c'}])
+    repository.delete(sql='DELETE FROM example')
+
+    assert {timeout for name, timeout in timeouts} == {3}
+    assert {name for name, timeout in timeouts} == {'select', 'select_first', 'insert_many', 'update', 'delete', 'load_data'}
+
+
+def test_call_timeout(repository, timeouts):
+    repository.timeout = 3
+    repository.insert_by([new_example('a')], timeout=1)
+    repository.query_by(where='', timeout=1)
+    repository.query_first_by(where='`name` = %s', params=('a',), timeout=1)
+    repository.page_by(where='', page_num=1, page_size=1, timeout=1)
+    repository.get_many([1], timeout=1)
+    repository.update_by(columns=['amount'], where='`id` = %s', params=(2, 1), timeout=1)
+    repository.bulk_load([{'name': 'c'}], timeout=1)
+    repository.delete_by(where='`id` = %s', params=(1,), timeout=1)
+
+    assert {timeout for name, timeout in timeouts} == {1}
@@ -0,0 +1,11 @@
+import random
+
+from pesto_orm.core.executor import backoff_delay
+
+
+def test_backoff_delay_starts_at_backoff(monkeypatch):
+    # 取随机抖动的上界
+    monkeypatch.setattr(random, 'uniform', lambda low, high: high)
+
+    assert [backoff_delay(attempt, 0.05, 1.0) for attempt in (1, 2, 3)] == [0.05, 0.1, 0.2]
+    assert backoff_delay(10, 0.05, 1.0) == 1.0
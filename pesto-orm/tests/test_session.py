@@ -0,0 +1,42 @@
+from pesto_orm.core.executor import Executor
+from pesto_orm.db.pool import ConnectionPool
+from stub_db import StubDatabase
+
+INSERT_SQL = 'INSERT INTO example (name, amount) VALUES (%s, %s)'
+NAMES_SQL = 'SELECT name FROM example ORDER BY id'
+
+
+def names(database):
+    return [row[0] for row in database.query(NAMES_SQL)]
+
+
+def test_session_pins_connection(executor, pool, database):
+    with executor.session():
+        executor.select(NAMES_SQL)
+        executor.insert(INSERT_SQL, ('a', 1))
+        assert pool.in_use_count() == 1
+        with executor.transaction():
+            executor.insert(INSERT_SQL, ('b', 2))
+        # 会话内事务结束后不归还连接
+        assert pool.in_use_count() == 1
+        executor.select(NAMES_SQL)
+    assert pool.in_use_count() == 0
+    assert names(database) == ['a', 'b']
+    assert len(database.connections) == 1
+
+
+def test_session_reads_skip_replica(pool, database):
+    replica = StubDatabase()
+    replica_pool = ConnectionPool(target=replica, core_size=1, max_size=1, validation_interval=0)
+    executor = Executor(pool, replica_pools=[replica_pool], max_retries=0)
+    try:
+        executor.select('SELECT 1 AS n')
+        assert replica.statements.count('SELECT 1 AS n') == 1
+
+        with executor.session():
+            executor.select('SELECT 1 AS n')
+        assert replica.statements.count('SELECT 1 AS n') == 1
+        assert database.statements.count('SELECT 1 AS n') == 1
+    finally:
+        executor.close()
+        replica.close()
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from conftest import CREATE_EXAMPLE_SQL, ExampleRepository
+from pesto_orm.core.executor import Executor
+from pesto_orm.core.shard import ShardMerge, ShardRouter
+from pesto_orm.db.pool import ConnectionPool
+from stub_db import StubDatabase
+
+
+@pytest.fixture
+def shards():
+    databases = [StubDatabase(), StubDatabase()]
+    executors = [Executor(ConnectionPool(target=database, core_size=1, max_size=2, checkout_timeout=1, validation_interval=0), max_retries=0)
+                 for database in databases]
+    for executor in executors:
+        executor.execute(CREATE_EXAMPLE_SQL)
+    yield executors
+    for executor in executors:
+        executor.close()
+    for database in databases:
+        database.close()
+
+
+@pytest.fixture
+def sharded_repository(shards):
+    repository = ExampleRepository(shards[0], shard_key='id', shard_router=ShardRouter(shards))
+    for i in range(1, 11):
+        # 按 id 取模: 偶数在分片 0, 奇数在分片 1
+        shards[i % 2].insert('INSERT INTO example (id, name, amount) VALUES (%s, %s, %s)', (i, 'n{}'.format(i), i * 10))
+    return repository
+
+
+def test_shard_merge_parse():
+    merge = ShardMerge('SELECT * FROM example e WHERE e.id IN (SELECT id FROM t ORDER BY id) ORDER BY e.`amount` DESC, name LIMIT 5 OFFSET 10')
+    assert merge.sql.endswith('ORDER BY e.`amount` DESC, name LIMIT 15')
+    assert (merge.order, merge.limit, merge.offset) == ([('amount', True), ('name', False)], 5, 10)
+
+    merge = ShardMerge('SELECT * FROM example LIMIT 10, 5')
+    assert (merge.sql, merge.order, merge.limit, merge.offset) == ('SELECT * FROM example LIMIT 15', [], 5, 10)
+
+    assert ShardMerge('SELECT * FROM example ORDER BY amount + 1').order == []
+
+
+def test_shard_merge_nulls_like_mysql():
+    merge = ShardMerge('SELECT * FROM example ORDER BY amount')
+    assert [row['amount'] for row in merge.merge([[{'amount': None}, {'amount': 2}], [{'amount': 1}]])] == [None, 1, 2]
+
+    merge = ShardMerge('SELECT * FROM example ORDER BY amount DESC')
+    assert [row['amount'] for row in merge.merge([[{'amount': 2}, {'amount': None}], [{'amount': 1}]])] == [2, 1, None]
+
+
+def test_sharded_page_by_sorts_and_limits(sharded_repository):
+    page = sharded_repository.page_by(where='amount > 0 ORDER BY amount DESC', page_num=2, page_size=3)
+    assert [model.get_attr('amount') for model in page] == [70, 60, 50]
+
+    rows = sharded_repository.query(sql='SELECT id, amount FROM example ORDER BY amount LIMIT 4')
+    assert [model.get_attr('amount') for model in rows] == [10, 20, 30, 40]
+
+    stream = sharded_repository.query(sql='SELECT id, amount FROM example ORDER BY amount LIMIT 3 OFFSET 1', yield_able=True)
+    assert [model.get_attr('amount') for model in stream] == [20, 30, 40]
+
+    first = sharded_repository.query_first(sql='SELECT id, amount FROM example ORDER BY amount DESC LIMIT 1')
+    assert first.get_attr('amount') == 100
+
+
+def test_fan_out_runs_first_shard_on_caller_thread(shards):
+    router = ShardRouter(shards)
+    threads = router.fan_out(lambda executor: threading.current_thread())
+
+    assert threads[0] is threading.current_thread()
+    assert threads[1] is not threading.current_thread()
+    # 默认线程数为除第一个分片外各分片连接池的最大连接数之和
+    assert router._pool._max_workers == 2
+    assert ShardRouter(shards, max_workers=8).fan_out(lambda executor: 1) == [1, 1]
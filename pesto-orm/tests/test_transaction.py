@@ -0,0 +1,53 @@
+import pytest
+
+INSERT_SQL = 'INSERT INTO example (name, amount) VALUES (%s, %s)'
+NAMES_SQL = 'SELECT name FROM example ORDER BY id'
+
+
+def names(database):
+    return [row[0] for row in database.query(NAMES_SQL)]
+
+
+def test_inner_rollback_keeps_outer_writes(executor, database, pool):
+    with executor.transaction():
+        executor.insert(INSERT_SQL, ('outer', 1))
+        with pytest.raises(ValueError):
+            with executor.transaction():
+                assert executor.transaction_depth() == 2
+                executor.insert(INSERT_SQL, ('inner', 2))
+                raise ValueError('rollback inner')
+        assert executor.transaction_depth() == 1
+        executor.insert(INSERT_SQL, ('after', 3))
+
+    assert executor.transaction_depth() == 0
+    assert names(database) == ['outer', 'after']
+    assert [sql for sql in database.statements if 'SAVEPOINT' in sql] == ['SAVEPOINT pesto_sp_1', 'ROLLBACK TO SAVEPOINT pesto_sp_1']
+    assert pool.in_use_count() == 0
+
+
+def test_outer_rollback_discards_released_savepoint(executor, database):
+    with pytest.raises(ValueError):
+        with executor.transaction():
+            executor.insert(INSERT_SQL, ('outer', 1))
+            with executor.transaction():
+                executor.insert(INSERT_SQL, ('inner', 2))
+            raise ValueError('rollback outer')
+
+    assert names(database) == []
+    assert 'RELEASE SAVEPOINT pesto_sp_1' in database.statements
+
+
+def test_nested_savepoints_unwind_in_order(executor, database):
+    with executor.transaction():
+        executor.insert(INSERT_SQL, ('a', 1))
+        with executor.transaction():
+            executor.insert(INSERT_SQL, ('b', 2))
+            with pytest.raises(ValueError):
+                with executor.transaction():
+                    assert executor.transaction_depth() == 3
+                    executor.insert(INSERT_SQL, ('c', 3))
+                    raise ValueError('rollback innermost')
+            executor.insert(INSERT_SQL, ('d', 4))
+
+    assert names(database) == ['a', 'b', 'd']
+
@@ -0,0 +1,24 @@
+import threading
+
+from pesto_orm.core.watchdog import Watchdog
+
+
+def test_cancelled_watches_do_not_accumulate():
+    watchdog = Watchdog()
+    for i in range(1000):
+        watch = watchdog.watch(3600, lambda: None)
+        assert watchdog.cancel(watch) is False
+
+    assert len(watchdog._heap) < Watchdog.COMPACT_MIN_SIZE
+    live = watchdog.watch(3600, lambda: None)
+    assert live in [entry[2] for entry in watchdog._heap]
+    watchdog.cancel(live)
+
+
+def test_watch_fires_after_timeout():
+    watchdog = Watchdog()
+    fired = threading.Event()
+    watch = watchdog.watch(0.05, fired.set)
+
+    assert fired.wait(2)
+    assert watchdog.cancel(watch) is True